@@ -24,7 +24,7 @@ import yaml
 import PIL.Image
 
 import tf2onnx
-from tf2onnx.optimizer.transpose_optimizer import TransposeOptimizer
+from tf2onnx.optimizer.pass_manager import default_pass_manager
 from tf2onnx.tfonnx import process_tf_graph
 
 # pylint: disable=broad-except,logging-not-lazy,unused-argument
@@ -308,8 +308,7 @@ class Test(object):
             try:
                 # convert model to onnx
                 onnx_graph = self.to_onnx(sess.graph, opset=opset, shape_override=shape_override)
-                optimizer = TransposeOptimizer(onnx_graph, debug)
-                optimizer.optimize()
+                default_pass_manager(debug=debug).run(onnx_graph, self.output_names)
 
                 model_proto = onnx_graph.make_model("test", self.output_names)
                 print("\tto_onnx", "OK")
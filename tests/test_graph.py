@@ -16,6 +16,8 @@ import tensorflow as tf
 from onnx import helper
 
 import tf2onnx
+from tf2onnx.optimizer.const_fold_optimizer import ConstFoldOptimizer
+from tf2onnx.shape_inference import infer_shapes
 from tf2onnx.tfonnx import process_tf_graph
 from tf2onnx.graph_matcher import OpTypePattern, GraphMatcher
 
@@ -257,6 +259,17 @@ class Tf2OnnxGraphTests(unittest.TestCase):
                 '"Reshape/shape":0 -> Reshape Reshape:0 -> output }',
                 onnx_to_graphviz(g))
 
+    def test_reshape_batch_size(self):
+        with tf.Session() as sess:
+            x1 = tf.placeholder(tf.float32, [None, 2, 3], name="input1")
+            x_ = tf.reshape(x1, tf.stack([tf.shape(x1)[0], 3, 2]))
+            _ = tf.identity(x_, name="output")
+            g = process_tf_graph(sess.graph, opset=7, batch_size=4)
+            ConstFoldOptimizer(g, ["output:0"]).optimize()
+            infer_shapes(g, override=True)
+            self.assertEqual([4, 3, 2], g.get_shape("output:0"))
+            self.assertEqual(['Reshape', 'Identity'], [n.type for n in g.get_nodes()])
+
     def test_custom_rewrite(self):
         # rewriter called from inside process_tf_graph: make a Add a Mul type
         def rewrite_test(g, ops):
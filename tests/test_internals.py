@@ -18,8 +18,10 @@ from onnx import helper
 import tensorflow as tf
 import tf2onnx
 import tf2onnx.utils
-from tf2onnx.graph import Node, Graph
-from tf2onnx.graph_matcher import OpTypePattern, GraphMatcher
+from tf2onnx.graph import Node, Graph, GraphEdit
+from tf2onnx.graph_matcher import OpTypePattern, GraphMatcher, MultiPatternMatcher, RewriteRule, apply_rules, \
+    attr_equals, const_value, MatcherStats, set_stats
+from tf2onnx.tfonnx import process_tf_graph, tensorflow_to_onnx
 
 # pylint: disable=missing-docstring
 
@@ -148,6 +150,70 @@ class Tf2OnnxInternalTests(unittest.TestCase):
                    'n3:0 -> ReplacedOp__2 ReplacedOp__2:0 -> n6 }'
         self.assertEqual(expected, result)
 
+    def test_rewrite_rule(self):
+        model_proto = self.sample_net()
+        g = tf2onnx.graph.Graph(model_proto.node, output_shapes={}, dtypes={})
+        pattern = OpTypePattern('Abs', name='output', inputs=[
+            OpTypePattern('Add', name='input', inputs=['*', '*'])
+        ])
+
+        def build(g, match):
+            input_node = match.get_op('input')
+            output_node = match.get_op('output')
+            op_name = tf2onnx.utils.make_name("ReplacedOp")
+            out_name = tf2onnx.utils.port_name(op_name)
+            new_node = Node(helper.make_node("Sub", input_node.input, [out_name], name=op_name), g)
+            return [new_node], {output_node.output[0]: out_name}
+
+        ops = apply_rules(g, g.get_nodes(), [RewriteRule("sub", pattern, build)])
+        g.set_nodes(ops)
+        g.topological_sort(ops)
+        result = onnx_to_graphviz(g)
+        # n2 and n3 were matched by '*' but are still consumed by the Sub
+        expected = 'digraph { n1 [op_type=Abs] n3 [op_type=Abs] n2 [op_type=Abs] ReplacedOp__2 [op_type=Sub] ' \
+                   'n6 [op_type=Identity] input -> n1 n1:0 -> n3 n1:0 -> n2 n2:0 -> ReplacedOp__2 ' \
+                   'n3:0 -> ReplacedOp__2 ReplacedOp__2:0 -> n6 }'
+        self.assertEqual(expected, result)
+
+    def test_rewrite_rule_incremental(self):
+        nodes = [helper.make_node("Placeholder", [], ["input:0"], name="input")]
+        for i in range(1, 6):
+            inp = "n{}:0".format(i - 1) if i > 1 else "input:0"
+            nodes.append(helper.make_node("Abs", [inp], ["n{}:0".format(i)], name="n{}".format(i)))
+        nodes.append(helper.make_node("Identity", ["n5:0"], ["output:0"], name="output"))
+        pattern = OpTypePattern('Abs', name='outer', inputs=[
+            OpTypePattern('Abs', name='inner')
+        ])
+
+        def build(_, match):
+            return [], {match.get_op('outer').output[0]: match.get_op('inner').output[0]}
+
+        rules = [RewriteRule("abs_abs", pattern, build, keep=["inner"])]
+        # every rewrite leaves the next Abs on an Abs, batch matching only sees the first pairs
+        g = tf2onnx.graph.Graph(nodes, output_shapes={}, dtypes={})
+        ops = apply_rules(g, g.get_nodes(), rules)
+        self.assertEqual(["input", "n1", "n3", "n5", "output"], [n.name for n in ops])
+        g = tf2onnx.graph.Graph(nodes, output_shapes={}, dtypes={})
+        ops = apply_rules(g, g.get_nodes(), rules, incremental=True)
+        self.assertEqual(["input", "n1", "output"], [n.name for n in ops])
+        self.assertEqual(["n1:0"], g.get_node_by_name("output").input)
+
+    def test_graph_edit(self):
+        model_proto = self.sample_net()
+        g = tf2onnx.graph.Graph(model_proto.node, output_shapes={}, dtypes={})
+        edit = GraphEdit()
+        n7 = Node(helper.make_node("Neg", ["n1:0"], ["n7:0"], name="n7"), g)
+        n8 = Node(helper.make_node("Neg", ["n7:0"], ["n8:0"], name="n8"), g)
+        edit.add_nodes([n7, n8])
+        edit.remove_nodes([g.get_node_by_name(name) for name in ["n2", "n5", "n6"]])
+        # renames are followed through chains
+        edit.rename_input("n2:0", "n7:0")
+        edit.rename_input("n7:0", "n8:0")
+        ops = edit.commit(g.get_nodes())
+        self.assertEqual(["n1", "n3", "n4", "n7", "n8"], [n.name for n in ops])
+        self.assertEqual(["n8:0", "n3:0"], g.get_node_by_name("n4").input)
+        self.assertEqual(["n1:0"], n7.input)
+
     def test_match_flipped(self):
         n1 = helper.make_node("Sub", ["i1", "i1"], ["n1:0"], name="n1")
         n2 = helper.make_node("Add", ["i2", "i2"], ["n2:0"], name="n2")
@@ -172,6 +238,215 @@ class Tf2OnnxInternalTests(unittest.TestCase):
         match_results = list(matcher.match_ops(ops))
         self.assertEqual(1, len(match_results))
 
+    @staticmethod
+    def commutative_net(swap_outer, swap_inner):
+        """(c * (a + b)) + (a - b) with the inputs of the Add and the Mul optionally swapped."""
+        nodes = [
+            helper.make_node("Placeholder", [], ["a:0"], name="a"),
+            helper.make_node("Placeholder", [], ["b:0"], name="b"),
+            helper.make_node("Const", [], ["c:0"], name="c"),
+            helper.make_node("Add", ["a:0", "b:0"], ["sum:0"], name="sum"),
+            helper.make_node("Sub", ["a:0", "b:0"], ["diff:0"], name="diff"),
+        ]
+        mul_inputs = ["sum:0", "c:0"] if swap_inner else ["c:0", "sum:0"]
+        nodes.append(helper.make_node("Mul", mul_inputs, ["prod:0"], name="prod"))
+        add_inputs = ["diff:0", "prod:0"] if swap_outer else ["prod:0", "diff:0"]
+        nodes.append(helper.make_node("Add", add_inputs, ["out:0"], name="out"))
+        return tf2onnx.graph.Graph(nodes, output_shapes={}, dtypes={})
+
+    def test_match_reorder_backtracking(self):
+        # commuted inputs on two levels, the 'Add|Sub' input pattern has no exact type
+        pattern = OpTypePattern('Add', name='out', inputs=[
+            OpTypePattern('Add|Sub', name='diff', inputs=['Placeholder', 'Placeholder']),
+            OpTypePattern('Mul', name='prod', inputs=[
+                OpTypePattern('Add', name='sum', inputs=['*', '*']),
+                OpTypePattern('Const', name='c'),
+            ]),
+        ])
+        for swap_outer in [False, True]:
+            for swap_inner in [False, True]:
+                g = self.commutative_net(swap_outer, swap_inner)
+                matches = list(GraphMatcher(pattern, allow_reorder=True).match_ops(g.get_nodes()))
+                self.assertEqual(1, len(matches))
+                for name in ["out", "diff", "prod", "sum", "c"]:
+                    self.assertEqual(name, matches[0].get_op(name).name)
+                in_order = len(list(GraphMatcher(pattern).match_ops(g.get_nodes())))
+                self.assertEqual(1 if swap_outer and swap_inner else 0, in_order)
+
+    def test_match_reorder_same_types(self):
+        # both inputs of the Mul are Adds, only one of them adds two Placeholders.
+        # assigning input patterns greedily by type gives x to 'consts' and fails
+        pattern = OpTypePattern('Mul', inputs=[
+            OpTypePattern('Add', name='consts', inputs=['Const', 'Const']),
+            OpTypePattern('Add', name='vars', inputs=['Placeholder', 'Placeholder']),
+        ])
+        nodes = [
+            helper.make_node("Placeholder", [], ["a:0"], name="a"),
+            helper.make_node("Const", [], ["c:0"], name="c"),
+            helper.make_node("Add", ["a:0", "a:0"], ["x:0"], name="x"),
+            helper.make_node("Add", ["c:0", "c:0"], ["y:0"], name="y"),
+            helper.make_node("Mul", ["x:0", "y:0"], ["m:0"], name="m"),
+            helper.make_node("Mul", ["x:0", "x:0"], ["n:0"], name="n"),
+        ]
+        g = tf2onnx.graph.Graph(nodes, output_shapes={}, dtypes={})
+        matches = list(GraphMatcher(pattern, allow_reorder=True).match_ops(g.get_nodes()))
+        self.assertEqual(1, len(matches))
+        self.assertEqual("y", matches[0].get_op('consts').name)
+        self.assertEqual("x", matches[0].get_op('vars').name)
+
+    def test_match_same_node(self):
+        # n4 = n2 + n3 with n2 and n3 both computed from n1
+        model_proto = self.sample_net()
+        g = tf2onnx.graph.Graph(model_proto.node, output_shapes={}, dtypes={})
+        pattern = OpTypePattern('Add', name='output', inputs=[
+            OpTypePattern('Abs', inputs=[OpTypePattern('*', name='x')]),
+            OpTypePattern('Abs', inputs=[OpTypePattern('*', name='x')]),
+        ])
+        matches = list(GraphMatcher(pattern).match_ops(g.get_nodes()))
+        self.assertEqual(1, len(matches))
+        self.assertEqual("n1", matches[0].get_op('x').name)
+
+        # a shared pattern object has to bind the same node too
+        g.get_node_by_name("n3").input[0] = "input"
+        self.assertEqual([], list(GraphMatcher(pattern).match_ops(g.get_nodes())))
+        shared = OpTypePattern('Abs')
+        pattern = OpTypePattern('Add', inputs=[shared, shared])
+        self.assertEqual([], list(GraphMatcher(pattern).match_ops(g.get_nodes())))
+        self.assertEqual([], list(GraphMatcher(pattern, allow_reorder=True).match_ops(g.get_nodes())))
+
+    def test_match_constraints(self):
+        model_proto = self.sample_net()
+        g = tf2onnx.graph.Graph(model_proto.node, output_shapes={}, dtypes={})
+        # n1 is consumed by n2 and n3, n2 only by n4
+        pattern = OpTypePattern('Abs', name='output', inputs=[OpTypePattern('Abs', single_consumer=True)])
+        self.assertEqual([], list(GraphMatcher(pattern).match_ops(g.get_nodes())))
+        pattern = OpTypePattern('Add', inputs=[OpTypePattern('Abs', single_consumer=True), '*'])
+        self.assertEqual(1, len(list(GraphMatcher(pattern).match_ops(g.get_nodes()))))
+
+        g.get_node_by_name("n3").set_attr("alpha", 2)
+        pattern = OpTypePattern('Abs', name='output', constraints=[attr_equals("alpha", 2)])
+        self.assertEqual(["n3"], [m.get_op('output').name for m in GraphMatcher(pattern).match_ops(g.get_nodes())])
+
+        nodes = [
+            helper.make_node("Const", [], ["c:0"], name="c",
+                             value=helper.make_tensor("v", TensorProto.FLOAT, [1], [2.])),
+            helper.make_node("Const", [], ["d:0"], name="d",
+                             value=helper.make_tensor("v", TensorProto.FLOAT, [1], [3.])),
+            helper.make_node("Mul", ["c:0", "d:0"], ["m:0"], name="m"),
+        ]
+        g = tf2onnx.graph.Graph(nodes, output_shapes={}, dtypes={})
+        two = OpTypePattern('*', name='two', constraints=[const_value(lambda v: v[0] == 2.)])
+        pattern = OpTypePattern('Mul', inputs=['*', two])
+        self.assertEqual([], list(GraphMatcher(pattern).match_ops(g.get_nodes())))
+        matches = list(GraphMatcher(pattern, allow_reorder=True).match_ops(g.get_nodes()))
+        self.assertEqual("c", matches[0].get_op('two').name)
+
+    def test_compiled_pattern(self):
+        pattern = OpTypePattern('Relu|Relu6', name='act', inputs=['*', None, OpTypePattern('Add')])
+        self.assertEqual(frozenset(['Relu', 'Relu6']), pattern.op_types)
+        self.assertEqual(3, pattern.arity)
+        self.assertFalse(pattern.ignored)
+        wildcard, ignored, add = pattern.inputs
+        self.assertIsNone(wildcard.op_types)
+        self.assertFalse(wildcard.ignored)
+        self.assertTrue(ignored.ignored)
+        self.assertEqual(0, add.arity)
+        self.assertEqual((2,), pattern.input_positions('Add'))
+        self.assertEqual((), pattern.input_positions('Mul'))
+
+    def test_multi_pattern_matcher(self):
+        model_proto = self.sample_net()
+        g = tf2onnx.graph.Graph(model_proto.node, output_shapes={}, dtypes={})
+        abs_abs = OpTypePattern('Abs', name='output', inputs=[OpTypePattern('Abs')])
+        abs_add = OpTypePattern('Abs', name='output', inputs=[
+            OpTypePattern('Add', inputs=[OpTypePattern('Abs'), OpTypePattern('Abs')])
+        ])
+        identity = OpTypePattern('Identity', name='output', inputs=['*'])
+
+        def run(abs_add_priority):
+            matcher = MultiPatternMatcher()
+            matcher.add("abs_abs", abs_abs)
+            matcher.add("abs_add", abs_add, priority=abs_add_priority)
+            matcher.add("identity", identity)
+            return [(name, m.get_op('output').name) for name, m in matcher.match_ops(g.get_nodes())]
+
+        # n3 shares n1 with n2, n5 shares n2, the Identity only shares the '*' input n5
+        self.assertEqual([("abs_abs", "n2"), ("identity", "n6")], run(0))
+        self.assertEqual([("abs_add", "n5"), ("identity", "n6")], run(1))
+
+    def test_match_op_type_index(self):
+        model_proto = self.sample_net()
+        g = tf2onnx.graph.Graph(model_proto.node, output_shapes={}, dtypes={})
+        self.assertEqual(["n1", "n2", "n3", "n5"], [n.name for n in g.get_nodes_of_type(["Abs"])])
+        self.assertEqual(["n4", "n6"], [n.name for n in g.get_nodes_of_type(["Identity", "Add"])])
+
+        pattern = OpTypePattern('Abs|Identity', name='output', inputs=[OpTypePattern('*')])
+        matcher = GraphMatcher(pattern)
+        indexed = [m.get_op('output').name for m in matcher.match_ops(g.get_nodes())]
+        scanned = [m.get_op('output').name for m in matcher.match_ops(list(g.get_nodes()))]
+        self.assertEqual(["n1", "n2", "n3", "n5", "n6"], indexed)
+        self.assertEqual(indexed, scanned)
+        self.assertEqual(indexed, [m.get_op('output').name for m in matcher.match_graph(g)])
+
+        # the index follows type changes and new node lists
+        g.get_node_by_name("n2").type = "Neg"
+        self.assertEqual(["n1", "n3", "n5", "n6"], [m.get_op('output').name for m in matcher.match_graph(g)])
+        g.set_nodes([n for n in g.get_nodes() if n.name != "n5"])
+        self.assertEqual(["n1", "n3", "n6"], [m.get_op('output').name for m in matcher.match_graph(g)])
+
+    def test_matcher_stats(self):
+        model_proto = self.sample_net()
+        g = tf2onnx.graph.Graph(model_proto.node, output_shapes={}, dtypes={})
+        pattern = OpTypePattern('Abs', name='output', inputs=[
+            OpTypePattern('Add', name='input', inputs=['*', '*'])
+        ])
+        stats = MatcherStats()
+        previous = set_stats(stats)
+        try:
+            self.assertEqual(1, len(list(GraphMatcher(pattern).match_ops(g.get_nodes()))))
+            multi = MultiPatternMatcher()
+            multi.add("abs_add", pattern)
+            self.assertEqual(1, len(multi.match_ops(g.get_nodes())))
+        finally:
+            set_stats(previous)
+        # n1, n2 and n3 fail on their input, n5 visits all 4 pattern nodes
+        expected = {"attempts": 4, "visits": 10, "matches": 1}
+        result = stats.stats()
+        self.assertEqual(["abs_add", "output"], sorted(result))
+        for name in result:
+            self.assertEqual(expected, {k: v for k, v in result[name].items() if k != "time"})
+        # profiling is off again
+        list(GraphMatcher(pattern).match_ops(g.get_nodes()))
+        self.assertEqual(4, stats.stats()["output"]["attempts"])
+
+    def test_graphdef_pass1(self):
+        with tf.Graph().as_default() as tf_graph:
+            x = tf.placeholder(tf.float32, [None, 6], name="input")
+            a, b = tf.split(x, 2, axis=1)
+            with tf.control_dependencies([a]):
+                y = tf.concat([tf.nn.relu(b), a], axis=1)
+            _ = tf.identity(tf.reshape(y, [-1, 2, 3]), name="output")
+        for add_shapes in [False, True]:
+            graph_def = tf_graph.as_graph_def(add_shapes=add_shapes)
+            with tf.Graph().as_default() as imported:
+                tf.import_graph_def(graph_def, name='')
+            expected = tensorflow_to_onnx(imported, {})
+            result = tensorflow_to_onnx(graph_def, {}, tf_shape_inference=not add_shapes)
+            self.assertEqual([str(n) for n in expected[0]], [str(n) for n in result[0]])
+            self.assertEqual(expected[1:], result[1:])
+        # without _output_shapes and tensorflow shape inference the Placeholder and Const shapes
+        # come from their attributes, the others are left to infer_shapes
+        graph_def = tf_graph.as_graph_def()
+        result = tensorflow_to_onnx(graph_def, {}, tf_shape_inference=False)
+        self.assertEqual([None, 6], result[3]["input:0"])
+        self.assertEqual([3], result[3]["Reshape/shape:0"])
+        self.assertEqual([], result[3]["output:0"])
+        result = tensorflow_to_onnx(graph_def, {"input:0": [1, 6]}, tf_shape_inference=False)
+        self.assertEqual([1, 6], result[3]["input:0"])
+        g = process_tf_graph(graph_def, opset=7, tf_shape_inference=False)
+        self.assertEqual([-1, 6], g.get_shape("input:0"))
+        self.assertEqual([-1, 2, 3], g.get_shape("output:0"))
+
     def test_cmdarg_parse(self):
         arg = "input/V-1_2:0,input/X:0[1,2,3],Y:1[4,5],Z:3,A:1,B"
         expected_inputs = ['input/V-1_2:0', 'input/X:0', 'Y:1', 'Z:3', 'A:1', 'B']
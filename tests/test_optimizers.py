@@ -0,0 +1,625 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""Unit Tests for the onnx graph optimizers."""
+
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+from onnx import TensorProto
+from onnx import helper, numpy_helper
+
+import tf2onnx
+import tf2onnx.utils
+from tf2onnx.graph import Graph
+from tf2onnx.optimizer.affine_optimizer import AffineOptimizer
+from tf2onnx.optimizer.cleanup_optimizer import CleanupOptimizer
+from tf2onnx.optimizer.const_fold_optimizer import ConstFoldOptimizer
+from tf2onnx.optimizer.layout_optimizer import LayoutOptimizer
+from tf2onnx.optimizer.pad_optimizer import PadOptimizer
+from tf2onnx.optimizer.pass_manager import PassManager, default_pass_manager
+from tf2onnx.optimizer.reshape_optimizer import ReshapeOptimizer
+from tf2onnx.optimizer.transpose_optimizer import PUSH_THROUGH_OPS, TransposeOptimizer, compose_perms, invert_perm, \
+    squeeze_perm, unsqueeze_perm
+
+# pylint: disable=missing-docstring,unused-argument
+
+
+def graph_summary(g):
+    """Op types and inputs of all nodes in graph order."""
+    return [(node.type, list(node.input)) for node in g.get_nodes()]
+
+
+class Tf2OnnxOptimizerTests(unittest.TestCase):
+
+    def setUp(self):
+        tf2onnx.utils.INTERNAL_NAME = 1
+
+    def test_cleanup_identity(self):
+        n1 = helper.make_node("Abs", ["input"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Identity", ["n1:0"], ["n2:0"], name="n2")
+        n3 = helper.make_node("StopGradient", ["n2:0"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Add", ["n3:0", "n2:0"], ["n4:0"], name="n4")
+        n5 = helper.make_node("Identity", ["n4:0"], ["n5:0"], name="n5")
+        g = Graph([n1, n2, n3, n4, n5], output_shapes={}, dtypes={})
+        removed = CleanupOptimizer(g, ["n5:0"]).optimize()
+        self.assertEqual(2, removed)
+        self.assertEqual([("Abs", ["input"]), ("Add", ["n1:0", "n1:0"]), ("Identity", ["n4:0"])],
+                         graph_summary(g))
+
+    def test_cleanup_cast(self):
+        dtypes = {"input": TensorProto.INT32, "n1:0": TensorProto.INT64, "n2:0": TensorProto.INT32,
+                  "n3:0": TensorProto.FLOAT, "n4:0": TensorProto.INT32, "n5:0": TensorProto.FLOAT}
+        # int32 -> int64 -> int32 round-trips, float -> int32 truncates and must stay
+        n1 = helper.make_node("Cast", ["input"], ["n1:0"], name="n1", to=TensorProto.INT64)
+        n2 = helper.make_node("Cast", ["n1:0"], ["n2:0"], name="n2", to=TensorProto.INT32)
+        n3 = helper.make_node("Cast", ["n2:0"], ["n3:0"], name="n3", to=TensorProto.FLOAT)
+        n4 = helper.make_node("Cast", ["n3:0"], ["n4:0"], name="n4", to=TensorProto.INT32)
+        n5 = helper.make_node("Cast", ["n4:0"], ["n5:0"], name="n5", to=TensorProto.FLOAT)
+        g = Graph([n1, n2, n3, n4, n5], output_shapes={}, dtypes=dtypes)
+        CleanupOptimizer(g, ["n5:0"]).optimize()
+        self.assertEqual([("Cast", ["input"]), ("Cast", ["n3:0"]), ("Cast", ["n4:0"])],
+                         graph_summary(g))
+
+    def test_cleanup_noop_cast(self):
+        dtypes = {"input": TensorProto.FLOAT, "n1:0": TensorProto.FLOAT, "n2:0": TensorProto.FLOAT}
+        n1 = helper.make_node("Cast", ["input"], ["n1:0"], name="n1", to=TensorProto.FLOAT)
+        n2 = helper.make_node("Abs", ["n1:0"], ["n2:0"], name="n2")
+        g = Graph([n1, n2], output_shapes={}, dtypes=dtypes)
+        CleanupOptimizer(g, ["n2:0"]).optimize()
+        self.assertEqual([("Abs", ["input"])], graph_summary(g))
+
+    def test_const_fold_shape_chain(self):
+        dtypes = {"input": TensorProto.FLOAT}
+        n1 = helper.make_node("Shape", ["input"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Gather", ["n1:0", "idx"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Unsqueeze", ["n2:0"], ["n3:0"], name="n3", axes=[0])
+        n4 = helper.make_node("Concat", ["n3:0", "minus_one"], ["n4:0"], name="n4", axis=0)
+        n5 = helper.make_node("Reshape", ["input", "n4:0"], ["n5:0"], name="n5")
+        g = Graph([n1, n2, n3, n4, n5], output_shapes={"input": [4, 2, 3]}, dtypes=dtypes, opset=7)
+        g.add_initializer(helper.make_tensor("idx", TensorProto.INT64, [], [0]))
+        g.add_initializer(helper.make_tensor("minus_one", TensorProto.INT64, [1], [-1]))
+        folded = ConstFoldOptimizer(g, ["n5:0"]).optimize()
+        self.assertEqual(4, folded)
+        self.assertEqual([("Reshape", ["input", "n4:0"])], graph_summary(g))
+        self.assertEqual(["n4:0"], list(g.initializers))
+        self.assertEqual([4, -1], list(numpy_helper.to_array(g.get_initializer("n4:0"))))
+
+    def test_const_fold_unknown_shape(self):
+        n1 = helper.make_node("Shape", ["input"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Reshape", ["input", "n1:0"], ["n2:0"], name="n2")
+        g = Graph([n1, n2], output_shapes={"input": [-1, 3]}, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        self.assertEqual(0, ConstFoldOptimizer(g, ["n2:0"]).optimize())
+        self.assertEqual(["Shape", "Reshape"], [n.type for n in g.get_nodes()])
+
+    def test_reshape_unsqueeze_squeeze(self):
+        shapes = {"input": [2, 3], "n1:0": [2, 1, 3], "n2:0": [2, 3], "n3:0": [2, 3]}
+        n1 = helper.make_node("Unsqueeze", ["input"], ["n1:0"], name="n1", axes=[1])
+        n2 = helper.make_node("Squeeze", ["n1:0"], ["n2:0"], name="n2", axes=[1])
+        n3 = helper.make_node("Abs", ["n2:0"], ["n3:0"], name="n3")
+        g = Graph([n1, n2, n3], output_shapes=shapes, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        report = ReshapeOptimizer(g, ["n3:0"]).optimize()
+        self.assertEqual({"nodes_before": 3, "nodes_after": 1, "collapsed": 0, "removed": 1}, report)
+        self.assertEqual([("Abs", ["input"])], graph_summary(g))
+
+    def test_reshape_chain(self):
+        shapes = {"input": [-1, 2, 3], "n1:0": [-1, 6], "n2:0": [-1, 6, 1], "n3:0": [-1, 3, 2]}
+        n1 = helper.make_node("Flatten", ["input"], ["n1:0"], name="n1", axis=1)
+        n2 = helper.make_node("Unsqueeze", ["n1:0"], ["n2:0"], name="n2", axes=[2])
+        n3 = helper.make_node("Reshape", ["n2:0", "shape"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Abs", ["n1:0"], ["n4:0"], name="n4")
+        g = Graph([n1, n2, n3, n4], output_shapes=shapes, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        g.add_initializer(helper.make_tensor("shape", TensorProto.INT64, [3], [0, 3, 2]))
+        report = ReshapeOptimizer(g, ["n3:0", "n4:0"]).optimize()
+        self.assertEqual({"nodes_before": 4, "nodes_after": 3, "collapsed": 1, "removed": 0}, report)
+        # the flatten is still used by n4, the unsqueeze is gone
+        self.assertEqual([("Flatten", ["input"]), ("Reshape", ["input", "n3__2"]), ("Abs", ["n1:0"])],
+                         graph_summary(g))
+        self.assertEqual([-1, 3, 2], list(numpy_helper.to_array(g.get_initializer("n3__2"))))
+        self.assertFalse(g.is_initializer("shape"))
+
+    def test_reshape_unknown_tail(self):
+        # the tail of the chain can't collapse, the no-op in front of it is removed anyway
+        shapes = {"input": [2, 3], "n1:0": [1, 2, 3], "n2:0": [2, 3]}
+        n1 = helper.make_node("Unsqueeze", ["input"], ["n1:0"], name="n1", axes=[0])
+        n2 = helper.make_node("Squeeze", ["n1:0"], ["n2:0"], name="n2", axes=[0])
+        n3 = helper.make_node("Reshape", ["n2:0", "shape"], ["n3:0"], name="n3")
+        g = Graph([n1, n2, n3], output_shapes=shapes, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        report = ReshapeOptimizer(g, ["n3:0"]).optimize()
+        self.assertEqual({"nodes_before": 3, "nodes_after": 1, "collapsed": 0, "removed": 1}, report)
+        self.assertEqual([("Reshape", ["input", "shape"])], graph_summary(g))
+
+    def test_pad_fold_nhwc(self):
+        n1 = helper.make_node("Pad", ["input"], ["n1:0"], name="n1", pads=[0, 1, 2, 0, 0, 1, 2, 0])
+        n2 = helper.make_node("Transpose", ["n1:0"], ["n2:0"], name="n2", perm=[0, 3, 1, 2])
+        n3 = helper.make_node("Conv", ["n2:0", "W"], ["n3:0"], name="n3", kernel_shape=[3, 3], pads=[1, 1, 1, 1])
+        g = Graph([n1, n2, n3], output_shapes={"input": [1, 8, 8, 3]}, dtypes={"input": TensorProto.FLOAT})
+        self.assertEqual(1, PadOptimizer(g, ["n3:0"]).optimize())
+        self.assertEqual([("Transpose", ["input"]), ("Conv", ["n2:0", "W"])], graph_summary(g))
+        self.assertEqual([2, 3, 2, 3], g.get_node_by_name("n3").get_attr("pads").ints)
+        self.assertEqual([1, 3, 8, 8], g.get_shape("n2:0"))
+
+    def test_pad_fold_maxpool(self):
+        # maxpool pads with -inf, zero padding only folds after an op that can't be negative
+        n1 = helper.make_node("Pad", ["input"], ["n1:0"], name="n1", pads=[0, 0, 1, 1, 0, 0, 1, 1])
+        n2 = helper.make_node("MaxPool", ["n1:0"], ["n2:0"], name="n2", kernel_shape=[2, 2])
+        n3 = helper.make_node("Relu", ["input"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Pad", ["n3:0"], ["n4:0"], name="n4", pads=[0, 0, 1, 1, 0, 0, 1, 1])
+        n5 = helper.make_node("MaxPool", ["n4:0"], ["n5:0"], name="n5", kernel_shape=[2, 2])
+        n6 = helper.make_node("Pad", ["n3:0"], ["n6:0"], name="n6", pads=[0, 0, 1, 1, 0, 0, 1, 1], value=1.)
+        n7 = helper.make_node("Conv", ["n6:0", "W"], ["n7:0"], name="n7", kernel_shape=[2, 2])
+        g = Graph([n1, n2, n3, n4, n5, n6, n7], output_shapes={}, dtypes={})
+        self.assertEqual(1, PadOptimizer(g, ["n2:0", "n5:0", "n7:0"]).optimize())
+        self.assertEqual(["Pad", "MaxPool", "Relu", "MaxPool", "Pad", "Conv"], [n.type for n in g.get_nodes()])
+        self.assertEqual([1, 1, 1, 1], g.get_node_by_name("n5").get_attr("pads").ints)
+
+    def test_pad_fold_averagepool(self):
+        # the zero padding counts in the average, the exported AveragePool has to say so
+        shapes = {"input:0": [1, 3, 4, 4], "n1:0": [1, 3, 6, 6], "n2:0": [1, 3, 5, 5], "n3:0": [1, 3, 5, 5]}
+        dtypes = {name: TensorProto.FLOAT for name in shapes}
+        n0 = helper.make_node("Placeholder", [], ["input:0"], name="input")
+        n1 = helper.make_node("Pad", ["input:0"], ["n1:0"], name="n1", pads=[0, 0, 1, 1, 0, 0, 1, 1])
+        n2 = helper.make_node("AveragePool", ["n1:0"], ["n2:0"], name="n2", kernel_shape=[2, 2])
+        n3 = helper.make_node("Identity", ["n2:0"], ["n3:0"], name="n3")
+        g = Graph([n0, n1, n2, n3], output_shapes=shapes, dtypes=dtypes, opset=7)
+        self.assertEqual(1, PadOptimizer(g, ["n3:0"]).optimize())
+        model_proto = g.make_model("test", ["n3:0"], optimize=False)
+        pool = [n for n in model_proto.graph.node if n.op_type == "AveragePool"][0]
+        attr = {a.name: helper.get_attribute_value(a) for a in pool.attribute}
+        self.assertEqual(["input:0"], list(pool.input))
+        self.assertEqual([1, 1, 1, 1], attr["pads"])
+        self.assertEqual(1, attr["count_include_pad"])
+
+    def test_affine_fold_nhwc_conv(self):
+        w = np.arange(2 * 3 * 1 * 1, dtype=np.float32).reshape([2, 3, 1, 1])
+        n1 = helper.make_node("Conv", ["input", "W"], ["n1:0"], name="n1", kernel_shape=[1, 1])
+        n2 = helper.make_node("Transpose", ["n1:0"], ["n2:0"], name="n2", perm=[0, 2, 3, 1])
+        n3 = helper.make_node("Mul", ["n2:0", "scale"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Add", ["shift", "n3:0"], ["n4:0"], name="n4")
+        n5 = helper.make_node("Relu", ["n4:0"], ["n5:0"], name="n5")
+        g = Graph([n1, n2, n3, n4, n5], output_shapes={}, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        g.add_initializer(numpy_helper.from_array(w, "W"))
+        g.add_initializer(numpy_helper.from_array(np.array([2., 3.], dtype=np.float32), "scale"))
+        g.add_initializer(numpy_helper.from_array(np.array(0.5, dtype=np.float32), "shift"))
+        self.assertEqual(2, AffineOptimizer(g, ["n5:0"]).optimize())
+        self.assertEqual([("Conv", ["input", "W", "n1__2"]), ("Transpose", ["n1:0"]), ("Relu", ["n2:0"])],
+                         graph_summary(g))
+        np.testing.assert_allclose(w * np.array([2., 3.]).reshape([2, 1, 1, 1]),
+                                   numpy_helper.to_array(g.get_initializer("W")))
+        np.testing.assert_allclose([0.5, 0.5], numpy_helper.to_array(g.get_initializer("n1__2")))
+        self.assertFalse(g.is_initializer("scale") or g.is_initializer("shift"))
+
+    def test_affine_fold_conv_bias(self):
+        n1 = helper.make_node("Conv", ["input", "W", "B"], ["n1:0"], name="n1", kernel_shape=[1, 1])
+        n2 = helper.make_node("Sub", ["n1:0", "c"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Div", ["n2:0", "d"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Relu", ["n3:0"], ["n4:0"], name="n4")
+        g = Graph([n1, n2, n3, n4], output_shapes={}, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        g.add_initializer(numpy_helper.from_array(np.ones([2, 1, 1, 1], dtype=np.float32), "W"))
+        g.add_initializer(numpy_helper.from_array(np.array([1., 2.], dtype=np.float32), "B"))
+        g.add_initializer(numpy_helper.from_array(np.array([[[3.]], [[4.]]], dtype=np.float32), "c"))
+        g.add_initializer(numpy_helper.from_array(np.array([[[2.]]], dtype=np.float32), "d"))
+        self.assertEqual(2, AffineOptimizer(g, ["n4:0"]).optimize())
+        self.assertEqual([("Conv", ["input", "W", "B"]), ("Relu", ["n1:0"])], graph_summary(g))
+        np.testing.assert_allclose([-1., -1.], numpy_helper.to_array(g.get_initializer("B")))
+        np.testing.assert_allclose([0.5, 0.5], numpy_helper.to_array(g.get_initializer("W")).flatten())
+
+    def test_affine_matmul_to_gemm(self):
+        n1 = helper.make_node("MatMul", ["input", "W"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Add", ["n1:0", "B"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Relu", ["n2:0"], ["n3:0"], name="n3")
+        g = Graph([n1, n2, n3], output_shapes={"input": [4, 2]}, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        g.add_initializer(numpy_helper.from_array(np.ones([2, 3], dtype=np.float32), "W"))
+        g.add_initializer(numpy_helper.from_array(np.array([1., 2., 3.], dtype=np.float32), "B"))
+        self.assertEqual(1, AffineOptimizer(g, ["n3:0"]).optimize())
+        self.assertEqual([("Gemm", ["input", "W", "n1__2"]), ("Relu", ["n1:0"])], graph_summary(g))
+        np.testing.assert_allclose([1., 2., 3.], numpy_helper.to_array(g.get_initializer("n1__2")))
+
+    def test_affine_not_per_channel(self):
+        # the constant varies along a spatial axis, it can't go into the weights
+        n1 = helper.make_node("Conv", ["input", "W"], ["n1:0"], name="n1", kernel_shape=[1, 1])
+        n2 = helper.make_node("Mul", ["n1:0", "scale"], ["n2:0"], name="n2")
+        g = Graph([n1, n2], output_shapes={}, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        g.add_initializer(numpy_helper.from_array(np.ones([2, 1, 1, 1], dtype=np.float32), "W"))
+        g.add_initializer(numpy_helper.from_array(np.array([[2.], [3.]], dtype=np.float32), "scale"))
+        self.assertEqual(0, AffineOptimizer(g, ["n2:0"]).optimize())
+        self.assertEqual(["Conv", "Mul"], [n.type for n in g.get_nodes()])
+
+    def test_layout_conv_chain(self):
+        # Transpose -> Conv -> Transpose -> Relu -> Add -> Concat -> Transpose -> Conv -> Transpose
+        n1 = helper.make_node("Transpose", ["input"], ["n1:0"], name="n1", perm=[0, 3, 1, 2])
+        n2 = helper.make_node("Conv", ["n1:0", "W"], ["n2:0"], name="n2", kernel_shape=[1, 1])
+        n3 = helper.make_node("Transpose", ["n2:0"], ["n3:0"], name="n3", perm=[0, 2, 3, 1])
+        n4 = helper.make_node("Relu", ["n3:0"], ["n4:0"], name="n4")
+        n5 = helper.make_node("Add", ["n4:0", "bias"], ["n5:0"], name="n5")
+        n6 = helper.make_node("Concat", ["n4:0", "n5:0"], ["n6:0"], name="n6", axis=3)
+        n7 = helper.make_node("Transpose", ["n6:0"], ["n7:0"], name="n7", perm=[0, 3, 1, 2])
+        n8 = helper.make_node("Conv", ["n7:0", "W2"], ["n8:0"], name="n8", kernel_shape=[1, 1])
+        n9 = helper.make_node("Transpose", ["n8:0"], ["n9:0"], name="n9", perm=[0, 2, 3, 1])
+        g = Graph([n1, n2, n3, n4, n5, n6, n7, n8, n9], output_shapes={}, dtypes={"input": TensorProto.FLOAT},
+                  opset=7)
+        g.add_initializer(numpy_helper.from_array(np.array([1., 2.], dtype=np.float32), "bias"))
+        self.assertEqual(2, LayoutOptimizer(g, ["n9:0"]).optimize())
+        self.assertEqual([("Transpose", ["input"]), ("Conv", ["n1:0", "W"]), ("Relu", ["n2:0"]),
+                          ("Add", ["n4:0", "bias"]), ("Concat", ["n4:0", "n5:0"]), ("Conv", ["n6:0", "W2"]),
+                          ("Transpose", ["n8:0"])], graph_summary(g))
+        self.assertEqual(1, g.get_node_by_name("n6").get_attr("axis").i)
+        self.assertEqual([1, 2, 1, 1], list(g.get_initializer("bias").dims))
+
+    def test_layout_nhwc_consumer(self):
+        # the reshape needs NHWC data, the transpose moves behind the elementwise ops
+        n1 = helper.make_node("Conv", ["input", "W"], ["n1:0"], name="n1", kernel_shape=[1, 1])
+        n2 = helper.make_node("Transpose", ["n1:0"], ["n2:0"], name="n2", perm=[0, 2, 3, 1])
+        n3 = helper.make_node("Pad", ["n2:0"], ["n3:0"], name="n3", pads=[0, 1, 2, 0, 0, 3, 4, 0])
+        n4 = helper.make_node("ReduceMean", ["n3:0"], ["n4:0"], name="n4", axes=[1, 2])
+        n5 = helper.make_node("Sub", ["n3:0", "n4:0"], ["n5:0"], name="n5")
+        n6 = helper.make_node("Reshape", ["n5:0", "shape"], ["n6:0"], name="n6")
+        g = Graph([n1, n2, n3, n4, n5, n6], output_shapes={}, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        self.assertEqual(0, LayoutOptimizer(g, ["n6:0"]).optimize())
+        self.assertEqual([("Conv", ["input", "W"]), ("Pad", ["n1:0"]), ("ReduceMean", ["n3:0"]),
+                          ("Sub", ["n3:0", "n4:0"]), ("Transpose", ["n5:0"]), ("Reshape", ["Transpose__2:0", "shape"])],
+                         graph_summary(g))
+        self.assertEqual([0, 0, 1, 2, 0, 0, 3, 4], g.get_node_by_name("n3").get_attr("pads").ints)
+        self.assertEqual([2, 3], g.get_node_by_name("n4").get_attr("axes").ints)
+
+    def test_layout_nhwc_shape(self):
+        # the transpose inserted for the reshape gets the NHWC shape back
+        n1 = helper.make_node("Conv", ["input", "W"], ["n1:0"], name="n1", kernel_shape=[1, 1])
+        n2 = helper.make_node("Transpose", ["n1:0"], ["n2:0"], name="n2", perm=[0, 2, 3, 1])
+        n3 = helper.make_node("Relu", ["n2:0"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Reshape", ["n3:0", "shape"], ["n4:0"], name="n4")
+        n5 = helper.make_node("Transpose", ["n3:0"], ["n5:0"], name="n5", perm=[0, 3, 1, 2])
+        n6 = helper.make_node("Conv", ["n5:0", "W2"], ["n6:0"], name="n6", kernel_shape=[1, 1])
+        g = Graph([n1, n2, n3, n4, n5, n6], output_shapes={"n1:0": [1, 3, 5, 7], "n2:0": [1, 5, 7, 3],
+                                                           "n3:0": [1, 5, 7, 3]},
+                  dtypes={"input": TensorProto.FLOAT}, opset=7)
+        self.assertEqual(1, LayoutOptimizer(g, ["n4:0", "n6:0"]).optimize())
+        self.assertEqual([1, 3, 5, 7], g.get_shape("n3:0"))
+        transpose = [n for n in g.get_nodes() if n.type == "Transpose"][0]
+        self.assertEqual(["n3:0"], transpose.input)
+        self.assertEqual([1, 5, 7, 3], g.get_shape(transpose.output[0]))
+        self.assertEqual([transpose.output[0], "shape"], g.get_node_by_name("n4").input)
+
+    def test_layout_shared_const(self):
+        # the first consumer gets a copy, the last one permutes the initializer in place
+        n1 = helper.make_node("Conv", ["input", "W"], ["n1:0"], name="n1", kernel_shape=[1, 1])
+        n2 = helper.make_node("Transpose", ["n1:0"], ["n2:0"], name="n2", perm=[0, 2, 3, 1])
+        n3 = helper.make_node("Add", ["n2:0", "bias"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Mul", ["n3:0", "bias"], ["n4:0"], name="n4")
+        n5 = helper.make_node("Transpose", ["n4:0"], ["n5:0"], name="n5", perm=[0, 3, 1, 2])
+        n6 = helper.make_node("Conv", ["n5:0", "W2"], ["n6:0"], name="n6", kernel_shape=[1, 1])
+        g = Graph([n1, n2, n3, n4, n5, n6], output_shapes={}, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        g.add_initializer(numpy_helper.from_array(np.array([1., 2.], dtype=np.float32), "bias"))
+        self.assertEqual(2, LayoutOptimizer(g, ["n6:0"]).optimize())
+        add_const = g.get_node_by_name("n3").input[1]
+        self.assertNotEqual("bias", add_const)
+        self.assertEqual("bias", g.get_node_by_name("n4").input[1])
+        self.assertEqual([1, 2, 1, 1], list(g.get_initializer(add_const).dims))
+        self.assertEqual([1, 2, 1, 1], list(g.get_initializer("bias").dims))
+        self.assertEqual(sorted(["bias", add_const]), sorted(g.initializers))
+
+    def test_layout_graph_output(self):
+        # nothing to gain, the graph is left alone
+        n1 = helper.make_node("Conv", ["input", "W"], ["n1:0"], name="n1", kernel_shape=[1, 1])
+        n2 = helper.make_node("Transpose", ["n1:0"], ["n2:0"], name="n2", perm=[0, 2, 3, 1])
+        n3 = helper.make_node("Relu", ["n2:0"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Reshape", ["n3:0", "shape"], ["n4:0"], name="n4")
+        g = Graph([n1, n2, n3, n4], output_shapes={}, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        self.assertEqual(0, LayoutOptimizer(g, ["n3:0", "n4:0"]).optimize())
+        self.assertEqual(["Conv", "Transpose", "Relu", "Reshape"], [n.type for n in g.get_nodes()])
+
+    def test_pass_manager_schedule(self):
+        calls = []
+
+        def _pass(name, changes):
+            def _run(g, output_names, debug):
+                calls.append(name)
+                return changes.pop(0) if changes else 0
+            return _run
+
+        manager = PassManager(max_iterations=5)
+        manager.register("c", _pass("c", [1, 1]), depends=["a", "b"])
+        manager.register("b", _pass("b", [0]), depends=["a"], fixpoint=False)
+        manager.register("a", _pass("a", []))
+        manager.register("d", _pass("d", []), depends=["c"], enabled=False)
+        g = Graph([], output_shapes={}, dtypes={})
+        self.assertEqual(3, manager.run(g, []))
+        # b only runs in the first iteration, c stops changing in the third
+        self.assertEqual(["a", "b", "c", "a", "c", "a", "c"], calls)
+        self.assertEqual([0, 0, 0, 1, 1, 2, 2], [s["iteration"] for s in manager.stats()])
+        manager.register("e", _pass("e", []), depends=["f"])
+        with self.assertRaises(ValueError):
+            manager.schedule()
+
+    def test_pass_manager_metrics(self):
+        n1 = helper.make_node("Identity", ["input"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Conv", ["n1:0", "W"], ["n2:0"], name="n2", kernel_shape=[1, 1])
+        n3 = helper.make_node("Mul", ["n2:0", "scale"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Relu", ["n3:0"], ["n4:0"], name="n4")
+        g = Graph([n1, n2, n3, n4], output_shapes={}, dtypes={"input": TensorProto.FLOAT}, opset=7)
+        g.add_initializer(numpy_helper.from_array(np.ones([2, 3, 1, 1], dtype=np.float32), "W"))
+        g.add_initializer(numpy_helper.from_array(np.array([2., 3.], dtype=np.float32).reshape([2, 1, 1]), "scale"))
+        manager = default_pass_manager()
+        manager.disable("transpose")
+        self.assertEqual(2, manager.run(g, ["n4:0"]))
+        self.assertEqual(["Conv", "Relu"], [n.type for n in g.get_nodes()])
+        stats = {s["pass"]: s for s in manager.stats() if s["iteration"] == 0}
+        self.assertEqual(["cleanup", "reshape", "pad", "affine"], list(stats))
+        self.assertEqual(-1, stats["cleanup"]["node_delta"])
+        self.assertEqual((-1, -8), (stats["affine"]["node_delta"], stats["affine"]["initializer_bytes_delta"]))
+        self.assertIn("affine", manager.summary())
+
+    def test_transpose_chain(self):
+        # the transposes between the convs cancel, the one in front of the graph output stays
+        n0 = helper.make_node("Placeholder", [], ["input:0"], name="input")
+        n1 = helper.make_node("Transpose", ["input:0"], ["n1:0"], name="n1", perm=[0, 3, 1, 2])
+        n2 = helper.make_node("Conv", ["n1:0", "W"], ["n2:0"], name="n2", kernel_shape=[1, 1])
+        n3 = helper.make_node("Transpose", ["n2:0"], ["n3:0"], name="n3", perm=[0, 2, 3, 1])
+        n4 = helper.make_node("Relu", ["n3:0"], ["n4:0"], name="n4")
+        n5 = helper.make_node("Tanh", ["n4:0"], ["n5:0"], name="n5")
+        n6 = helper.make_node("Transpose", ["n5:0"], ["n6:0"], name="n6", perm=[0, 3, 1, 2])
+        n7 = helper.make_node("Conv", ["n6:0", "W"], ["n7:0"], name="n7", kernel_shape=[1, 1])
+        n8 = helper.make_node("Transpose", ["n7:0"], ["n8:0"], name="n8", perm=[0, 2, 3, 1])
+        n9 = helper.make_node("Identity", ["n8:0"], ["n9:0"], name="n9")
+        g = Graph([n0, n1, n2, n3, n4, n5, n6, n7, n8, n9], output_shapes={}, dtypes={}, opset=7)
+        TransposeOptimizer(g, output_names=["n9:0"]).optimize()
+        self.assertEqual([("Placeholder", []), ("Transpose", ["input:0"]), ("Conv", ["n1:0", "W"]),
+                          ("Relu", ["n2:0"]), ("Tanh", ["n4:0"]), ("Conv", ["n5:0", "W"]),
+                          ("Transpose", ["n7:0"]), ("Identity", ["n8:0"])], graph_summary(g))
+
+    def test_transpose_graph_input(self):
+        # no Placeholder node, the cancelled transpose reads a graph input that has no producer
+        n1 = helper.make_node("Transpose", ["input:0"], ["n1:0"], name="n1", perm=[0, 2, 3, 1])
+        n2 = helper.make_node("Transpose", ["n1:0"], ["n2:0"], name="n2", perm=[0, 3, 1, 2])
+        n3 = helper.make_node("Conv", ["n2:0", "W"], ["n3:0"], name="n3", kernel_shape=[1, 1])
+        n4 = helper.make_node("Transpose", ["n3:0"], ["n4:0"], name="n4", perm=[0, 2, 3, 1])
+        n5 = helper.make_node("Identity", ["n4:0"], ["n5:0"], name="n5")
+        g = Graph([n1, n2, n3, n4, n5], output_shapes={}, dtypes={}, opset=7)
+        TransposeOptimizer(g, output_names=["n5:0"]).optimize()
+        self.assertEqual([("Conv", ["input:0", "W"]), ("Transpose", ["n3:0"]), ("Identity", ["n4:0"])],
+                         graph_summary(g))
+
+    def _push_through_graph(self, op_type, const=None, const_first=False):
+        """Transpose(NHWC) -> op -> Transpose(NCHW) -> Identity, both transposes should cancel."""
+        n0 = helper.make_node("Placeholder", [], ["input:0"], name="input")
+        n1 = helper.make_node("Transpose", ["input:0"], ["n1:0"], name="n1", perm=[0, 2, 3, 1])
+        inputs = ["n1:0"]
+        if const is not None:
+            inputs = ["c", "n1:0"] if const_first else ["n1:0", "c"]
+        n2 = helper.make_node(op_type, inputs, ["n2:0"], name="n2")
+        n3 = helper.make_node("Transpose", ["n2:0"], ["n3:0"], name="n3", perm=[0, 3, 1, 2])
+        n4 = helper.make_node("Identity", ["n3:0"], ["n4:0"], name="n4")
+        g = Graph([n0, n1, n2, n3, n4], output_shapes={}, dtypes={}, opset=7)
+        if const is not None:
+            g.add_initializer(numpy_helper.from_array(const, "c"))
+        TransposeOptimizer(g, output_names=["n4:0"]).optimize()
+        return g
+
+    def test_transpose_push_through_unary(self):
+        for op_type in sorted(op for op, kind in PUSH_THROUGH_OPS.items() if kind == "unary"):
+            g = self._push_through_graph(op_type)
+            self.assertEqual([("Placeholder", []), (op_type, ["input:0"]), ("Identity", ["n2:0"])],
+                             graph_summary(g), op_type)
+
+    def test_transpose_push_through_broadcast(self):
+        # per channel constant of the NHWC data
+        const = np.arange(3, dtype=np.float32)
+        for op_type in sorted(op for op, kind in PUSH_THROUGH_OPS.items() if kind == "broadcast"):
+            for const_first in [False, True]:
+                g = self._push_through_graph(op_type, const, const_first)
+                inputs = ["c", "input:0"] if const_first else ["input:0", "c"]
+                self.assertEqual([("Placeholder", []), (op_type, inputs), ("Identity", ["n2:0"])],
+                                 graph_summary(g), op_type)
+                np.testing.assert_array_equal(const.reshape([1, 3, 1, 1]),
+                                              numpy_helper.to_array(g.get_initializer("c")), op_type)
+
+    def test_transpose_push_through_scalar(self):
+        g = self._push_through_graph("Mul", np.array(2., dtype=np.float32))
+        self.assertEqual(["Placeholder", "Mul", "Identity"], [n.type for n in g.get_nodes()])
+        self.assertEqual([], list(g.get_initializer("c").dims))
+
+    def test_transpose_push_through_const_rank(self):
+        # a constant of higher rank than the data changes the output rank, it stays as it is
+        g = self._push_through_graph("Add", np.ones([2, 1, 1, 1, 3], dtype=np.float32))
+        self.assertEqual(["Placeholder", "Transpose", "Add", "Transpose", "Identity"],
+                         [n.type for n in g.get_nodes()])
+
+    def test_compose_perms(self):
+        perm = [0, 4, 1, 2, 3]
+        self.assertEqual([0, 2, 3, 4, 1], invert_perm(perm))
+        self.assertEqual([0, 1, 2, 3, 4], compose_perms(perm, invert_perm(perm)))
+        x = np.arange(24).reshape([2, 3, 4])
+        np.testing.assert_array_equal(np.transpose(np.transpose(x, [1, 0, 2]), [0, 2, 1]),
+                                      np.transpose(x, compose_perms([1, 0, 2], [0, 2, 1])))
+
+    def test_transpose_merge(self):
+        # 5-D transposes cancel, 3-D ones merge into a single transpose
+        n0 = helper.make_node("Placeholder", [], ["input:0"], name="input")
+        n1 = helper.make_node("Transpose", ["input:0"], ["n1:0"], name="n1", perm=[0, 4, 1, 2, 3])
+        n2 = helper.make_node("Transpose", ["n1:0"], ["n2:0"], name="n2", perm=[0, 2, 3, 4, 1])
+        n3 = helper.make_node("Relu", ["n2:0"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Placeholder", [], ["seq:0"], name="seq")
+        n5 = helper.make_node("Transpose", ["seq:0"], ["n5:0"], name="n5", perm=[1, 0, 2])
+        n6 = helper.make_node("Transpose", ["n5:0"], ["n6:0"], name="n6", perm=[0, 2, 1])
+        n7 = helper.make_node("Identity", ["n6:0"], ["n7:0"], name="n7")
+        g = Graph([n0, n1, n2, n3, n4, n5, n6, n7], output_shapes={}, dtypes={}, opset=7)
+        TransposeOptimizer(g, output_names=["n3:0", "n7:0"]).optimize()
+        self.assertEqual(sorted([("Placeholder", []), ("Relu", ["input:0"]), ("Placeholder", []),
+                                 ("Transpose", ["seq:0"]), ("Identity", ["n6:0"])]), sorted(graph_summary(g)))
+        self.assertEqual([1, 2, 0], g.get_node_by_name("n6").get_attr("perm").ints)
+
+    def test_transpose_const_fold(self):
+        n0 = helper.make_node("Placeholder", [], ["input:0"], name="input")
+        n1 = helper.make_node("Transpose", ["W"], ["n1:0"], name="n1", perm=[1, 2, 0])
+        n2 = helper.make_node("Add", ["input:0", "n1:0"], ["n2:0"], name="n2")
+        g = Graph([n0, n1, n2], output_shapes={}, dtypes={}, opset=7)
+        val = np.arange(24, dtype=np.float32).reshape([2, 3, 4])
+        g.add_initializer(numpy_helper.from_array(val, "W"))
+        TransposeOptimizer(g, output_names=["n2:0"]).optimize()
+        self.assertEqual([("Placeholder", []), ("Add", ["input:0", "n1:0"])], graph_summary(g))
+        np.testing.assert_array_equal(np.transpose(val, [1, 2, 0]), numpy_helper.to_array(g.get_initializer("n1:0")))
+        self.assertFalse(g.is_initializer("W"))
+
+    def test_transpose_split(self):
+        # the transposes after both outputs cancel, the split axis moves from C to 1
+        n0 = helper.make_node("Placeholder", [], ["input:0"], name="input")
+        n1 = helper.make_node("Transpose", ["input:0"], ["n1:0"], name="n1", perm=[0, 2, 3, 1])
+        n2 = helper.make_node("Split", ["n1:0"], ["n2:0", "n2:1"], name="n2", axis=3)
+        n3 = helper.make_node("Transpose", ["n2:0"], ["n3:0"], name="n3", perm=[0, 3, 1, 2])
+        n4 = helper.make_node("Transpose", ["n2:1"], ["n4:0"], name="n4", perm=[0, 3, 1, 2])
+        n5 = helper.make_node("Add", ["n3:0", "n4:0"], ["n5:0"], name="n5")
+        g = Graph([n0, n1, n2, n3, n4, n5], output_shapes={}, dtypes={}, opset=7)
+        TransposeOptimizer(g, output_names=["n5:0"]).optimize()
+        self.assertEqual([("Placeholder", []), ("Split", ["input:0"]), ("Add", ["n2:0", "n2:1"])], graph_summary(g))
+        self.assertEqual(1, g.get_node_by_name("n2").get_attr("axis").i)
+
+    def test_transpose_push_through_same_input(self):
+        n0 = helper.make_node("Placeholder", [], ["input:0"], name="input")
+        n1 = helper.make_node("Transpose", ["input:0"], ["n1:0"], name="n1", perm=[0, 2, 3, 1])
+        n2 = helper.make_node("Sub", ["n1:0", "n1:0"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Transpose", ["n2:0"], ["n3:0"], name="n3", perm=[0, 3, 1, 2])
+        n4 = helper.make_node("Identity", ["n3:0"], ["n4:0"], name="n4")
+        g = Graph([n0, n1, n2, n3, n4], output_shapes={}, dtypes={}, opset=7)
+        TransposeOptimizer(g, output_names=["n4:0"]).optimize()
+        self.assertEqual([("Placeholder", []), ("Sub", ["input:0", "input:0"]), ("Identity", ["n2:0"])],
+                         graph_summary(g))
+
+    def test_squeeze_unsqueeze_perm(self):
+        x = np.random.rand(2, 3, 4, 5)
+        perm = [0, 2, 3, 1]
+        for axes in [[1, 2], [3], [0, 3]]:
+            expected = np.transpose(x, perm).sum(axis=tuple(axes))
+            got = np.transpose(x.sum(axis=tuple(perm[a] for a in axes)), squeeze_perm(perm, axes))
+            np.testing.assert_allclose(expected, got)
+        for axes in [[0], [2, 5], [4]]:
+            expected = np.transpose(x, perm)
+            got = x
+            for a in axes:
+                expected = np.expand_dims(expected, a)
+                got = np.expand_dims(got, a)
+            np.testing.assert_allclose(expected, np.transpose(got, unsqueeze_perm(perm, axes)))
+
+    def _transpose_head_graph(self, op_type, shape, **kwargs):
+        """Transpose(NHWC) -> op -> Identity."""
+        n0 = helper.make_node("Placeholder", [], ["input:0"], name="input")
+        n1 = helper.make_node("Transpose", ["input:0"], ["n1:0"], name="n1", perm=[0, 2, 3, 1])
+        inputs = ["n1:0", "idx"] if op_type == "Gather" else ["n1:0"]
+        n2 = helper.make_node(op_type, inputs, ["n2:0"], name="n2", **kwargs)
+        n3 = helper.make_node("Identity", ["n2:0"], ["n3:0"], name="n3")
+        shapes = {"input:0": shape, "n1:0": [shape[i] for i in [0, 2, 3, 1]]}
+        g = Graph([n0, n1, n2, n3], output_shapes=shapes, dtypes={}, opset=7)
+        g.add_initializer(numpy_helper.from_array(np.array([[0, 1], [1, 0]], dtype=np.int64), "idx"))
+        TransposeOptimizer(g, output_names=["n3:0"]).optimize()
+        return g
+
+    def test_transpose_reduce_head(self):
+        # global pooling without keepdims, the transpose disappears
+        g = self._transpose_head_graph("ReduceMean", [1, 8, 4, 4], axes=[1, 2], keepdims=0)
+        self.assertEqual([("Placeholder", []), ("ReduceMean", ["input:0"]), ("Identity", ["n2:0"])],
+                         graph_summary(g))
+        self.assertEqual([2, 3], g.get_node_by_name("n2").get_attr("axes").ints)
+        # reduce over H, a rank 3 transpose is left
+        g = self._transpose_head_graph("ReduceSum", [1, 8, 4, 4], axes=[-3], keepdims=0)
+        self.assertEqual([("Placeholder", []), ("ReduceSum", ["input:0"]), ("Transpose", ["n2:0"]),
+                          ("Identity", ["n1:0"])], graph_summary(g))
+        self.assertEqual([2], g.get_node_by_name("n2").get_attr("axes").ints)
+        self.assertEqual([0, 2, 1], g.get_node_by_name("n1").get_attr("perm").ints)
+
+    def test_transpose_squeeze_head(self):
+        g = self._transpose_head_graph("Squeeze", [1, 8, 1, 1])
+        self.assertEqual([("Placeholder", []), ("Squeeze", ["input:0"]), ("Identity", ["n2:0"])],
+                         graph_summary(g))
+        self.assertEqual([0, 2, 3], g.get_node_by_name("n2").get_attr("axes").ints)
+
+    def test_transpose_gather(self):
+        g = self._transpose_head_graph("Gather", [2, 3, 4, 5], axis=2)
+        self.assertEqual(["Placeholder", "Gather", "Transpose", "Identity"], [n.type for n in g.get_nodes()])
+        axis = g.get_node_by_name("n2").get_attr("axis").i
+        perm = g.get_node_by_name("n1").get_attr("perm").ints
+        x = np.random.rand(2, 3, 4, 5)
+        idx = np.array([[0, 1], [1, 0]])
+        np.testing.assert_allclose(np.take(np.transpose(x, [0, 2, 3, 1]), idx, axis=2),
+                                   np.transpose(np.take(x, idx, axis=axis), perm))
+
+    def test_transpose_cost_model(self):
+        # moving the transpose of the small input costs a transpose of the big input, it stays
+        shapes = {"small:0": [1, 8, 1, 1], "big:0": [1, 16, 16, 8], "n1:0": [1, 1, 1, 8], "n2:0": [1, 16, 16, 8]}
+        dtypes = {name: TensorProto.FLOAT for name in shapes}
+        n0 = helper.make_node("Placeholder", [], ["small:0"], name="small")
+        n1 = helper.make_node("Placeholder", [], ["big:0"], name="big")
+        n2 = helper.make_node("Transpose", ["small:0"], ["n1:0"], name="n1", perm=[0, 2, 3, 1])
+        n3 = helper.make_node("Add", ["n1:0", "big:0"], ["n2:0"], name="n2")
+        n4 = helper.make_node("Transpose", ["n2:0"], ["n3:0"], name="n3", perm=[0, 3, 1, 2])
+        n5 = helper.make_node("Identity", ["n3:0"], ["n4:0"], name="n4")
+        n6 = helper.make_node("Relu", ["n2:0"], ["n5:0"], name="n5")
+        g = Graph([n0, n1, n2, n3, n4, n5, n6], output_shapes=shapes, dtypes=dtypes, opset=7)
+        report = TransposeOptimizer(g, output_names=["n4:0", "n5:0"]).optimize()
+        self.assertEqual(["Add", "Identity", "Placeholder", "Placeholder", "Relu", "Transpose", "Transpose"],
+                         sorted(n.type for n in g.get_nodes()))
+        self.assertEqual((8224, 8224, 8224), (report["transpose_bytes_before"], report["transpose_bytes_predicted"],
+                                              report["transpose_bytes_after"]))
+        self.assertEqual((0, 0), (report["unknown_size_before"], report["unknown_size_after"]))
+        self.assertEqual({"Add": 1}, report["blocked"])
+
+    def test_transpose_branches_unhandled(self):
+        # a copy of the transpose would get stuck in front of every consumer, the transpose stays
+        shapes = {"input:0": [1, 2, 3, 4], "n1:0": [1, 3, 4, 2]}
+        dtypes = {name: TensorProto.FLOAT for name in shapes}
+        n0 = helper.make_node("Placeholder", [], ["input:0"], name="input")
+        n1 = helper.make_node("Transpose", ["input:0"], ["n1:0"], name="n1", perm=[0, 2, 3, 1])
+        n2 = helper.make_node("Reshape", ["n1:0", "shape"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Softmax", ["n1:0"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Flatten", ["n1:0"], ["n4:0"], name="n4")
+        g = Graph([n0, n1, n2, n3, n4], output_shapes=shapes, dtypes=dtypes, opset=7)
+        report = TransposeOptimizer(g, output_names=["n2:0", "n3:0", "n4:0"]).optimize()
+        self.assertEqual((1, 1), (report["transposes_before"], report["transposes_after"]))
+        self.assertEqual((96, 96), (report["transpose_bytes_before"], report["transpose_bytes_after"]))
+        self.assertNotIn("branches", report["rewrites"])
+
+        # one copy gets stuck, the other one cancels with the NCHW transpose behind the Relu
+        n5 = helper.make_node("Relu", ["n1:0"], ["n5:0"], name="n5")
+        n6 = helper.make_node("Transpose", ["n5:0"], ["n6:0"], name="n6", perm=[0, 3, 1, 2])
+        n7 = helper.make_node("Identity", ["n6:0"], ["n7:0"], name="n7")
+        g = Graph([n0, n1, n2, n5, n6, n7], output_shapes=shapes, dtypes=dtypes, opset=7)
+        report = TransposeOptimizer(g, output_names=["n2:0", "n7:0"]).optimize()
+        self.assertEqual((2, 1), (report["transposes_before"], report["transposes_after"]))
+        self.assertEqual(1, report["rewrites"]["branches"])
+
+    def test_transpose_report(self):
+        n0 = helper.make_node("Placeholder", [], ["input:0"], name="input")
+        n1 = helper.make_node("Transpose", ["input:0"], ["n1:0"], name="n1", perm=[0, 2, 3, 1])
+        n2 = helper.make_node("Relu", ["n1:0"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Reshape", ["n2:0", "shape"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Identity", ["n3:0"], ["n4:0"], name="n4")
+        g = Graph([n0, n1, n2, n3, n4], output_shapes={}, dtypes={}, opset=7)
+        report = TransposeOptimizer(g, output_names=["n4:0"], trace=True).optimize()
+        self.assertEqual((1, 1), (report["transposes_before"], report["transposes_after"]))
+        self.assertEqual({"unary": 1}, report["rewrites"])
+        self.assertEqual(["unary"], list(report["time"]))
+        # the transpose got stuck in front of the reshape
+        self.assertEqual({"Reshape": 1}, report["blocked"])
+        self.assertEqual([{"rewrite": "unary", "transpose": "n1", "node": "n2", "changed": True}],
+                         report["trace"])
+        self.assertEqual(2, report["iterations"])
+
+    def test_transpose_topk(self):
+        # the values go back to NCHW, the indices are a graph output and need a transpose to NHWC
+        n0 = helper.make_node("Placeholder", [], ["input:0"], name="input")
+        n1 = helper.make_node("Transpose", ["input:0"], ["n1:0"], name="n1", perm=[0, 2, 3, 1])
+        n2 = helper.make_node("TopK", ["n1:0"], ["n2:0", "n2:1"], name="n2", k=2)
+        n3 = helper.make_node("Transpose", ["n2:0"], ["n3:0"], name="n3", perm=[0, 3, 1, 2])
+        n4 = helper.make_node("Identity", ["n3:0"], ["n4:0"], name="n4")
+        n5 = helper.make_node("Identity", ["n2:1"], ["n5:0"], name="n5")
+        g = Graph([n0, n1, n2, n3, n4, n5], output_shapes={}, dtypes={}, opset=7)
+        TransposeOptimizer(g, output_names=["n4:0", "n5:0"]).optimize()
+        self.assertEqual(sorted([("Placeholder", []), ("TopK", ["input:0"]), ("Identity", ["n2:0"]),
+                                 ("Transpose", ["n2:1"]), ("Identity", ["Transpose__3:0"])]),
+                         sorted(graph_summary(g)))
+        self.assertEqual(1, g.get_node_by_name("n2").get_attr("axis").i)
+
+
+if __name__ == '__main__':
+    unittest.main()
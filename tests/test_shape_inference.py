@@ -0,0 +1,90 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""Unit Tests for onnx shape inference."""
+
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+from onnx import TensorProto
+from onnx import helper
+
+import tf2onnx
+import tf2onnx.utils
+from tf2onnx.graph import Graph
+from tf2onnx.shape_inference import infer_shapes
+
+# pylint: disable=missing-docstring
+
+
+class Tf2OnnxShapeInferenceTests(unittest.TestCase):
+
+    def setUp(self):
+        tf2onnx.utils.INTERNAL_NAME = 1
+
+    def test_conv_chain(self):
+        n1 = helper.make_node("Transpose", ["input"], ["n1:0"], name="n1", perm=[0, 3, 1, 2])
+        n2 = helper.make_node("Conv", ["n1:0", "W"], ["n2:0"], name="n2", kernel_shape=[3, 3],
+                              strides=[2, 2], pads=[1, 1, 1, 1])
+        n3 = helper.make_node("Relu", ["n2:0"], ["n3:0"], name="n3")
+        n4 = helper.make_node("MaxPool", ["n3:0"], ["n4:0"], name="n4", kernel_shape=[2, 2],
+                              strides=[2, 2])
+        n5 = helper.make_node("GlobalAveragePool", ["n4:0"], ["n5:0"], name="n5")
+        n6 = helper.make_node("Flatten", ["n5:0"], ["n6:0"], name="n6")
+        g = Graph([n1, n2, n3, n4, n5, n6], output_shapes={"input": [-1, 32, 32, 3]},
+                  dtypes={"input": TensorProto.FLOAT}, opset=7)
+        g.add_initializer(helper.make_tensor("W", TensorProto.FLOAT, [16, 3, 3, 3], np.zeros(16 * 27)))
+        infer_shapes(g)
+        self.assertEqual([-1, 3, 32, 32], g.get_shape("n1:0"))
+        self.assertEqual([-1, 16, 16, 16], g.get_shape("n2:0"))
+        self.assertEqual([-1, 16, 8, 8], g.get_shape("n4:0"))
+        self.assertEqual([-1, 16], g.get_shape("n6:0"))
+        self.assertEqual(TensorProto.FLOAT, g.get_dtype("n6:0"))
+
+    def test_maxpool_indices(self):
+        n1 = helper.make_node("MaxPool", ["input"], ["n1:0", "n1:1"], name="n1", kernel_shape=[2, 2],
+                              strides=[2, 2])
+        n2 = helper.make_node("MaxPool", ["unknown"], ["n2:0", "n2:1"], name="n2", kernel_shape=[2, 2])
+        g = Graph([n1, n2], output_shapes={"input": [1, 3, 8, 8]},
+                  dtypes={"input": TensorProto.FLOAT, "unknown": TensorProto.FLOAT}, opset=8)
+        infer_shapes(g)
+        self.assertEqual(([1, 3, 4, 4], TensorProto.FLOAT), (g.get_shape("n1:0"), g.get_dtype("n1:0")))
+        self.assertEqual(([1, 3, 4, 4], TensorProto.INT64), (g.get_shape("n1:1"), g.get_dtype("n1:1")))
+        self.assertEqual(TensorProto.INT64, g.get_dtype("n2:1"))
+
+    def test_reshape_and_broadcast(self):
+        n1 = helper.make_node("Reshape", ["input", "shape"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Add", ["n1:0", "bias"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Greater", ["n2:0", "bias"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Shape", ["n3:0"], ["n4:0"], name="n4")
+        g = Graph([n1, n2, n3, n4], output_shapes={"input": [2, 3, 4], "bias": [4]},
+                  dtypes={"input": TensorProto.FLOAT, "bias": TensorProto.FLOAT}, opset=7)
+        g.add_initializer(helper.make_tensor("shape", TensorProto.INT64, [2], [0, -1]))
+        infer_shapes(g)
+        self.assertEqual([2, 12], g.get_shape("n1:0"))
+        self.assertEqual(None, g.get_shape("n2:0"))
+        g.set_shape("bias", [12])
+        infer_shapes(g)
+        self.assertEqual([2, 12], g.get_shape("n2:0"))
+        self.assertEqual(TensorProto.BOOL, g.get_dtype("n3:0"))
+        self.assertEqual([2], g.get_shape("n4:0"))
+        self.assertEqual(TensorProto.INT64, g.get_dtype("n4:0"))
+
+    def test_refine_and_override(self):
+        n1 = helper.make_node("Transpose", ["input"], ["n1:0"], name="n1", perm=[0, 2, 3, 1])
+        g = Graph([n1], output_shapes={"input": [1, 3, 5, 7], "n1:0": [-1, 5, -1, 3]},
+                  dtypes={"input": TensorProto.FLOAT})
+        infer_shapes(g)
+        self.assertEqual([1, 5, 7, 3], g.get_shape("n1:0"))
+        g.set_shape("n1:0", [1, 3, 5, 7])
+        infer_shapes(g)
+        self.assertEqual([1, 3, 5, 7], g.get_shape("n1:0"))
+        infer_shapes(g, override=True)
+        self.assertEqual([1, 5, 7, 3], g.get_shape("n1:0"))
+
+
+if __name__ == '__main__':
+    unittest.main()
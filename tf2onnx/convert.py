@@ -16,7 +16,7 @@ from onnx import helper
 import tensorflow as tf
 
 import tf2onnx.utils
-from tf2onnx.optimizer.transpose_optimizer import TransposeOptimizer
+from tf2onnx.optimizer.pass_manager import default_pass_manager, DEFAULT_MAX_ITERATIONS
 from tf2onnx.tfonnx import process_tf_graph, tf_optimize, DEFAULT_TARGET, POSSIBLE_TARGETS
 
 _TENSORFLOW_DOMAIN = "ai.onnx.converters.tensorflow"
@@ -34,9 +34,19 @@ def get_args():
     parser.add_argument("--opset", type=int, default=None, help="highest opset to use")
     parser.add_argument("--custom-ops", help="list of custom ops")
     parser.add_argument("--unknown-dim", type=int, default=-1, help="default for unknown dimensions")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="specialize the graph for this batch size and fold the shape computations")
+    parser.add_argument("--layout-propagation", help="decide the layout of all tensors in one pass over the graph "
+                                                     "instead of cancelling transposes locally", action="store_true")
+    parser.add_argument("--enable-passes", default="", help="comma separated graph optimizer passes to enable")
+    parser.add_argument("--disable-passes", default="", help="comma separated graph optimizer passes to disable")
+    parser.add_argument("--max-iterations", type=int, default=DEFAULT_MAX_ITERATIONS,
+                        help="maximum number of times the graph optimizer passes are repeated")
     parser.add_argument("--target", default=",".join(DEFAULT_TARGET), help="target platform")
     parser.add_argument("--continue_on_error", help="continue_on_error", action="store_true")
     parser.add_argument("--verbose", help="verbose output", action="store_true")
+    parser.add_argument("--no-tf-shape-inference", dest="tf_shape_inference", action="store_false",
+                        help="don't build a tensorflow graph for the shapes the graphdef has no _output_shapes for")
     parser.add_argument("--fold_const", help="enable tf constant_folding transformation before conversion",
                         action="store_true")
     args = parser.parse_args()
@@ -46,6 +56,8 @@ def get_args():
         args.inputs, args.shape_override = tf2onnx.utils.split_nodename_and_shape(args.inputs)
     if args.outputs:
         args.outputs = args.outputs.split(",")
+    args.enable_passes = [name for name in args.enable_passes.split(",") if name]
+    args.disable_passes = [name for name in args.disable_passes.split(",") if name]
     if args.target:
         args.target = args.target.split(",")
         for target in args.target:
@@ -85,20 +97,29 @@ def main():
 
     # todo: consider to enable const folding by default?
     graph_def = tf_optimize(args.inputs, args.outputs, graph_def, args.fold_const)
-    with tf.Graph().as_default() as tf_graph:
-        tf.import_graph_def(graph_def, name='')
-    with tf.Session(graph=tf_graph):
-        g = process_tf_graph(tf_graph,
-                             continue_on_error=args.continue_on_error,
-                             verbose=args.verbose,
-                             target=args.target,
-                             opset=args.opset,
-                             custom_op_handlers=custom_ops,
-                             extra_opset=extra_opset,
-                             shape_override=args.shape_override)
-
-    optimizer = TransposeOptimizer(g, args.verbose is not None)
-    optimizer.optimize()
+    # the nodes are read from the graphdef, a tensorflow graph is only built for missing shapes
+    g = process_tf_graph(graph_def,
+                         continue_on_error=args.continue_on_error,
+                         verbose=args.verbose,
+                         target=args.target,
+                         opset=args.opset,
+                         custom_op_handlers=custom_ops,
+                         extra_opset=extra_opset,
+                         shape_override=args.shape_override,
+                         batch_size=args.batch_size,
+                         tf_shape_inference=args.tf_shape_inference)
+
+    manager = default_pass_manager(args.max_iterations, args.verbose)
+    if args.batch_size is not None:
+        manager.enable("const_fold")
+    if args.layout_propagation:
+        manager.enable("layout")
+        manager.disable("transpose")
+    for name in args.enable_passes:
+        manager.enable(name)
+    for name in args.disable_passes:
+        manager.disable(name)
+    manager.run(g, args.outputs)
 
     model_proto = g.make_model(
         "converted from {}".format(args.input), args.outputs,
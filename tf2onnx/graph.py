@@ -9,6 +9,7 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import itertools
 import numpy as np
 
 from onnx import helper, numpy_helper, optimizer, OperatorSetIdProto
@@ -88,6 +89,7 @@ class Node(object):
     def type(self, val):
         """Set Op type."""
         self._op.op_type = val
+        self.graph.bump_version()
 
     @property
     def domain(self):
@@ -246,6 +248,9 @@ class Graph(object):
         self._nodes = []
         self._initializers = {}
         self._nodes_by_name = {}
+        # bumped whenever the node list or a node type changes, invalidates _op_type_index
+        self._version = 0
+        self._op_type_index = None
         self.shapes = {}
         self._model_inputs = {}
         self._target = set(target)
@@ -293,6 +298,39 @@ class Graph(object):
         """Set new node list."""
         self._nodes = ops
         self._nodes_by_name = {op.name: op for op in ops}
+        self.bump_version()
+
+    @property
+    def version(self):
+        return self._version
+
+    def bump_version(self):
+        """Mark the node list as changed.
+
+        set_nodes() and Node.type do this, code that edits the list returned by get_nodes()
+        in place has to call set_nodes() before matching on the graph again.
+        """
+        self._version += 1
+
+    def get_op_type_index(self):
+        """Map op type to the positions of its nodes in get_nodes(), built once per graph version."""
+        if self._op_type_index is None or self._op_type_index[0] != self._version \
+                or self._op_type_index[1] != len(self._nodes):
+            index = {}
+            for i, op in enumerate(self._nodes):
+                index.setdefault(op.type, []).append(i)
+            self._op_type_index = (self._version, len(self._nodes), index)
+        return self._op_type_index[2]
+
+    def get_nodes_of_type(self, op_types):
+        """Nodes of any of the given op types, in node order."""
+        index = self.get_op_type_index()
+        positions = [index[t] for t in op_types if t in index]
+        if not positions:
+            return []
+        if len(positions) > 1:
+            positions = [sorted(itertools.chain(*positions))]
+        return [self._nodes[i] for i in positions[0]]
 
     def update_proto(self):
         """Update the onnx protobuf from out internal Node structure."""
@@ -352,6 +390,12 @@ class Graph(object):
             return self._initializers[name]
         raise ValueError("no initializer called " + name)
 
+    def remove_initializer(self, name):
+        """Remove an initializer that is no longer referenced."""
+        if name not in self._initializers:
+            raise ValueError("no initializer called " + name)
+        del self._initializers[name]
+
     def update_initializer(self, name, tensor):
         if self.is_initializer(name):
             new_tensor = numpy_helper.from_array(tensor, name)
@@ -609,6 +653,19 @@ class Graph(object):
                 nodes.append(node)
         return nodes
 
+    def get_consumer_map(self):
+        """Map every output name to the list of nodes consuming it.
+        Building the map is O(N). Passes that rewire many nodes build it once and keep it
+        current with replace_all_inputs_indexed() instead of calling find_output_consumers().
+        """
+        consumers = collections.defaultdict(list)
+        for node in self.get_nodes():
+            for name in node.input:
+                nodes = consumers[name]
+                if not nodes or nodes[-1] is not node:
+                    nodes.append(node)
+        return consumers
+
     @staticmethod
     def replace_all_inputs(ops, old_input, new_input):
         """Replace all inputs pointing to old_input with new_input."""
@@ -617,6 +674,26 @@ class Graph(object):
                 if input_name == old_input:
                     node.input[i] = new_input
 
+    @staticmethod
+    def replace_all_inputs_indexed(consumers, old_input, new_input):
+        """Replace all inputs pointing to old_input with new_input.
+        Only the nodes recorded for old_input in the consumer map are visited and the map
+        is updated to reflect the change.
+        Args:
+            consumers: consumer map as returned by get_consumer_map()
+            old_input: output name to be replaced
+            new_input: output name replacing it
+        """
+        nodes = consumers.pop(old_input, [])
+        new_consumers = consumers.setdefault(new_input, [])
+        for node in nodes:
+            for i, input_name in enumerate(node.input):
+                if input_name == old_input:
+                    node.input[i] = new_input
+            if node not in new_consumers:
+                new_consumers.append(node)
+        return nodes
+
     @staticmethod
     def replace_input(node, old_input, new_input):
         """Replace node."""
@@ -655,3 +732,66 @@ class Graph(object):
     @staticmethod
     def remove_deleted_nodes(ops):
         return [node for node in ops if not node.is_deleted()]
+
+
+class GraphEdit(object):
+    """Node removals, additions and input renames collected from many rewrites and applied in one pass.
+
+    Rewriters that edit the node list per match pay a scan of all nodes for every match,
+    a GraphEdit rewires, filters and extends the list once in commit().
+    """
+
+    def __init__(self):
+        self._removed = set()
+        self._added = []
+        # old tensor name -> tensor name replacing it
+        self._renames = {}
+
+    def remove_nodes(self, nodes):
+        self._removed.update(n for n in nodes if n)
+
+    def add_nodes(self, nodes):
+        self._added.extend(nodes)
+
+    def rename_input(self, old_input, new_input):
+        """Make all consumers of old_input use new_input."""
+        if old_input != new_input:
+            self._renames[old_input] = new_input
+
+    def _rename_inputs(self, node):
+        for i, name in enumerate(node.input):
+            if name in self._renames:
+                node.input[i] = self._resolve(name)
+
+    def _resolve(self, name):
+        seen = set()
+        while name in self._renames and name not in seen:
+            seen.add(name)
+            name = self._renames[name]
+        return name
+
+    def commit(self, ops):
+        """Apply the edit to ops. Returns the new node list.
+
+        A removed node whose outputs are still consumed after the renames is kept
+        so that the graph doesn't end up with dangling inputs.
+        """
+        added = set(self._added)
+        consumed = set()
+        for node in itertools.chain(ops, self._added):
+            if node in self._removed:
+                continue
+            self._rename_inputs(node)
+            consumed.update(node.input)
+
+        removed = set(self._removed)
+        changed = True
+        while changed:
+            changed = False
+            for node in list(removed):
+                if any(name in consumed for name in node.output):
+                    removed.discard(node)
+                    self._rename_inputs(node)
+                    consumed.update(node.input)
+                    changed = True
+        return [n for n in ops if n not in removed and n not in added] + self._added
@@ -18,13 +18,43 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import copy
+import collections
+import itertools
+import time
+
+from onnx import helper
+
+from tf2onnx.graph import GraphEdit
+
+
+def attr_equals(name, value):
+    """Constraint: the op has attribute name with the given value."""
+    def _check(op):
+        attr = op.get_attr(name)
+        return attr is not None and helper.get_attribute_value(attr) == value
+    return _check
+
+
+def const_value(predicate=None):
+    """Constraint: the op is a Const and predicate, if given, is true for its value."""
+    def _check(op):
+        return op.is_const() and (predicate is None or bool(predicate(op.get_tensor_value())))
+    return _check
 
 
 class OpTypePattern(object):
-    """A tree pattern that matches TF expressions with certain op types."""
+    """A tree pattern that matches TF expressions with certain op types.
+
+    Patterns are compiled when they are created: the accepted op types, the arity and
+    the wildcard flags are computed once so that matching doesn't parse op_type.
+    Patterns are immutable after that.
 
-    def __init__(self, op_type, name=None, inputs=None):
+    Constraints are checked on a candidate op before its inputs are matched. A name
+    that appears several times in a pattern, like a pattern object used several times,
+    has to match the same op everywhere.
+    """
+
+    def __init__(self, op_type, name=None, inputs=None, constraints=None, single_consumer=False):
         """Initializes an OpTypePattern.
 
         Args:
@@ -34,25 +64,72 @@ class OpTypePattern(object):
             (3) multiple op types separated by '|', e.g., 'Relu|Relu6'.
             We could use regex strings, which might be worthwhile when we have many
             similar TF op types.
+            None matches anything, including a missing op, without recording it in
+            the MatchResult.
           name: Optional string. The name of the pattern that can be looked up in
             MatchResult.
           inputs: Optional list of `OpTypePattern`s or strings that specify the
             patterns for the inputs of a matching op. If None, this pattern accepts
             any inputs of a matching op.
+          constraints: Optional list of functions that take the candidate op and
+            return False to reject it, see attr_equals and const_value.
+          single_consumer: if True the outputs of the op may only be consumed by
+            one node, the op the parent pattern matched. Use it for the inner nodes
+            of a subgraph the rewriter removes.
         """
         self._op_type = op_type
         self._name = name
         if inputs is None:
             inputs = []
-        self._inputs = [
+        self._inputs = tuple(
             input_pattern if isinstance(input_pattern, OpTypePattern) else
             OpTypePattern(input_pattern) for input_pattern in inputs
-            ]
+        )
+        self._ignored = op_type is None
+        # None if the pattern accepts any op type
+        if op_type is None or op_type == '*':
+            self._op_types = None
+        else:
+            self._op_types = frozenset(op_type.split('|'))
+        self._arity = len(self._inputs)
+        # longest path from the root to an input pattern
+        self._depth = 1 + max(p.depth for p in self._inputs) if self._inputs else 0
+        # input positions by op_type string, allow_reorder prefers inputs of the exact type
+        input_positions = {}
+        for i, input_pattern in enumerate(self._inputs):
+            input_positions.setdefault(input_pattern.op_type, []).append(i)
+        self._input_positions = {k: tuple(v) for k, v in input_positions.items()}
+        self._constraints = tuple(constraints or ())
+        self._single_consumer = single_consumer
+        self._constrained = bool(self._constraints) or single_consumer
 
     @property
     def op_type(self):
         return self._op_type
 
+    @property
+    def op_types(self):
+        """frozenset of the accepted op types, None for '*' and None."""
+        return self._op_types
+
+    @property
+    def ignored(self):
+        """True for op_type None, the pattern matches without looking at the op."""
+        return self._ignored
+
+    @property
+    def arity(self):
+        """Number of input patterns, 0 accepts any inputs."""
+        return self._arity
+
+    @property
+    def depth(self):
+        """Number of edges from the root to the deepest input pattern.
+
+        A match rooted at an op only covers ops at most depth edges upstream of it.
+        """
+        return self._depth
+
     @property
     def inputs(self):
         return self._inputs
@@ -61,6 +138,23 @@ class OpTypePattern(object):
     def name(self):
         return self._name
 
+    @property
+    def constraints(self):
+        return self._constraints
+
+    @property
+    def single_consumer(self):
+        return self._single_consumer
+
+    @property
+    def constrained(self):
+        """True if the pattern has constraints or requires a single consumer."""
+        return self._constrained
+
+    def input_positions(self, op_type):
+        """Positions of the input patterns whose op_type is exactly op_type."""
+        return self._input_positions.get(op_type, ())
+
 
 class MatchResult(object):
     r"""Encapsulates the result of a match done by GraphMatcher.
@@ -92,13 +186,26 @@ class MatchResult(object):
         self._name_to_pattern = {}
 
     def add(self, pattern, op, tensor):
-        self._pattern_to_op_tensor[pattern] = op, tensor
+        """Bind pattern to op. Returns False if pattern or its name is bound to another op."""
+        bound = self._pattern_to_op_tensor.get(pattern)
+        if bound is not None:
+            return bound[0] is op
         if pattern.name is not None:
-            # allow this so we can apply subgraphs multiple times
-            # if pattern.name in self._name_to_pattern:
-            #   raise ValueError(
-            #       'Name %s is already bound to another pattern' % pattern.name)
-            self._name_to_pattern[pattern.name] = pattern
+            other = self._name_to_pattern.get(pattern.name)
+            if other is not None:
+                if self._pattern_to_op_tensor[other][0] is not op:
+                    return False
+            else:
+                self._name_to_pattern[pattern.name] = pattern
+        self._pattern_to_op_tensor[pattern] = op, tensor
+        return True
+
+    def checkpoint(self):
+        """State to go back to with rollback()."""
+        return dict(self._pattern_to_op_tensor), dict(self._name_to_pattern)
+
+    def rollback(self, checkpoint):
+        self._pattern_to_op_tensor, self._name_to_pattern = dict(checkpoint[0]), dict(checkpoint[1])
 
     def _to_pattern(self, pattern_or_name):
         if isinstance(pattern_or_name, OpTypePattern):
@@ -119,19 +226,97 @@ class MatchResult(object):
     def get_nodes(self):
         return [n[0] for n in self._pattern_to_op_tensor.values()]
 
+    def get_typed_nodes(self):
+        """Nodes matched by patterns that name op types, i.e. not by '*'."""
+        return [n[0] for p, n in self._pattern_to_op_tensor.items() if p.op_types is not None]
+
+
+def _candidates(ops, op_types):
+    """The ops in `ops` whose type is in op_types, all of them if op_types is None.
+
+    If `ops` is the node list of a tf2onnx Graph its op type index is used,
+    otherwise `ops` is filtered by type.
+    """
+    if op_types is None:
+        return ops
+    if isinstance(ops, list) and ops:
+        graph = getattr(ops[0], "graph", None)
+        if hasattr(graph, "get_nodes_of_type") and graph.get_nodes() is ops:
+            return graph.get_nodes_of_type(op_types)
+    return (op for op in ops if op is not None and op.type in op_types)
+
+
+class MatcherStats(object):
+    """Profiling counters of the matchers, per pattern name.
+
+    For every pattern the root attempts (match_op calls), the pattern nodes visited
+    while matching, the successful matches and the time spent are summed up.
+    """
+
+    def __init__(self):
+        self._patterns = collections.OrderedDict()
+
+    def record(self, name, visits, matched, elapsed):
+        counters = self._patterns.get(name)
+        if counters is None:
+            counters = {"attempts": 0, "visits": 0, "matches": 0, "time": 0.}
+            self._patterns[name] = counters
+        counters["attempts"] += 1
+        counters["visits"] += visits
+        counters["matches"] += int(matched)
+        counters["time"] += elapsed
+
+    def stats(self):
+        """dict of pattern name -> dict with attempts, visits, matches and time."""
+        return {name: dict(counters) for name, counters in self._patterns.items()}
+
+    def summary(self):
+        """Table of the counters per pattern."""
+        lines = ["{:<16} {:>9} {:>9} {:>8} {:>10}".format("pattern", "attempts", "visits", "matches", "time(ms)")]
+        for name, counters in self._patterns.items():
+            lines.append("{:<16} {:>9} {:>9} {:>8} {:>10.1f}".format(
+                name, counters["attempts"], counters["visits"], counters["matches"], counters["time"] * 1000))
+        return "\n".join(lines)
+
+
+# MatcherStats all matchers record into, None if profiling is off
+_STATS = None
+
+
+def set_stats(stats):
+    """Let all matchers record into stats, None turns profiling off. Returns the previous stats."""
+    global _STATS  # pylint: disable=global-statement
+    previous = _STATS
+    _STATS = stats
+    return previous
+
 
 class GraphMatcher(object):
     """Checks if a particular subgraph matches a given pattern."""
 
-    def __init__(self, pattern, allow_reorder=False):
+    def __init__(self, pattern, allow_reorder=False, name=None):
         """Initializes a GraphMatcher.
 
         Args:
           pattern: The `OpTypePattern` against which `GraphMatcher` matches
             subgraphs.
+          name: name the matcher is profiled under, defaults to the name or the
+            op_type of the root pattern.
         """
         self._pattern = pattern
+        self._name = name or pattern.name or pattern.op_type
+        # pattern nodes visited by the last match_op
+        self._visits = 0
         self._allow_reorder = allow_reorder
+        self._match_result = None
+        # (pattern, op) -> match, for allow_reorder
+        self._memo = {}
+        # id(graph) -> (graph, version, consumer counts by tensor name)
+        self._consumers = {}
+
+    @property
+    def pattern(self):
+        return self._pattern
 
     def _match_pattern(self, pattern, op, tensor):
         """Returns whether an TF expression rooted at `op` matches `pattern`.
@@ -149,46 +334,125 @@ class GraphMatcher(object):
         Returns:
           True if an TF expression rooted at `op` matches `pattern`.
         """
-        if pattern.op_type is None:
+        self._visits += 1
+        if pattern.ignored:
             return True
 
-        if pattern.op_type != '*':
-            if op is None or op.type not in pattern.op_type.split('|'):
-                return False
+        op_types = pattern.op_types
+        if op_types is not None and (op is None or op.type not in op_types):
+            return False
 
-        self._match_result.add(pattern, op, tensor)
-        # print("matched", ",".join([op.type + "|" + op.name for op in self._match_result.get_nodes()]))
+        if pattern.constrained and not self._check_constraints(pattern, op):
+            return False
+
+        if not self._match_result.add(pattern, op, tensor):
+            return False
 
-        if not pattern.inputs:
+        arity = pattern.arity
+        if not arity:
             # If pattern.inputs is empty, skips the rest and accepts all the inputs.
             return True
 
-        if not op or len(op.inputs) != len(pattern.inputs):
+        if not op:
+            return False
+        op_inputs = op.inputs
+        if len(op_inputs) != arity:
             return False
 
         if self._allow_reorder:
-            inputs = [None] * len(op.inputs)
-            wanted = copy.copy(pattern.inputs)
-            for idx, i in enumerate(op.inputs):
-                for j in range(len(wanted)):  # pylint: disable=consider-using-enumerate
-                    if i.type == wanted[j].op_type:
-                        inputs[idx] = wanted[j]
-                        del wanted[j]
-                        break
-            for idx, i in enumerate(inputs):
-                if i is None:
-                    inputs[idx] = wanted[0]
-                    del wanted[0]
-            pat = list(zip(op.inputs, inputs))
+            # the assignments only check the structure, the named bindings can still
+            # conflict, in which case the next assignment is tried
+            for input_patterns in self._assignments(pattern, op_inputs):
+                checkpoint = self._match_result.checkpoint()
+                if self._match_inputs(op_inputs, input_patterns):
+                    return True
+                self._match_result.rollback(checkpoint)
+            return False
+        return self._match_inputs(op_inputs, pattern.inputs)
+
+    def _match_inputs(self, op_inputs, input_patterns):
+        for input_tensor, input_pattern in zip(op_inputs, input_patterns):
+            if not self._match_pattern(input_pattern, input_tensor, input_tensor):
+                return False
+        return True
+
+    def _check_constraints(self, pattern, op):
+        if op is None:
+            return False
+        if pattern.single_consumer and self._consumer_count(op) != 1:
+            return False
+        for constraint in pattern.constraints:
+            if not constraint(op):
+                return False
+        return True
+
+    def _consumer_count(self, op):
+        """Number of node inputs consuming the outputs of op.
+
+        The counts are taken once per match_ops call and graph version.
+        """
+        graph = op.graph
+        cached = self._consumers.get(id(graph))
+        if cached is None or cached[0] is not graph or cached[1] != graph.version:
+            counts = collections.Counter(name for node in graph.get_nodes() for name in node.input)
+            cached = graph, graph.version, counts
+            self._consumers[id(graph)] = cached
+        counts = cached[2]
+        return sum(counts[name] for name in op.output)
+
+    def reset_consumers(self, cache=None):
+        """Forget the consumer maps, matchers passed the same cache dict share them."""
+        self._consumers = {} if cache is None else cache
+
+    def _matches(self, pattern, op):
+        """Returns whether `op` matches `pattern` with reordered inputs, memoized per match_op.
+
+        Only the structure and the constraints are checked, not the named bindings.
+        """
+        key = pattern, op
+        ret = self._memo.get(key)
+        if ret is not None:
+            return ret
+        if pattern.ignored:
+            ret = True
+        elif pattern.op_types is not None and (op is None or op.type not in pattern.op_types):
+            ret = False
+        elif pattern.constrained and not self._check_constraints(pattern, op):
+            ret = False
+        elif not pattern.arity:
+            ret = True
+        elif not op:
+            ret = False
         else:
-            pat = list(zip(op.inputs, pattern.inputs))
+            op_inputs = op.inputs
+            ret = len(op_inputs) == pattern.arity and next(self._assignments(pattern, op_inputs), None) is not None
+        self._memo[key] = ret
+        return ret
 
-        ret = []
-        for input_tensor, input_pattern in pat:
-            # print("MATCHING", input_pattern.op_type, input_tensor.type)
-            r = self._match_pattern(input_pattern, input_tensor, input_tensor)
-            ret.append(r)
-        return all(ret)
+    def _assignments(self, pattern, op_inputs):
+        """Yields the orders of the input patterns that match op_inputs.
+
+        Backtracks over the permutations of the input patterns. Each op input tries
+        the patterns whose op_type is exactly its type first, then the others in order.
+        """
+        inputs = pattern.inputs
+        assigned = [None] * len(op_inputs)
+
+        def _assign(idx, used):
+            if idx == len(op_inputs):
+                yield assigned
+                return
+            op_input = op_inputs[idx]
+            preferred = pattern.input_positions(op_input.type) if op_input is not None else ()
+            others = (j for j in range(len(inputs)) if j not in preferred)
+            for j in itertools.chain(preferred, others):
+                if used & (1 << j) or not self._matches(inputs[j], op_input):
+                    continue
+                assigned[idx] = inputs[j]
+                for ret in _assign(idx + 1, used | (1 << j)):
+                    yield ret
+
+        return _assign(0, 0)
 
     def match_op(self, op):
         """Matches `op` against `self._pattern`.
@@ -201,20 +465,32 @@ class GraphMatcher(object):
           None.
         """
         self._match_result = MatchResult()
-        if not self._match_pattern(self._pattern, op, tensor=None):
-            return None
-        return self._match_result
+        if self._allow_reorder:
+            self._memo = {}
+        stats = _STATS
+        if stats is None:
+            if not self._match_pattern(self._pattern, op, tensor=None):
+                return None
+            return self._match_result
+        self._visits = 0
+        start = time.time()
+        matched = self._match_pattern(self._pattern, op, tensor=None)
+        stats.record(self._name, self._visits, matched, time.time() - start)
+        return self._match_result if matched else None
 
     def match_ops(self, ops):
         """Matches each operation in `ops` against `self._pattern`.
 
+        Only ops whose type the root of the pattern accepts are tried.
+
         Args:
           ops: collection of `tf.Operation` to match against the pattern.
 
         Yields:
           `MatchResult` for each `tf.Operation` that matches the pattern.
         """
-        for op in ops:
+        self.reset_consumers()
+        for op in _candidates(ops, self._pattern.op_types):
             match_result = self.match_op(op)
             if match_result:
                 yield match_result
@@ -223,11 +499,299 @@ class GraphMatcher(object):
         """Matches each operation in `graph` against `self._pattern`.
 
         Args:
-          graph: `tf.Graph` containing operations to match.
+          graph: `tf.Graph` or tf2onnx `Graph` containing operations to match.
 
         Yields:
           `MatchResult` for each `tf.Operation` in `graph` that matches the pattern.
         """
+        if hasattr(graph, "get_nodes_of_type"):
+            ops = graph.get_nodes()
+        else:
+            ops = graph.get_operations()
         # Python 3.3.2+ implements `yield from`, but for now:
-        for match_result in self.match_ops(graph.get_operations()):
+        for match_result in self.match_ops(ops):
             yield match_result
+
+
+class MultiPatternMatcher(object):
+    """Matches several patterns in a single traversal of the ops.
+
+    Every op is only tried against the patterns whose root accepts its type. The
+    matches are returned by priority, higher first, then by the order the patterns
+    were added and then in op order. A match is dropped if it shares a node with a
+    match returned before it; nodes matched by '*' are inputs the rewrites keep and
+    may be shared.
+    """
+
+    def __init__(self):
+        # (priority, order, name, matcher)
+        self._entries = []
+        self._dispatch = {}
+        # op types any of the roots accepts, None if one accepts any op
+        self._root_types = frozenset()
+
+    def add(self, name, pattern, allow_reorder=False, priority=0):
+        """Add a pattern, its matches are reported with name."""
+        self._entries.append((-priority, len(self._entries), name, GraphMatcher(pattern, allow_reorder, name)))
+        self._entries.sort(key=lambda e: e[:2])
+        self._dispatch = {}
+        root_types = [e[3].pattern.op_types for e in self._entries]
+        if any(t is None for t in root_types):
+            self._root_types = None
+        else:
+            self._root_types = frozenset().union(*root_types)
+
+    def _matchers(self, op_type):
+        """Entries whose root accepts op_type, in priority order."""
+        entries = self._dispatch.get(op_type)
+        if entries is None:
+            entries = [e for e in self._entries
+                       if e[3].pattern.op_types is None or op_type in e[3].pattern.op_types]
+            self._dispatch[op_type] = entries
+        return entries
+
+    @property
+    def radius(self):
+        """Largest pattern depth, an edit can only change matches rooted this far downstream."""
+        return max([e[3].pattern.depth for e in self._entries] or [0])
+
+    def reset_consumers(self, cache=None):
+        """Let all matchers share the consumer counts in cache."""
+        cache = {} if cache is None else cache
+        for entry in self._entries:
+            entry[3].reset_consumers(cache)
+
+    def match_op(self, op):
+        """Matches op against the patterns in priority order.
+
+        Returns:
+          (name, `MatchResult`) of the first pattern op matches, None if there is none.
+        """
+        for entry in self._matchers(op.type):
+            match_result = entry[3].match_op(op)
+            if match_result:
+                return entry[2], match_result
+        return None
+
+    def match_ops(self, ops):
+        """Matches the ops against all patterns.
+
+        Args:
+          ops: collection of `tf.Operation` to match against the patterns.
+
+        Returns:
+          list of (name, `MatchResult`) of the non-overlapping matches.
+        """
+        # order the pattern was added -> its matches
+        found = {entry[1]: [] for entry in self._entries}
+        self.reset_consumers()
+        for op in _candidates(ops, self._root_types):
+            if op is None:
+                continue
+            for entry in self._matchers(op.type):
+                match_result = entry[3].match_op(op)
+                if match_result:
+                    found[entry[1]].append(match_result)
+
+        claimed = set()
+        matches = []
+        for entry in self._entries:
+            for match_result in found[entry[1]]:
+                nodes = match_result.get_typed_nodes()
+                if any(node in claimed for node in nodes):
+                    continue
+                claimed.update(nodes)
+                matches.append((entry[2], match_result))
+        return matches
+
+
+class RewriteRule(object):
+    """A pattern and the function building its replacement.
+
+    build is called as build(graph, match) and returns (new_nodes, renames): the nodes
+    to add and a dict mapping tensors of the matched nodes to the tensors replacing
+    them, or None to leave the match alone. The matched nodes, except those whose
+    pattern names are in keep, are removed.
+    """
+
+    def __init__(self, name, pattern, build, keep=None, allow_reorder=False, priority=0):
+        self.name = name
+        self.pattern = pattern
+        self.build = build
+        self.keep = list(keep or [])
+        self.allow_reorder = allow_reorder
+        self.priority = priority
+
+
+def apply_rules(g, ops, rules, incremental=False):
+    """Match all rules in one traversal of ops and apply them with a single GraphEdit.
+
+    Matches are applied in rule priority order, then in the order of rules, and are
+    skipped if they overlap a match applied before. Returns the new node list.
+
+    With incremental the rules are instead applied as soon as they match, see
+    _apply_rules_incremental, so rewrites enabled by other rewrites are found in
+    the same call.
+    """
+    by_name = {}
+    matcher = MultiPatternMatcher()
+    for rule in rules:
+        if rule.name in by_name:
+            raise ValueError("rule " + rule.name + " is given twice")
+        by_name[rule.name] = rule
+        matcher.add(rule.name, rule.pattern, rule.allow_reorder, rule.priority)
+    if incremental:
+        return _apply_rules_incremental(g, ops, matcher, by_name)
+    edit = GraphEdit()
+    for name, match in matcher.match_ops(ops):
+        rule = by_name[name]
+        replacement = rule.build(g, match)
+        if replacement is None:
+            continue
+        new_nodes, renames = replacement
+        keep = [match.get_op(k) for k in rule.keep]
+        edit.remove_nodes(n for n in match.get_nodes() if n not in keep)
+        edit.add_nodes(new_nodes)
+        for old_input, new_input in renames.items():
+            edit.rename_input(old_input, new_input)
+    return edit.commit(ops)
+
+
+class _ConsumerCounts(object):
+    """Consumer counts read from a consumer map that is updated by every rewrite."""
+
+    def __init__(self, consumers):
+        self._consumers = consumers
+
+    def __getitem__(self, name):
+        return len(self._consumers.get(name, ()))
+
+
+def _unique(nodes):
+    seen = set()
+    ret = []
+    for node in nodes:
+        if node is not None and node not in seen:
+            seen.add(node)
+            ret.append(node)
+    return ret
+
+
+def _downstream(nodes, consumers, radius):
+    """nodes and the nodes consuming their outputs, up to radius edges away."""
+    frontier = _unique(nodes)
+    visited = set(frontier)
+    ret = list(frontier)
+    for _ in range(radius):
+        next_frontier = []
+        for node in frontier:
+            for out in node.output:
+                for consumer in consumers.get(out, ()):
+                    if consumer not in visited:
+                        visited.add(consumer)
+                        next_frontier.append(consumer)
+        ret.extend(next_frontier)
+        frontier = next_frontier
+    return ret
+
+
+def _apply_rules_incremental(g, ops, matcher, by_name):
+    """Apply the rules with a worklist of ops that are (re)matched.
+
+    The ops are tried in order, each against the rules in priority order, and the
+    first match is applied right away. The edit only changes matches rooted at
+    most matcher.radius edges downstream of the nodes it added, rewired or kept,
+    or of the producers that lost a consumer, so only those are queued again.
+    A chain of rewrites, each enabled by the one before, converges in one call
+    while untouched ops are matched once.
+    """
+    # tensor -> nodes consuming it, once per input
+    consumers = collections.defaultdict(list)
+    producers = {}
+    for node in ops:
+        for name in node.input:
+            consumers[name].append(node)
+        for name in node.output:
+            producers[name] = node
+    counts = _ConsumerCounts(consumers)
+    cache = {}
+    matcher.reset_consumers(cache)
+    radius = matcher.radius
+
+    removed = set()
+    added = []
+    queue = collections.deque(ops)
+    queued = set(ops)
+    # a rule that keeps matching its own replacement would never stop
+    max_rewrites = 2 * len(ops) + 100
+    rewrites = 0
+    while queue:
+        op = queue.popleft()
+        queued.discard(op)
+        if op in removed:
+            continue
+        cache[id(g)] = g, g.version, counts
+        found = matcher.match_op(op)
+        if found is None:
+            continue
+        name, match = found
+        rule = by_name[name]
+        matched = _unique(match.get_nodes())
+        inputs_before = {node: list(node.input) for node in matched}
+        replacement = rule.build(g, match)
+        if replacement is None:
+            continue
+        rewrites += 1
+        if rewrites > max_rewrites:
+            raise ValueError("rewrite rules don't converge, last applied " + name)
+        new_nodes, renames = replacement
+        keep = [match.get_op(k) for k in rule.keep]
+        touched = list(new_nodes) + [n for n in keep if n is not None]
+
+        # build may have changed the inputs of the matched nodes it keeps
+        for node, before in inputs_before.items():
+            if node.input != before:
+                for input_name in before:
+                    consumers[input_name].remove(node)
+                for input_name in node.input:
+                    consumers[input_name].append(node)
+        for node in new_nodes:
+            for input_name in node.input:
+                consumers[input_name].append(node)
+            for output_name in node.output:
+                producers[output_name] = node
+        added.extend(new_nodes)
+
+        for old_input, new_input in renames.items():
+            rewired = _unique(consumers.pop(old_input, []))
+            for node in rewired:
+                for i, input_name in enumerate(node.input):
+                    if input_name == old_input:
+                        node.input[i] = new_input
+                        consumers[new_input].append(node)
+            touched.extend(rewired)
+
+        # matched nodes whose outputs are still consumed stay
+        to_remove = set(n for n in matched if n not in keep)
+        changed = True
+        while changed:
+            changed = False
+            for node in list(to_remove):
+                if any(c not in to_remove for out in node.output for c in consumers.get(out, ())):
+                    to_remove.discard(node)
+                    changed = True
+        for node in to_remove:
+            removed.add(node)
+            for input_name in node.input:
+                consumers[input_name].remove(node)
+                producer = producers.get(input_name)
+                if producer is not None:
+                    touched.append(producer)
+
+        # requeue everything within radius downstream of the edit
+        for node in _downstream(touched, consumers, radius):
+            if node not in removed and node not in queued:
+                queue.append(node)
+                queued.add(node)
+
+    return [n for n in ops if n not in removed] + [n for n in added if n not in removed]
@@ -5,4 +5,5 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-__all__ = ["transpose_optimizer"]
+__all__ = ["affine_optimizer", "cleanup_optimizer", "const_fold_optimizer", "layout_optimizer", "pad_optimizer",
+           "pass_manager", "reshape_optimizer", "transpose_optimizer"]
@@ -0,0 +1,245 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Affine Optimizer - fold constant Mul/Add/Sub/Div chains into Conv, ConvTranspose, Gemm and MatMul."""
+
+import logging
+
+import numpy as np
+from onnx import helper, numpy_helper
+
+from tf2onnx import utils
+from tf2onnx.shape_inference import get_input_shape
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.affine_optimizer")
+
+# pylint: disable=logging-not-lazy,missing-docstring
+
+_AFFINE_OPS = ["Add", "Div", "Mul", "Sub"]
+
+
+def _attr(node, name, default=None):
+    attr = node.get_attr(name)
+    if attr is None:
+        return default
+    return helper.get_attribute_value(attr)
+
+
+class AffineOptimizer(object):
+    """Fold per-channel constant scale and shift ops into the weights and bias of the op in front.
+
+    Handles chains like Conv -> Mul -> Add -> Sub -> Div with scalar or per-channel
+    constants in any broadcast shape, also behind the NHWC Transpose that
+    conv_convert_inputs puts after a Conv. An existing bias is updated, a missing one
+    is created. A MatMul of a 2-D input followed by an Add becomes a Gemm.
+    """
+
+    def __init__(self, graph, output_names, debug=False):
+        self._g = graph
+        self._output_names = set(output_names)
+        self._debug = debug
+        self._consumers = None
+
+    def optimize(self):
+        ops = self._g.get_nodes()
+        self._consumers = self._g.get_consumer_map()
+        removed = set()
+        for node in ops:
+            if node in removed or node.domain or node.type not in ["Conv", "ConvTranspose", "Gemm", "MatMul"]:
+                continue
+            folded = self._fold_next(node)
+            while folded is not None:
+                removed.add(folded)
+                folded = self._fold_next(node)
+        if removed:
+            self._g.set_nodes([n for n in self._g.get_nodes() if n not in removed])
+        log.debug("folded " + str(len(removed)) + " node(s)")
+        return len(removed)
+
+    def _single_consumer(self, name):
+        if name in self._output_names:
+            return None
+        consumers = self._consumers.get(name, [])
+        if len(consumers) != 1:
+            return None
+        return consumers[0]
+
+    def _const(self, name):
+        if not self._g.is_initializer(name):
+            return None
+        return numpy_helper.to_array(self._g.get_initializer(name))
+
+    def _fold_next(self, node):
+        """Fold the affine op consuming node's output. Return the removed node or None."""
+        out_name = node.output[0]
+        consumer = self._single_consumer(out_name)
+        perm = None
+        transpose = None
+        if consumer is not None and consumer.type == "Transpose":
+            transpose = consumer
+            perm = _attr(transpose, "perm")
+            if perm is None:
+                return None
+            consumer = self._single_consumer(transpose.output[0])
+        if consumer is None or consumer.type not in _AFFINE_OPS or consumer.domain:
+            return None
+        if consumer.output[0] in self._output_names:
+            # the graph output would lose its producer
+            return None
+        data = (transpose or node).output[0]
+        if data not in consumer.input[:2] or consumer.input[0] == consumer.input[1]:
+            return None
+        const_index = 1 if consumer.input[0] == data else 0
+        const = self._const(consumer.input[const_index])
+        if const is None or not np.issubdtype(const.dtype, np.floating):
+            return None
+
+        rank = self._output_rank(node, perm)
+        if rank is None:
+            return None
+        vec = self._per_channel(node, consumer, const, rank, perm)
+        if vec is None:
+            return None
+
+        if consumer.type == "Mul":
+            scale, shift = vec, None
+        elif consumer.type == "Div":
+            if const_index == 0 or not np.all(vec):
+                return None
+            scale, shift = 1. / vec, None
+        elif consumer.type == "Add":
+            scale, shift = None, vec
+        elif const_index == 1:
+            scale, shift = None, np.negative(vec)
+        else:
+            # const - x
+            scale, shift = -np.ones_like(vec), vec
+
+        if not self._apply(node, scale, shift):
+            return None
+
+        # drop the affine op
+        self._g.replace_all_inputs_indexed(self._consumers, consumer.output[0], data)
+        for name in consumer.input:
+            consumers = self._consumers.get(name)
+            if consumers and consumer in consumers:
+                consumers.remove(consumer)
+            if not consumers and self._g.is_initializer(name) and name not in self._output_names:
+                self._g.remove_initializer(name)
+        return consumer
+
+    def _output_rank(self, node, perm):
+        if perm is not None:
+            return len(perm)
+        if node.type in ["Conv", "ConvTranspose"]:
+            weights = self._const(node.input[1])
+            return weights.ndim if weights is not None else None
+        if node.type == "Gemm":
+            return 2
+        # matmul keeps the rank of its first input
+        shape = get_input_shape(self._g, node.output[0]) or get_input_shape(self._g, node.input[0])
+        return len(shape) if shape else None
+
+    def _channels(self, node):
+        """Number of output channels and the channel axis of the output, None if it can't be folded."""
+        weights = self._const(node.input[1])
+        if weights is None:
+            return None, None
+        if node.type == "Conv":
+            return weights.shape[0], 1
+        if node.type == "ConvTranspose":
+            if _attr(node, "group", 1) != 1:
+                return None, None
+            return weights.shape[1], 1
+        if node.type == "Gemm":
+            return weights.shape[0] if _attr(node, "transB", 0) else weights.shape[1], -1
+        if weights.ndim != 2:
+            return None, None
+        return weights.shape[1], -1
+
+    def _per_channel(self, node, consumer, const, rank, perm):
+        """Return const as vector over the output channels of node, None if it isn't per-channel."""
+        channels, axis = self._channels(node)
+        if channels is None or const.ndim > rank:
+            return None
+        shape = list(const.shape)
+        legacy_axis = _attr(consumer, "axis") if self._g.opset < 7 else None
+        if legacy_axis is not None:
+            # legacy broadcast aligns the constant at axis instead of at the end
+            shape = [1] * legacy_axis + shape
+            shape = shape + [1] * (rank - len(shape))
+        else:
+            shape = [1] * (rank - len(shape)) + shape
+        if len(shape) != rank:
+            return None
+        expanded = const.reshape(shape)
+        if perm is not None:
+            # constant is in the layout of the transpose output, bring it into the layout of node
+            expanded = np.transpose(expanded, np.argsort(perm))
+        axis = axis % rank
+        if any(d != 1 for i, d in enumerate(expanded.shape) if i != axis):
+            return None
+        if expanded.shape[axis] not in [1, channels]:
+            return None
+        return np.broadcast_to(expanded.reshape(-1), (channels,)).astype(const.dtype)
+
+    def _set_weight(self, node, index, value):
+        """Set a weight/bias input of node, copying the initializer if something else uses it."""
+        name = node.input[index] if index < len(node.input) else ""
+        consumers = self._consumers.get(name, [])
+        if name and consumers == [node]:
+            self._g.update_initializer(name, value)
+            return
+        new_name = utils.make_name(node.name)
+        self._g.make_const(new_name, value)
+        if name:
+            consumers.remove(node)
+            node.input[index] = new_name
+        else:
+            node.input.append(new_name)
+        self._consumers[new_name].append(node)
+
+    def _apply(self, node, scale, shift):
+        if node.type == "MatMul" and shift is not None and not self._to_gemm(node):
+            return False
+        weights = self._const(node.input[1])
+        bias = self._const(node.input[2]) if len(node.input) > 2 else None
+        if node.type in ["Conv", "ConvTranspose"]:
+            w_axis = 0 if node.type == "Conv" else 1
+        elif node.type == "Gemm":
+            w_axis = 0 if _attr(node, "transB", 0) else 1
+        else:
+            w_axis = 1
+        channels = weights.shape[w_axis]
+        if bias is None and node.type != "MatMul":
+            bias = np.zeros(channels, dtype=weights.dtype)
+        if node.type == "Gemm":
+            beta = _attr(node, "beta", 1.)
+            if shift is not None and beta == 0:
+                return False
+
+        if scale is not None:
+            shape = [1] * weights.ndim
+            shape[w_axis] = channels
+            weights = weights * scale.reshape(shape)
+            self._set_weight(node, 1, weights.astype(self._const(node.input[1]).dtype))
+            if bias is not None:
+                bias = bias * scale
+        if shift is not None:
+            if node.type == "Gemm":
+                bias = bias + shift / beta
+            else:
+                bias = bias + shift
+        if bias is not None and (scale is not None and len(node.input) > 2 or shift is not None):
+            if node.type == "Gemm" and self._g.opset < 7:
+                node.set_attr("broadcast", 1)
+            self._set_weight(node, 2, bias.astype(weights.dtype))
+        return True
+
+    def _to_gemm(self, node):
+        """Turn a MatMul of a 2-D input into a Gemm so it can take a bias."""
+        shape = get_input_shape(self._g, node.input[0])
+        if shape is None or len(shape) != 2 or self._const(node.input[1]) is None:
+            return False
+        node.type = "Gemm"
+        return True
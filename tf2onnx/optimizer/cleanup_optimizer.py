@@ -0,0 +1,122 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Cleanup Optimizer - remove Identity, StopGradient and redundant Cast nodes."""
+
+import collections
+import logging
+
+from onnx import onnx_pb
+
+from tf2onnx import utils
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.cleanup_optimizer")
+
+# pylint: disable=logging-not-lazy,missing-docstring
+
+_IDENTITY_OPS = ["Identity", "StopGradient"]
+
+_T = onnx_pb.TensorProto
+
+# a cast from the key dtype to any of the listed dtypes keeps every value intact,
+# so casting the result back (or to any other dtype) gives the same result as
+# casting the original tensor.
+_LOSSLESS_CASTS = {
+    _T.BOOL: [_T.INT8, _T.UINT8, _T.INT16, _T.UINT16, _T.INT32, _T.INT64, _T.FLOAT16, _T.FLOAT, _T.DOUBLE],
+    _T.INT8: [_T.INT16, _T.INT32, _T.INT64, _T.FLOAT16, _T.FLOAT, _T.DOUBLE],
+    _T.UINT8: [_T.INT16, _T.UINT16, _T.INT32, _T.INT64, _T.FLOAT16, _T.FLOAT, _T.DOUBLE],
+    _T.INT16: [_T.INT32, _T.INT64, _T.FLOAT, _T.DOUBLE],
+    _T.UINT16: [_T.INT32, _T.INT64, _T.FLOAT, _T.DOUBLE],
+    _T.INT32: [_T.INT64, _T.DOUBLE],
+    _T.FLOAT16: [_T.FLOAT, _T.DOUBLE],
+    _T.FLOAT: [_T.DOUBLE],
+}
+
+_DTYPE_BY_NAME = {v: k for k, v in utils.ONNX_DTYPE_NAMES.items()}
+
+
+def get_cast_to(node):
+    """Return the target dtype of a Cast node, None if unknown."""
+    to = node.get_attr("to")
+    if to is None:
+        return None
+    if to.s:
+        # opset < 6 casts carry the dtype name as string
+        return _DTYPE_BY_NAME.get(to.s.decode("utf-8"))
+    return to.i
+
+
+class CleanupOptimizer(object):
+    """Remove Identity/StopGradient nodes and Cast nodes that don't change the data.
+
+    Nodes producing a graph output are kept so the output names stay intact.
+    All rewiring goes through a consumer map that is built once, so the cost is
+    proportional to the number of removed nodes and their consumers.
+    """
+
+    def __init__(self, graph, output_names, debug=False):
+        self._g = graph
+        self._output_names = set(output_names)
+        self._debug = debug
+        self._consumers = None
+        self._removed = set()
+
+    def optimize(self):
+        self._consumers = self._g.get_consumer_map()
+        self._removed = set()
+        ops = self._g.get_nodes()
+        for node in ops:
+            if node in self._removed:
+                continue
+            if node.type in _IDENTITY_OPS:
+                self._remove_identity(node)
+            elif node.type == "Cast":
+                self._remove_redundant_cast(node)
+
+        if self._removed:
+            self._g.set_nodes([n for n in ops if n not in self._removed])
+        if self._debug:
+            removed = collections.Counter(n.type for n in self._removed)
+            print("cleanup optimizer: removed {} node(s) {}".format(
+                len(self._removed), ", ".join("{}: {}".format(k, v) for k, v in sorted(removed.items()))))
+        log.debug("removed " + str(len(self._removed)) + " node(s)")
+        return len(self._removed)
+
+    def _is_graph_output(self, node):
+        return any(name in self._output_names for name in node.output)
+
+    def _drop(self, node):
+        self._removed.add(node)
+        for name in node.input:
+            consumers = self._consumers.get(name)
+            if consumers and node in consumers:
+                consumers.remove(node)
+
+    def _bypass(self, node):
+        """Point all consumers of node to its input and drop node."""
+        self._g.replace_all_inputs_indexed(self._consumers, node.output[0], node.input[0])
+        self._drop(node)
+
+    def _remove_identity(self, node):
+        if self._is_graph_output(node) or len(node.input) != 1:
+            return
+        self._bypass(node)
+
+    def _remove_redundant_cast(self, node):
+        producer = self._g.get_node_by_name(node.input[0])
+        if producer is not None and producer.type == "Cast" and producer not in self._removed:
+            src_dtype = self._g.get_dtype(producer.input[0])
+            if get_cast_to(producer) in _LOSSLESS_CASTS.get(src_dtype, []):
+                # the first cast keeps every value, so read straight from its input
+                old_input = node.input[0]
+                self._g.replace_input(node, old_input, producer.input[0])
+                self._consumers[old_input].remove(node)
+                self._consumers[producer.input[0]].append(node)
+                if not self._consumers[old_input] and not self._is_graph_output(producer):
+                    self._drop(producer)
+
+        to = get_cast_to(node)
+        if to is None or self._is_graph_output(node):
+            return
+        if self._g.get_dtype(node.input[0]) == to:
+            self._bypass(node)
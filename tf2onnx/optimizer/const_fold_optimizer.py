@@ -0,0 +1,185 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Const Fold Optimizer - evaluate nodes whose inputs are known at conversion time."""
+
+import logging
+
+import numpy as np
+from onnx import helper, numpy_helper
+
+from tf2onnx import utils
+from tf2onnx.optimizer.cleanup_optimizer import get_cast_to
+from tf2onnx.shape_inference import get_input_shape
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.const_fold_optimizer")
+
+# pylint: disable=logging-not-lazy,missing-docstring,unused-argument
+
+
+def _attr(node, name, default=None):
+    attr = node.get_attr(name)
+    if attr is None:
+        return default
+    return helper.get_attribute_value(attr)
+
+
+def _fold_shape(node, shapes, values):
+    return np.array(shapes[0], dtype=np.int64)
+
+
+def _fold_size(node, shapes, values):
+    return np.array(np.prod(shapes[0], dtype=np.int64), dtype=np.int64)
+
+
+def _fold_cast(node, shapes, values):
+    return values[0].astype(utils.ONNX_TO_NUMPY_DTYPE[get_cast_to(node)])
+
+
+def _fold_gather(node, shapes, values):
+    return np.take(values[0], values[1], axis=_attr(node, "axis", 0))
+
+
+def _fold_concat(node, shapes, values):
+    return np.concatenate(values, axis=_attr(node, "axis", 0))
+
+
+def _fold_unsqueeze(node, shapes, values):
+    val = values[0]
+    rank = val.ndim + len(_attr(node, "axes"))
+    for axis in sorted(a + rank if a < 0 else a for a in _attr(node, "axes")):
+        val = np.expand_dims(val, axis)
+    return val
+
+
+def _fold_squeeze(node, shapes, values):
+    axes = _attr(node, "axes")
+    return np.squeeze(values[0], axis=tuple(axes) if axes is not None else None)
+
+
+def _fold_slice(node, shapes, values):
+    val = values[0]
+    starts = _attr(node, "starts")
+    ends = _attr(node, "ends")
+    axes = _attr(node, "axes", list(range(len(starts))))
+    index = [slice(None)] * val.ndim
+    for axis, start, end in zip(axes, starts, ends):
+        index[axis] = slice(start, end)
+    return val[tuple(index)]
+
+
+def _fold_reshape(node, shapes, values):
+    val = values[0]
+    target = values[1] if len(values) > 1 else _attr(node, "shape")
+    target = [val.shape[i] if d == 0 else d for i, d in enumerate(np.array(target).flatten().tolist())]
+    return val.reshape(target)
+
+
+def _fold_binary(node, shapes, values):
+    if node.get_attr("axis") is not None:
+        # legacy broadcast along an axis doesn't follow numpy rules
+        return None
+    a, b = values
+    if node.type == "Add":
+        return a + b
+    if node.type == "Sub":
+        return a - b
+    if node.type == "Mul":
+        return a * b
+    if np.issubdtype(a.dtype, np.integer):
+        # onnx integer division truncates toward zero
+        return np.fix(np.true_divide(a, b)).astype(a.dtype)
+    return a / b
+
+
+# op type -> (fold function, True if only the input shapes are needed)
+_FOLD_FUNCS = {
+    "Add": (_fold_binary, False),
+    "Cast": (_fold_cast, False),
+    "Concat": (_fold_concat, False),
+    "Div": (_fold_binary, False),
+    "Gather": (_fold_gather, False),
+    "Identity": (lambda node, shapes, values: values[0], False),
+    "Mul": (_fold_binary, False),
+    "Reshape": (_fold_reshape, False),
+    "Shape": (_fold_shape, True),
+    "Size": (_fold_size, True),
+    "Slice": (_fold_slice, False),
+    "Squeeze": (_fold_squeeze, False),
+    "Sub": (_fold_binary, False),
+    "Unsqueeze": (_fold_unsqueeze, False),
+}
+
+
+class ConstFoldOptimizer(object):
+    """Replace nodes that can be evaluated at conversion time with initializers.
+
+    Once all input shapes are known (for example after binding the batch size) the
+    Shape -> Gather/Slice -> Unsqueeze -> Concat -> Reshape chains tensorflow emits
+    for dynamic shapes collapse into constants. The folded value takes the name of
+    the node output so consumers don't need to be rewired. Nodes producing a graph
+    output are kept.
+    """
+
+    def __init__(self, graph, output_names, debug=False):
+        self._g = graph
+        self._output_names = set(output_names)
+        self._debug = debug
+
+    def optimize(self):
+        ops = self._g.get_nodes()
+        folded = []
+        candidates = set()
+        for node in ops:
+            if node.domain or any(name in self._output_names for name in node.output):
+                continue
+            value = self._fold(node)
+            if value is None:
+                continue
+            # the inputs may now be dead initializers
+            candidates.update(name for name in node.input if self._g.is_initializer(name))
+            name = node.output[0]
+            tensor = numpy_helper.from_array(value, name)
+            self._g.add_initializer(tensor)
+            self._g.set_dtype(name, tensor.data_type)
+            candidates.add(name)
+            folded.append(node)
+
+        if folded:
+            folded = set(folded)
+            ops = [n for n in ops if n not in folded]
+            self._g.set_nodes(ops)
+            used = set(self._output_names)
+            for node in ops:
+                used.update(node.input)
+            for name in candidates - used:
+                self._g.remove_initializer(name)
+        log.debug("folded " + str(len(folded)) + " node(s)")
+        return len(folded)
+
+    def _fold(self, node):
+        fold = _FOLD_FUNCS.get(node.type)
+        if fold is None or len(node.output) != 1:
+            return None
+        func, shape_only = fold
+        inputs = [name for name in node.input if name]
+        if not inputs:
+            return None
+        if shape_only:
+            shapes = [get_input_shape(self._g, name) for name in inputs]
+            if any(s is None or not all(d >= 0 for d in s) for s in shapes):
+                return None
+            values = []
+        else:
+            if not all(self._g.is_initializer(name) for name in inputs):
+                return None
+            shapes = []
+            values = [numpy_helper.to_array(self._g.get_initializer(name)) for name in inputs]
+        try:
+            value = func(node, shapes, values)
+        except Exception as ex:  # pylint: disable=broad-except
+            log.debug("can't fold " + node.name + ": " + str(ex))
+            return None
+        if value is None:
+            return None
+        return np.asarray(value)
@@ -0,0 +1,334 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Layout Optimizer - pick one layout per tensor for the whole graph instead of cancelling transposes locally."""
+
+import logging
+
+import numpy as np
+from onnx import helper, numpy_helper
+
+from tf2onnx import utils
+from tf2onnx.graph import Node
+from tf2onnx.optimizer.transpose_optimizer import invert_perm
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.layout_optimizer")
+
+# pylint: disable=logging-not-lazy,missing-docstring,unused-argument
+
+# elementwise ops, they don't care about the layout
+_UNARY_OPS = [
+    "Abs", "Cast", "Ceil", "Clip", "Dropout", "Elu", "Exp", "Floor", "HardSigmoid", "Identity", "LeakyRelu",
+    "Log", "Neg", "Not", "Reciprocal", "Relu", "Selu", "Sigmoid", "Softplus", "Softsign", "Sqrt", "Tanh",
+]
+
+# elementwise ops with numpy style broadcast (opset >= 7)
+_BROADCAST_OPS = [
+    "Add", "And", "Div", "Equal", "Greater", "Less", "Max", "Mean", "Min", "Mul", "Or", "Pow", "Sub", "Sum", "Xor",
+]
+
+_REDUCE_OPS = [
+    "ReduceL1", "ReduceL2", "ReduceLogSum", "ReduceLogSumExp", "ReduceMax", "ReduceMean", "ReduceMin",
+    "ReduceProd", "ReduceSum", "ReduceSumSquare",
+]
+
+
+def _attr(node, name, default=None):
+    attr = node.get_attr(name)
+    if attr is None:
+        return default
+    return helper.get_attribute_value(attr)
+
+
+def nchw_perm(rank):
+    """Permutation taking a channels-last tensor of the given rank to channels-first."""
+    return [0, rank - 1] + list(range(1, rank - 1))
+
+
+class LayoutOptimizer(object):
+    """Decide for every tensor whether it is kept in the tensorflow layout (NHWC) or stored as NCHW.
+
+    conv_convert_inputs wraps each NHWC op in Transpose(NHWC->NCHW) -> op -> Transpose(NCHW->NHWC).
+    Instead of moving those transposes around one at a time this pass runs a dataflow analysis
+    over the whole graph:
+
+    1. the output of a Transpose(NCHW->NHWC) can be stored as NCHW for free, that is its input.
+    2. a layout insensitive op (elementwise, Concat, Split, Pad, Slice, Reduce*) whose data inputs
+       are all stored as NCHW produces NCHW outputs, after rewriting axes, pads and constants.
+    3. ops at the edge of the NCHW region are moved back to NHWC if that doesn't add transposes.
+
+    Afterwards Transposes are only left where a NHWC tensor is really needed: graph outputs and
+    ops that depend on the layout like Reshape.
+    """
+
+    def __init__(self, graph, output_names, debug=False):
+        self._g = graph
+        self._output_names = set(output_names)
+        self._debug = debug
+        self._consumers = None
+        # tensor name -> perm of the tensors stored as NCHW
+        self._nchw = {}
+        self._handlers = {}
+        self._initialize_handlers()
+
+    def _initialize_handlers(self):
+        self._handlers = {op: self._elementwise_handler for op in _UNARY_OPS + _BROADCAST_OPS}
+        self._handlers.update({op: self._reduce_handler for op in _REDUCE_OPS})
+        self._handlers.update({
+            "Concat": self._axis_handler,
+            "Pad": self._pad_handler,
+            "Slice": self._slice_handler,
+            "Split": self._axis_handler,
+        })
+
+    def optimize(self):
+        """Run the pass. Returns the number of transposes removed."""
+        self._g.topological_sort(self._g.get_nodes())
+        ops = self._g.get_nodes()
+        before = len([n for n in ops if n.type == "Transpose"])
+        self._consumers = self._g.get_consumer_map()
+        self._nchw = {}
+        for node in ops:
+            self._assign(node)
+        self._prune(ops)
+        if self._nchw:
+            self._rewrite(ops)
+        after = len([n for n in self._g.get_nodes() if n.type == "Transpose"])
+        if self._debug:
+            print("layout optimizer: {} NCHW tensor(s), transposes {} -> {}".format(len(self._nchw), before, after))
+        log.debug("removed " + str(before - after) + " transpose(s)")
+        return before - after
+
+    # analysis
+
+    def _is_seed(self, node):
+        """Transpose(NCHW->NHWC), its output stored as NCHW is its input."""
+        if node.type != "Transpose" or node.domain or node.input[0] in self._nchw:
+            return False
+        perm = _attr(node, "perm")
+        return perm is not None and len(perm) > 2 and list(perm) == invert_perm(nchw_perm(len(perm)))
+
+    def _assign(self, node):
+        if self._is_seed(node):
+            self._nchw[node.output[0]] = nchw_perm(len(_attr(node, "perm")))
+            return
+        perm = self._input_perm(node)
+        if perm is None or any(name in self._output_names for name in node.output):
+            return
+        if self._handlers[node.type](node, perm, False):
+            for name in node.output:
+                self._nchw[name] = perm
+
+    def _input_perm(self, node):
+        """Common perm of the data inputs if node can run on NCHW data, None if it can't."""
+        if node.type not in self._handlers or node.domain:
+            return None
+        perm = None
+        for name in node.input:
+            if not name or self._g.is_initializer(name):
+                continue
+            if name not in self._nchw or (perm is not None and self._nchw[name] != perm):
+                return None
+            perm = self._nchw[name]
+        return perm
+
+    def _is_nchw_node(self, node):
+        return bool(node.output) and node.output[0] in self._nchw
+
+    def _absorbs(self, node, name):
+        """True if a Transpose consuming name turns into a no-op when name is stored as NCHW."""
+        if node.type != "Transpose" or name not in self._nchw:
+            return False
+        perm = _attr(node, "perm")
+        return perm is not None and list(perm) == self._nchw[name]
+
+    def _needs_nhwc(self, name, skip=None):
+        """True if something needs name in the tensorflow layout."""
+        if name in self._output_names:
+            return True
+        for consumer in self._consumers.get(name, []):
+            if consumer is skip or consumer.type == "Transpose":
+                continue
+            if not self._is_nchw_node(consumer):
+                return True
+        return False
+
+    def _prune(self, ops):
+        """Move ops at the edge of the NCHW region back to NHWC as long as it doesn't cost transposes."""
+        changed = True
+        while changed:
+            changed = False
+            for node in reversed(ops):
+                if not self._is_nchw_node(node):
+                    continue
+                outputs = node.output
+                if any(self._is_nchw_node(c) for name in outputs for c in self._consumers.get(name, [])):
+                    continue
+                keep_cost = len([name for name in outputs if self._needs_nhwc(name)])
+                if self._is_seed(node):
+                    inputs = []
+                else:
+                    inputs = set(name for name in node.input if name in self._nchw)
+                revert_cost = len([name for name in inputs if not self._needs_nhwc(name, skip=node)])
+                revert_cost += len([c for name in outputs for c in self._consumers.get(name, [])
+                                    if self._absorbs(c, name)])
+                if revert_cost <= keep_cost:
+                    for name in outputs:
+                        del self._nchw[name]
+                    changed = True
+
+    # rewrite
+
+    def _rewrite(self, ops):
+        # tensor name -> name of the NCHW data
+        physical = {}
+        # outputs of removed transposes -> tensor holding the same data
+        renamed = {}
+        seeds = {}
+        to_remove = set()
+        to_add = []
+        for node in ops:
+            if self._is_nchw_node(node):
+                if self._is_seed(node):
+                    physical[node.output[0]] = node.input[0]
+                    seeds[node.output[0]] = node
+                    continue
+                perm = self._nchw[node.output[0]]
+                self._handlers[node.type](node, perm, True)
+                for i, name in enumerate(node.input):
+                    if name in physical:
+                        node.input[i] = physical[name]
+                for name in node.output:
+                    physical[name] = name
+                    self._set_nchw_shape(name, perm)
+                continue
+            for i, name in enumerate(node.input):
+                if name in renamed:
+                    # already holds the data in the layout node expects
+                    node.input[i] = renamed[name]
+                    continue
+                if name not in physical:
+                    continue
+                if node.type == "Transpose":
+                    if self._compose(node, name, physical[name]):
+                        renamed[node.output[0]] = physical[name]
+                        to_remove.add(node)
+                elif name not in seeds:
+                    node.input[i] = self._nhwc_name(name, to_add)
+
+        for name, seed in seeds.items():
+            if not self._needs_seed(name):
+                to_remove.add(seed)
+        ops = [n for n in ops if n not in to_remove] + to_add
+        self._g.set_nodes(ops)
+        self._g.topological_sort(ops)
+
+    def _needs_seed(self, name):
+        if name in self._output_names:
+            return True
+        for consumer in self._consumers.get(name, []):
+            if name in consumer.input and not self._is_nchw_node(consumer):
+                return True
+        return False
+
+    def _compose(self, node, name, source):
+        """Transpose consuming a NCHW tensor, transpose the NCHW data instead. True if it became a no-op."""
+        inv = invert_perm(self._nchw[name])
+        perm = [inv[p] for p in _attr(node, "perm")]
+        node.input[0] = source
+        if perm == list(range(len(perm))) and node.output[0] not in self._output_names:
+            return True
+        node.set_attr("perm", perm)
+        return False
+
+    def _nhwc_name(self, name, to_add):
+        """Name of a Transpose of name back to NHWC, created on first use."""
+        for node in to_add:
+            if node.input[0] == name:
+                return node.output[0]
+        op_name = utils.make_name("Transpose")
+        perm = invert_perm(self._nchw[name])
+        transpose = Node(helper.make_node("Transpose", [name], [utils.port_name(op_name)], name=op_name, perm=perm),
+                         self._g)
+        # name holds NCHW data by now, its shape was permuted by _set_nchw_shape
+        shape = self._g.get_shape(name)
+        if shape is not None and len(shape) == len(perm):
+            self._g.set_shape(transpose.output[0], [shape[i] for i in perm])
+        dtype = self._g.get_dtype(name)
+        if dtype is not None:
+            self._g.set_dtype(transpose.output[0], dtype)
+        to_add.append(transpose)
+        return transpose.output[0]
+
+    def _set_nchw_shape(self, name, perm):
+        shape = self._g.get_shape(name)
+        if shape is not None and len(shape) == len(perm):
+            self._g.set_shape(name, [shape[p] for p in perm])
+
+    def _permute_const(self, node, index, perm, apply):
+        """Bring a constant input into NCHW layout. Returns False if that isn't possible."""
+        name = node.input[index]
+        val = numpy_helper.to_array(self._g.get_initializer(name))
+        if val.size == 1 and val.ndim <= 1:
+            return True
+        if val.ndim > len(perm) or self._g.opset < 7:
+            return False
+        if apply:
+            val = np.transpose(val.reshape([1] * (len(perm) - val.ndim) + list(val.shape)), perm)
+            consumers = self._consumers.get(name, [])
+            if len(consumers) == 1 and name not in self._output_names:
+                self._g.update_initializer(name, val)
+            else:
+                new_name = utils.make_name(node.name)
+                self._g.make_const(new_name, val)
+                node.input[index] = new_name
+                # the last consumer left can update the initializer in place
+                if node in consumers and name not in node.input:
+                    consumers.remove(node)
+        return True
+
+    # handlers: check if node can work on NCHW data, rewrite it when apply is set
+
+    def _elementwise_handler(self, node, perm, apply):
+        if node.type in _BROADCAST_OPS and (node.get_attr("axis") is not None or node.get_attr("broadcast")):
+            return False
+        for i, name in enumerate(node.input):
+            if name and self._g.is_initializer(name) and not self._permute_const(node, i, perm, apply):
+                return False
+        return True
+
+    def _axis_handler(self, node, perm, apply):
+        if node.type == "Concat" and any(self._g.is_initializer(name) for name in node.input):
+            return False
+        if apply:
+            axis = _attr(node, "axis", 0) % len(perm)
+            node.set_attr("axis", invert_perm(perm)[axis])
+        return True
+
+    def _reduce_handler(self, node, perm, apply):
+        if _attr(node, "keepdims", 1) != 1:
+            return False
+        axes = _attr(node, "axes")
+        if apply and axes is not None:
+            inv = invert_perm(perm)
+            node.set_attr("axes", sorted(inv[a % len(perm)] for a in axes))
+        return True
+
+    def _pad_handler(self, node, perm, apply):
+        pads = _attr(node, "pads")
+        if pads is None or len(pads) != 2 * len(perm):
+            return False
+        if apply:
+            rank = len(perm)
+            node.set_attr("pads", [pads[p] for p in perm] + [pads[p + rank] for p in perm])
+        return True
+
+    def _slice_handler(self, node, perm, apply):
+        starts = _attr(node, "starts")
+        if starts is None or len(node.input) > 1:
+            return False
+        if apply:
+            inv = invert_perm(perm)
+            axes = _attr(node, "axes", list(range(len(starts))))
+            node.set_attr("axes", [inv[a % len(perm)] for a in axes])
+        return True
@@ -0,0 +1,124 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Pad Optimizer - fold zero padding into the pads of Conv, MaxPool and AveragePool."""
+
+import logging
+
+from onnx import helper
+
+from tf2onnx.shape_inference import infer_node_shape
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.pad_optimizer")
+
+# pylint: disable=logging-not-lazy,missing-docstring
+
+_POOL_OPS = ["Conv", "MaxPool", "AveragePool"]
+
+# MaxPool pads with -inf. Zero padding gives the same result only if the input can't be negative.
+_NON_NEGATIVE_OPS = ["Relu", "Sigmoid", "Softplus", "Abs"]
+
+
+def _attr(node, name, default=None):
+    attr = node.get_attr(name)
+    if attr is None:
+        return default
+    return helper.get_attribute_value(attr)
+
+
+class PadOptimizer(object):
+    """Fold a zero-valued, spatial-only Pad into the pads attribute of the following op.
+
+    The pad is either directly in front of the op (NCHW) or in front of the
+    Transpose conv_convert_inputs inserts for NHWC ops, in which case the pad
+    axes are mapped through the permutation.
+    """
+
+    def __init__(self, graph, output_names, debug=False):
+        self._g = graph
+        self._output_names = set(output_names)
+        self._debug = debug
+        self._consumers = None
+
+    def optimize(self):
+        ops = self._g.get_nodes()
+        self._consumers = self._g.get_consumer_map()
+        removed = set()
+        for node in ops:
+            if node.type == "Pad" and not node.domain and self._fold(node):
+                removed.add(node)
+        if removed:
+            self._g.set_nodes([n for n in ops if n not in removed])
+        log.debug("folded " + str(len(removed)) + " pad(s)")
+        return len(removed)
+
+    def _single_consumer(self, node):
+        if node.output[0] in self._output_names:
+            return None
+        consumers = self._consumers.get(node.output[0], [])
+        if len(consumers) != 1:
+            return None
+        return consumers[0]
+
+    def _fold(self, pad):
+        mode = _attr(pad, "mode", b"constant")
+        if mode != b"constant" or _attr(pad, "value", 0.) != 0.:
+            return False
+        pads = _attr(pad, "pads")
+        if pads is None or any(p < 0 for p in pads):
+            return False
+        rank = len(pads) // 2
+
+        consumer = self._single_consumer(pad)
+        if consumer is None:
+            return False
+        transpose = None
+        perm = list(range(rank))
+        if consumer.type == "Transpose":
+            transpose = consumer
+            perm = _attr(transpose, "perm")
+            consumer = self._single_consumer(transpose)
+            if consumer is None or perm is None or len(perm) != rank:
+                return False
+        if consumer.type not in _POOL_OPS or consumer.domain or consumer.input[0] != (transpose or pad).output[0]:
+            return False
+
+        # pad of each axis in the layout of the consumer
+        begin = [pads[p] for p in perm]
+        end = [pads[p + rank] for p in perm]
+        if begin[0] or begin[1] or end[0] or end[1]:
+            return False
+        if not self._can_fold_into(consumer, pad, rank):
+            return False
+
+        spatial = rank - 2
+        old_pads = _attr(consumer, "pads", [0] * spatial * 2)
+        new_pads = [old_pads[i] + begin[i + 2] for i in range(spatial)] + \
+                   [old_pads[i + spatial] + end[i + 2] for i in range(spatial)]
+        consumer.set_attr("pads", new_pads)
+        if "auto_pad" in consumer.attr:
+            del consumer.attr["auto_pad"]
+        if consumer.type == "AveragePool":
+            consumer.set_attr("count_include_pad", 1)
+
+        # bypass the pad
+        self._g.replace_all_inputs_indexed(self._consumers, pad.output[0], pad.input[0])
+        self._consumers[pad.input[0]].remove(pad)
+        if transpose is not None:
+            infer_node_shape(self._g, transpose, override=True)
+        return True
+
+    def _can_fold_into(self, node, pad, rank):
+        auto_pad = _attr(node, "auto_pad", b"NOTSET")
+        if auto_pad not in [b"NOTSET", b"VALID"]:
+            return False
+        if node.type == "MaxPool":
+            producer = self._g.get_node_by_name(pad.input[0])
+            return producer is not None and producer.type in _NON_NEGATIVE_OPS
+        if node.type == "AveragePool":
+            # zero padding counts in the average
+            if self._g.opset < 7:
+                return False
+            old_pads = _attr(node, "pads", [0] * (rank - 2) * 2)
+            return _attr(node, "count_include_pad", 0) == 1 or not any(old_pads)
+        return True
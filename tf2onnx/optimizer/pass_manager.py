@@ -0,0 +1,223 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Pass Manager - run the graph optimizers in dependency order until nothing changes."""
+
+import collections
+import logging
+import time
+
+import numpy as np
+
+from tf2onnx import utils
+from tf2onnx.optimizer.affine_optimizer import AffineOptimizer
+from tf2onnx.optimizer.cleanup_optimizer import CleanupOptimizer
+from tf2onnx.optimizer.const_fold_optimizer import ConstFoldOptimizer
+from tf2onnx.optimizer.layout_optimizer import LayoutOptimizer
+from tf2onnx.optimizer.pad_optimizer import PadOptimizer
+from tf2onnx.optimizer.reshape_optimizer import ReshapeOptimizer
+from tf2onnx.optimizer.transpose_optimizer import TransposeOptimizer
+from tf2onnx.shape_inference import infer_shapes
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.pass_manager")
+
+# pylint: disable=logging-not-lazy,missing-docstring
+
+DEFAULT_MAX_ITERATIONS = 4
+
+
+def initializer_bytes(g):
+    """Size of all initializers of the graph in bytes."""
+    total = 0
+    for tensor in g.initializers.values():
+        dtype = utils.ONNX_TO_NUMPY_DTYPE.get(tensor.data_type)
+        if dtype is None:
+            total += len(tensor.raw_data)
+        else:
+            total += int(np.prod(tensor.dims, dtype=np.int64)) * np.dtype(dtype).itemsize
+    return total
+
+
+class OptimizerPass(object):
+    """A registered pass.
+
+    func is called as func(graph, output_names, debug) and returns the number of changes
+    it made or None, in which case the node and initializer deltas tell if it did anything.
+    """
+
+    def __init__(self, name, func, depends=None, enabled=True, fixpoint=True, update_shapes=False):
+        self.name = name
+        self.func = func
+        # passes that have to run before this one if they are enabled
+        self.depends = list(depends or [])
+        self.enabled = enabled
+        # False for passes that only run in the first iteration
+        self.fixpoint = fixpoint
+        # run shape inference after the pass if it changed the graph
+        self.update_shapes = update_shapes
+
+
+class PassManager(object):
+    """Run registered passes in dependency order until a fixpoint or the iteration limit.
+
+    Every pass run is recorded with its wall time, node delta and initializer byte delta,
+    see stats() and summary().
+    """
+
+    def __init__(self, max_iterations=DEFAULT_MAX_ITERATIONS, debug=False):
+        self.max_iterations = max_iterations
+        self._debug = debug
+        self._passes = collections.OrderedDict()
+        self._stats = []
+
+    def register(self, name, func, depends=None, enabled=True, fixpoint=True, update_shapes=False):
+        if name in self._passes:
+            raise ValueError("pass " + name + " is already registered")
+        self._passes[name] = OptimizerPass(name, func, depends, enabled, fixpoint, update_shapes)
+
+    def passes(self):
+        return list(self._passes)
+
+    def enable(self, name, enabled=True):
+        if name not in self._passes:
+            raise ValueError("unknown pass " + name + ", known passes: " + ", ".join(self._passes))
+        self._passes[name].enabled = enabled
+
+    def disable(self, name):
+        self.enable(name, False)
+
+    def is_enabled(self, name):
+        return name in self._passes and self._passes[name].enabled
+
+    def schedule(self):
+        """Enabled passes in dependency order, registration order between independent passes."""
+        order = []
+        state = {}
+
+        def _visit(opt):
+            if state.get(opt.name) == "done":
+                return
+            if state.get(opt.name) == "visiting":
+                raise ValueError("passes have a dependency cycle at " + opt.name)
+            state[opt.name] = "visiting"
+            for dep in opt.depends:
+                if dep not in self._passes:
+                    raise ValueError("pass " + opt.name + " depends on unknown pass " + dep)
+                _visit(self._passes[dep])
+            state[opt.name] = "done"
+            if opt.enabled:
+                order.append(opt)
+
+        for opt in self._passes.values():
+            _visit(opt)
+        return order
+
+    def run(self, g, output_names):
+        """Run the enabled passes on the graph. Returns the number of iterations."""
+        schedule = self.schedule()
+        self._stats = []
+        iteration = 0
+        changed = True
+        while changed and iteration < self.max_iterations:
+            changed = False
+            for opt in schedule:
+                if iteration > 0 and not opt.fixpoint:
+                    continue
+                if self._run_pass(opt, g, output_names, iteration):
+                    changed = True
+            iteration += 1
+        if changed:
+            log.debug("no fixpoint after " + str(iteration) + " iteration(s)")
+        if self._debug:
+            print(self.summary())
+        return iteration
+
+    def _run_pass(self, opt, g, output_names, iteration):
+        nodes_before = len(g.get_nodes())
+        bytes_before = initializer_bytes(g)
+        start = time.time()
+        result = opt.func(g, output_names, self._debug)
+        nodes_after = len(g.get_nodes())
+        bytes_after = initializer_bytes(g)
+        if result is None:
+            changed = nodes_after != nodes_before or bytes_after != bytes_before
+        else:
+            changed = bool(result)
+        if changed and opt.update_shapes:
+            infer_shapes(g, override=True)
+        self._stats.append({
+            "pass": opt.name,
+            "iteration": iteration,
+            "time": time.time() - start,
+            "changed": changed,
+            "node_delta": nodes_after - nodes_before,
+            "initializer_bytes_delta": bytes_after - bytes_before,
+        })
+        return changed
+
+    def stats(self):
+        """One record per pass run of the last run()."""
+        return list(self._stats)
+
+    def summary(self):
+        """Table of the time, node delta and initializer byte delta per pass, summed over the iterations."""
+        totals = collections.OrderedDict()
+        for record in self._stats:
+            total = totals.setdefault(record["pass"], {"runs": 0, "time": 0., "node_delta": 0,
+                                                       "initializer_bytes_delta": 0})
+            total["runs"] += 1
+            total["time"] += record["time"]
+            total["node_delta"] += record["node_delta"]
+            total["initializer_bytes_delta"] += record["initializer_bytes_delta"]
+        lines = ["{:<12} {:>4} {:>10} {:>8} {:>14}".format("pass", "runs", "time(ms)", "nodes", "init bytes")]
+        for name, total in totals.items():
+            lines.append("{:<12} {:>4} {:>10.1f} {:>+8} {:>+14}".format(
+                name, total["runs"], total["time"] * 1000, total["node_delta"], total["initializer_bytes_delta"]))
+        return "\n".join(lines)
+
+
+def _const_fold_pass(g, output_names, debug):
+    return ConstFoldOptimizer(g, output_names, debug).optimize()
+
+
+def _cleanup_pass(g, output_names, debug):
+    return CleanupOptimizer(g, output_names, debug).optimize()
+
+
+def _reshape_pass(g, output_names, debug):
+    report = ReshapeOptimizer(g, output_names, debug).optimize()
+    return report["collapsed"] + report["removed"]
+
+
+def _pad_pass(g, output_names, debug):
+    return PadOptimizer(g, output_names, debug).optimize()
+
+
+def _affine_pass(g, output_names, debug):
+    return AffineOptimizer(g, output_names, debug).optimize()
+
+
+def _transpose_pass(g, output_names, debug):
+    report = TransposeOptimizer(g, debug, output_names).optimize()
+    return sum(report["rewrites"].values())
+
+
+def _layout_pass(g, output_names, debug):
+    return LayoutOptimizer(g, output_names, debug).optimize()
+
+
+def default_pass_manager(max_iterations=DEFAULT_MAX_ITERATIONS, debug=False):
+    """Pass manager with the optimizers convert.py runs.
+
+    const_fold and layout are disabled by default, layout replaces transpose when enabled.
+    """
+    manager = PassManager(max_iterations, debug)
+    manager.register("const_fold", _const_fold_pass, enabled=False, update_shapes=True)
+    manager.register("cleanup", _cleanup_pass, depends=["const_fold"], update_shapes=True)
+    manager.register("reshape", _reshape_pass, depends=["cleanup"])
+    manager.register("pad", _pad_pass, depends=["reshape"])
+    manager.register("affine", _affine_pass, depends=["pad"])
+    manager.register("transpose", _transpose_pass, depends=["affine"], fixpoint=False, update_shapes=True)
+    manager.register("layout", _layout_pass, depends=["affine"], enabled=False, fixpoint=False,
+                     update_shapes=True)
+    return manager
@@ -0,0 +1,147 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Reshape Optimizer - collapse chains of Reshape, Squeeze, Unsqueeze and Flatten."""
+
+import logging
+
+import numpy as np
+from onnx import onnx_pb
+
+from tf2onnx import utils
+from tf2onnx.shape_inference import get_input_shape
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.reshape_optimizer")
+
+# pylint: disable=logging-not-lazy,missing-docstring
+
+# all of these keep the order of the elements and only change the shape
+_RESHAPE_OPS = ["Flatten", "Reshape", "Squeeze", "Unsqueeze"]
+
+# Reshape-1 (opset < 5) only takes float tensors
+_RESHAPE1_DTYPES = [onnx_pb.TensorProto.FLOAT, onnx_pb.TensorProto.FLOAT16, onnx_pb.TensorProto.DOUBLE]
+
+
+class ReshapeOptimizer(object):
+    """Collapse chains of shape-only ops into a single Reshape or remove them.
+
+    A chain like Unsqueeze -> Squeeze or Reshape -> Reshape only moves the shape around,
+    so it can read straight from the input of the chain and reshape once to the final
+    shape. If the final shape is the shape of the chain input the last op is removed.
+    This needs the output shape to be known (at most one unknown dimension).
+    """
+
+    def __init__(self, graph, output_names, debug=False):
+        self._g = graph
+        self._output_names = set(output_names)
+        self._debug = debug
+        self._consumers = None
+        self._removed = set()
+
+    def optimize(self):
+        """Run the pass. Returns a report with the node counts before and after."""
+        ops = self._g.get_nodes()
+        report = {"nodes_before": len(ops), "collapsed": 0, "removed": 0}
+        self._consumers = self._g.get_consumer_map()
+        self._removed = set()
+        for node in ops:
+            if node in self._removed or node.type not in _RESHAPE_OPS or node.domain:
+                continue
+            if self._only_feeds_reshapes(node):
+                # handled from the end of the chain
+                continue
+            if not self._has_output_shape(node):
+                continue
+            old_input = node.input[0]
+            src = self._find_chain_input(node)
+            out_shape = get_input_shape(self._g, node.output[0])
+            if out_shape == get_input_shape(self._g, src) and not self._is_graph_output(node):
+                self._g.replace_all_inputs_indexed(self._consumers, node.output[0], src)
+                self._drop(node)
+                report["removed"] += 1
+            elif src != old_input and self._can_reshape(src):
+                self._make_reshape(node, src, out_shape)
+                report["collapsed"] += 1
+            else:
+                continue
+            self._drop_dead_chain(old_input)
+
+        if self._removed:
+            ops = [n for n in ops if n not in self._removed]
+            self._g.set_nodes(ops)
+        report["nodes_after"] = len(ops)
+        if self._debug:
+            print("reshape optimizer: nodes {nodes_before} -> {nodes_after}, chains collapsed: {collapsed}, "
+                  "removed: {removed}".format(**report))
+        return report
+
+    def _is_graph_output(self, node):
+        return any(name in self._output_names for name in node.output)
+
+    def _has_output_shape(self, node):
+        shape = get_input_shape(self._g, node.output[0])
+        return shape is not None and shape.count(-1) <= 1
+
+    def _only_feeds_reshapes(self, node):
+        """True if all consumers are shape-only ops that can collapse the chain including node."""
+        consumers = self._consumers.get(node.output[0])
+        return (consumers and not self._is_graph_output(node)
+                and all(n.type in _RESHAPE_OPS and not n.domain and self._has_output_shape(n) for n in consumers))
+
+    def _producer(self, name):
+        node = self._g.get_node_by_name(name)
+        if node is None or node in self._removed or node.output[0] != name:
+            return None
+        return node
+
+    def _find_chain_input(self, node):
+        src = node.input[0]
+        producer = self._producer(src)
+        while producer is not None and producer.type in _RESHAPE_OPS and not producer.domain:
+            src = producer.input[0]
+            producer = self._producer(src)
+        return src
+
+    def _can_reshape(self, src):
+        return self._g.opset >= 5 or self._g.get_dtype(src) in _RESHAPE1_DTYPES
+
+    def _make_reshape(self, node, src, shape):
+        """Turn node into a Reshape of src to shape."""
+        for name in node.input:
+            self._release_input(node, name)
+        node.type = "Reshape"
+        for attr in ["axes", "axis", "shape"]:
+            if attr in node.attr:
+                del node.attr[attr]
+        if self._g.opset < 5:
+            node.set_attr("shape", shape)
+            del node.input[:]
+            node.input.append(src)
+        else:
+            shape_name = utils.make_name(node.name)
+            self._g.make_const(shape_name, np.array(shape, dtype=np.int64))
+            del node.input[:]
+            node.input.extend([src, shape_name])
+            self._consumers[shape_name].append(node)
+        self._consumers[src].append(node)
+
+    def _release_input(self, node, name):
+        consumers = self._consumers.get(name)
+        if consumers and node in consumers:
+            consumers.remove(node)
+        if not consumers and self._g.is_initializer(name) and name not in self._output_names:
+            self._g.remove_initializer(name)
+
+    def _drop(self, node):
+        self._removed.add(node)
+        for name in node.input:
+            self._release_input(node, name)
+
+    def _drop_dead_chain(self, name):
+        """Remove the producers of name that are left without consumers."""
+        producer = self._producer(name)
+        while (producer is not None and producer.type in _RESHAPE_OPS and not self._consumers.get(name)
+               and not self._is_graph_output(producer)):
+            self._drop(producer)
+            name = producer.input[0]
+            producer = self._producer(name)
@@ -2,7 +2,9 @@
 # Licensed under the MIT license.
 """Transpose Optimizer."""
 
+import collections
 import logging
+import time
 
 import numpy as np
 
@@ -18,6 +20,105 @@ log = logging.getLogger("tf2onnx.optimizer.transpose_optimizer")
 # FIXME:
 # pylint: disable=unused-variable
 
+# ops a NHWC transpose can be pushed through:
+# "unary" ops work elementwise on their only input,
+# "broadcast" ops take a second input and broadcast numpy style, a constant one gets transposed with the data,
+# "reduce" ops get their axes remapped, without keepdims the transpose behind them loses the reduced axes
+PUSH_THROUGH_OPS = {
+    "Abs": "unary",
+    "Cast": "unary",
+    "Ceil": "unary",
+    "Clip": "unary",
+    "Elu": "unary",
+    "Exp": "unary",
+    "Floor": "unary",
+    "HardSigmoid": "unary",
+    "LeakyRelu": "unary",
+    "Log": "unary",
+    "Neg": "unary",
+    "Not": "unary",
+    "Reciprocal": "unary",
+    "Relu": "unary",
+    "Selu": "unary",
+    "Sigmoid": "unary",
+    "Softplus": "unary",
+    "Softsign": "unary",
+    "Sqrt": "unary",
+    "Tanh": "unary",
+    "Add": "broadcast",
+    "And": "broadcast",
+    "Div": "broadcast",
+    "Equal": "broadcast",
+    "Greater": "broadcast",
+    "Less": "broadcast",
+    "Max": "broadcast",
+    "Min": "broadcast",
+    "Mul": "broadcast",
+    "Or": "broadcast",
+    "Pow": "broadcast",
+    "PRelu": "broadcast",
+    "Sub": "broadcast",
+    "Xor": "broadcast",
+    "ReduceL1": "reduce",
+    "ReduceL2": "reduce",
+    "ReduceLogSum": "reduce",
+    "ReduceLogSumExp": "reduce",
+    "ReduceMax": "reduce",
+    "ReduceMean": "reduce",
+    "ReduceMin": "reduce",
+    "ReduceProd": "reduce",
+    "ReduceSum": "reduce",
+    "ReduceSumSquare": "reduce",
+}
+
+
+def invert_perm(perm):
+    """Permutation undoing perm."""
+    inv = [0] * len(perm)
+    for i, p in enumerate(perm):
+        inv[p] = i
+    return inv
+
+
+def compose_perms(first, second):
+    """Permutation of Transpose(perm=second) applied to the output of Transpose(perm=first)."""
+    return [first[p] for p in second]
+
+
+def squeeze_perm(perm, axes):
+    """Perm for the output of an op dropping axes of Transpose(perm), when the op runs on the transpose input.
+
+    The op then drops the axes perm[a] instead.
+    """
+    kept = [p for p in range(len(perm)) if p not in [perm[a] for a in axes]]
+    return [kept.index(perm[i]) for i in range(len(perm)) if i not in axes]
+
+
+def unsqueeze_perm(perm, axes):
+    """Perm for the output of an Unsqueeze(axes) of Transpose(perm), when it runs on the transpose input."""
+    rank = len(perm) + len(axes)
+    others = [i for i in range(rank) if i not in axes]
+    new_perm = list(range(rank))
+    for i, pos in enumerate(others):
+        new_perm[pos] = others[perm[i]]
+    return new_perm
+
+
+def format_report(report):
+    """Text summary of a TransposeOptimizer report."""
+    lines = ["transposes: {} -> {}, transpose bytes: {} -> {} (predicted {}), {} iteration(s)".format(
+        report["transposes_before"], report["transposes_after"], report["transpose_bytes_before"],
+        report["transpose_bytes_after"], report["transpose_bytes_predicted"], report["iterations"])]
+    lines.append("{:<20} {:>8} {:>10}".format("rewrite", "count", "time(ms)"))
+    for name in sorted(report["time"]):
+        lines.append("{:<20} {:>8} {:>10.2f}".format(name, report["rewrites"].get(name, 0),
+                                                     report["time"][name] * 1000))
+    if report["blocked"]:
+        lines.append("blocked by: " + ", ".join("{} x{}".format(op, cnt)
+                                                for op, cnt in sorted(report["blocked"].items())))
+    return "\n".join(lines)
+
+
 def is_nhwc_transpose(transpose_node):
     perm_attr = transpose_node.get_attr('perm')
     return transpose_node.type == "Transpose" and perm_attr and perm_attr.ints == [0, 2, 3, 1]
@@ -34,13 +135,29 @@ def is_useless_transpose(transpose_node):
 
 
 class TransposeOptimizer(object):
-    """Transpose Optimizer."""
+    """Transpose Optimizer.
+
+    Transposes are processed from a worklist. After a rewrite only the transposes next to the
+    nodes it touched are queued again, and inputs are rewired through a consumer map, so the
+    time grows with the number of rewrites instead of rescanning the graph after each one.
 
-    def __init__(self, graph, debug=False):
+    optimize() returns a report with the rewrites and the time per handler, the ops that
+    stopped a transpose, the transposes and transposed bytes before and after, and with
+    trace set a record of every rewrite that was tried.
+    """
+
+    def __init__(self, graph, debug=False, output_names=None, trace=False):
         self._g = graph
         self._debug = debug
+        self._trace = trace
+        self._output_names = set(output_names or [])
         self._handler_map = {}
-        self._force_stop = {}
+        self._consumers = None
+        self._nodes = []
+        self._removed = set()
+        self._touched = []
+        # bytes moved by transposes as predicted by the cost model while rewriting
+        self._predicted_bytes = 0
 
         # make sure all proto of nodes or attribtues are update to date
         self._g.update_proto()
@@ -83,72 +200,198 @@ class TransposeOptimizer(object):
         self._g.topological_sort(self._g.get_nodes())
 
     def optimize(self):
-        self._g.dump_node_statistics("before optimization")
-        no_action = False
-        iteration_cnt = 0
-        while not no_action:
-            no_action = True
-            nodes = self.nodes
-            self._force_stop = {}
-            for n in nodes:
-                if is_nhwc_transpose(n):
-                    if self._handle_nhwc_tranpose(n):
-                        no_action = False
-                        iteration_cnt += 1
-                        # need break, because handler may change nodes set, making the n stale object
-                        # referencing already deleted elements
-                        break
-
-                if is_useless_transpose(n):
-                    no_action = False
-                    iteration_cnt += 1
-                    self._remove_useless_tranpose(n)
-                    break
-            # for debugging purpose
-            if "stop" in self._force_stop and self._force_stop["stop"] == 1:
-                break
-
-        log.debug("finish after " + str(iteration_cnt) + " iteration(s)")
+        if self._debug:
+            self._g.dump_node_statistics("before optimization")
+        self._nodes = list(self.nodes)
+        self._consumers = self._g.get_consumer_map()
+        self._removed = set()
+        bytes_before, unknown_before = self._transposed_bytes()
+        self._predicted_bytes = bytes_before
+        worklist = collections.deque(n for n in self._nodes if n.type == "Transpose")
+        report = {
+            "iterations": 0,
+            "rewrites": collections.Counter(),
+            "time": collections.Counter(),
+            "blocked": collections.Counter(),
+            "transposes_before": len(worklist),
+        }
+        trace = []
+        queued = set(worklist)
+        while worklist:
+            n = worklist.popleft()
+            queued.discard(n)
+            if n in self._removed:
+                continue
+            report["iterations"] += 1
+            self._touched = []
+            start = time.time()
+            name, consumer, changed = self._rewrite(n)
+            if name is not None:
+                report["time"][name] += time.time() - start
+            if changed:
+                report["rewrites"][name] += 1
+            elif consumer is not None:
+                report["blocked"][consumer.type] += 1
+            if self._trace and name is not None:
+                trace.append({"rewrite": name, "transpose": n.name,
+                              "node": consumer.name if consumer is not None else None, "changed": changed})
+            for t in self._affected_transposes():
+                if t not in queued:
+                    worklist.append(t)
+                    queued.add(t)
+
+        log.debug("finish after " + str(report["iterations"]) + " iteration(s)")
+        bytes_after, unknown_after = self._transposed_bytes()
+        self._g.set_nodes([n for n in self._nodes if n not in self._removed])
         self.post_optimize_action()
-        self._g.dump_node_statistics("after optimization")
+        report.update({
+            "transposes_after": len([n for n in self.nodes if n.type == "Transpose"]),
+            "transpose_bytes_before": bytes_before,
+            "transpose_bytes_predicted": self._predicted_bytes,
+            "transpose_bytes_after": bytes_after,
+            "unknown_size_before": unknown_before,
+            "unknown_size_after": unknown_after,
+        })
+        for key in ["rewrites", "time", "blocked"]:
+            report[key] = dict(report[key])
+        if self._trace:
+            report["trace"] = trace
+        if self._debug:
+            self._g.dump_node_statistics("after optimization")
+            print(format_report(report))
+        return report
+
+    def _rewrite(self, trans):
+        """Try to get rid of trans. Returns the name of the rewrite tried, the node it was pushed into and
+        if the graph changed."""
+        if self._fold_const_transpose(trans):
+            return "fold_const", None, True
+        if self._merge_transposes(trans):
+            return "merge", None, True
+        if is_nhwc_transpose(trans):
+            out_nodes = self._find_output_consumers(trans.output[0])
+            if len(out_nodes) != 1:
+                return "branches", None, self._handle_nhwc_tranpose(trans)
+            handler = self._handler_map.get(out_nodes[0].type)
+            name = handler.__name__.strip("_")[:-len("_handler")] if handler else None
+            return name, out_nodes[0], self._handle_nhwc_tranpose(trans)
+        if is_useless_transpose(trans):
+            return "useless", None, self._remove_useless_tranpose(trans)
+        return None, None, False
 
     def _initialize_handlers(self):
-        self._handler_map = {
-            "Add": self._add_handler,
+        kinds = {
+            "unary": self._unary_handler,
+            "broadcast": self._broadcast_handler,
+            "reduce": self._reduce_handler,
+        }
+        self._handler_map = {op: kinds[kind] for op, kind in PUSH_THROUGH_OPS.items()}
+        self._handler_map.update({
             "Concat": self._concat_handler,
+            "Gather": self._gather_handler,
             "Identity": self._identity_handler,
-            "Max": self._maxmin_handler,
-            "Min": self._maxmin_handler,
-            "Mul": self._mul_handler,
             "Pad": self._pad_handler,
-            "ReduceMean": self._reducemean_handler,
-            "Relu": self._relu_handler,
             "Slice": self._slice_handler,
-            "Split": self._split_handler,
-            "Tanh": self._tanh_handler,
+            "Split": self._multi_output_axis_handler,
+            "Squeeze": self._squeeze_handler,
+            "TopK": self._multi_output_axis_handler,
             "Transpose": self._transpose_handler,
-        }
+            "Unsqueeze": self._unsqueeze_handler,
+        })
+
+    # graph edits, they keep the consumer map current and remember the nodes they touch
+
+    def _affected_transposes(self):
+        """Transposes among the touched nodes and their direct neighbors."""
+        result = []
+        seen = set()
+        for node in self._touched:
+            if node is None or node in self._removed:
+                continue
+            neighbors = [node] + [self._g.get_node_by_name(name) for name in node.input]
+            for name in node.output:
+                neighbors.extend(self._consumers.get(name, []))
+            for n in neighbors:
+                if n is not None and n.type == "Transpose" and n not in self._removed and n not in seen:
+                    seen.add(n)
+                    result.append(n)
+        return result
+
+    def _find_output_consumers(self, output_name):
+        return [n for n in self._consumers.get(output_name, []) if n not in self._removed]
+
+    def _is_graph_output(self, node):
+        return any(name in self._output_names for name in node.output)
+
+    def _replace_all_inputs(self, old_input, new_input):
+        nodes = self._g.replace_all_inputs_indexed(self._consumers, old_input, new_input)
+        self._touched.extend(nodes)
+
+    def _replace_input(self, node, old_input, new_input):
+        if not self._g.replace_input(node, old_input, new_input):
+            return
+        consumers = self._consumers.get(old_input)
+        if consumers and node in consumers:
+            consumers.remove(node)
+        if node not in self._consumers[new_input]:
+            self._consumers[new_input].append(node)
+        self._touched.append(node)
+
+    def _set_input(self, node, index, new_input):
+        old_input = node.input[index]
+        if node.type == "Transpose" and index == 0:
+            # the transpose moves to a different tensor
+            self._track_transpose(old_input, -1)
+            self._track_transpose(new_input, 1)
+        node.input[index] = new_input
+        if old_input not in node.input:
+            consumers = self._consumers.get(old_input)
+            if consumers and node in consumers:
+                consumers.remove(node)
+        if node not in self._consumers[new_input]:
+            self._consumers[new_input].append(node)
+        self._touched.append(node)
 
     # if there is nodes added, removed, or inputs changed, we need update the output_nodes/output_number etc.
     def _update_graph_nodes(self, nodes_to_extend, nodes_to_remove, has_input_changed=False):
-        ops = self.nodes
-
-        if nodes_to_remove:
-            for n in nodes_to_remove:
-                ops.remove(n)
-
-        if nodes_to_extend:
-            ops.extend(nodes_to_extend)
-
-        if nodes_to_extend or nodes_to_remove or has_input_changed:
-            self._g.set_nodes(ops)
+        for n in nodes_to_remove or []:
+            if n in self._removed:
+                continue
+            self._removed.add(n)
+            if n.type == "Transpose":
+                self._track_transpose(n.input[0], -1)
+            for name in n.input:
+                consumers = self._consumers.get(name)
+                if consumers and n in consumers:
+                    consumers.remove(n)
+            # graph inputs have no producer
+            producers = [self._g.get_node_by_name(name) for name in n.input if name]
+            self._touched.extend(p for p in producers if p is not None)
+
+        for n in nodes_to_extend or []:
+            self._nodes.append(n)
+            if n.type == "Transpose":
+                self._track_transpose(n.input[0], 1)
+            for name in n.input:
+                if n not in self._consumers[name]:
+                    self._consumers[name].append(n)
+            self._touched.append(n)
 
     def _handle_node_having_branches(self, node):
-        # create transpose pairs if some input are not.
-        self._create_transpose_pairs_before_node(node)
-
+        # the output transposes get removed, they can't be graph outputs
+        if any(self._is_graph_output(n) for name in node.output for n in self._find_output_consumers(name)):
+            return False
         # make sure node's all input transpose all have only 1 consumer node,
         # otherwise, it would impact their other output nodes
+        if not self._transpose_has_single_consumer_node([n for n in node.inputs if n and is_nhwc_transpose(n)]):
+            log.debug("input transpose does not have single consumer, skipping...")
+            return False
+        if not self._is_profitable(node):
+            log.debug("moving the transposes around " + node.name + " doesn't save bytes, skipping...")
+            return False
+
+        # create transpose pairs if some input are not.
+        self._create_transpose_pairs_before_node(node)
         if self._transpose_has_single_consumer_node(node.inputs):
             self._create_transpose_pairs_after_node(node)
             to_remove = []
@@ -156,22 +399,18 @@ class TransposeOptimizer(object):
             input_transposes = node.inputs
             for n in input_transposes:
                 n_input = n.input[0]
-                assert len(n.output) == 1
-                self._g.replace_all_inputs(self._g.get_nodes(), n.output[0], n_input)
+                self._replace_all_inputs(n.output[0], n_input)
 
                 to_remove.append(n)
 
-            assert len(node.output) == 1
-            # currently we assume node only has 1 output, for cases where it is more than 1 for example Split
-            # we need consider the fact that Split's multiple output will not always has data in NCHW/NHWC,
-            # it might be a different shape.
-            output_transposes = self._g.find_output_consumers(node.output[0])
-            for n in output_transposes:
-                n_input = n.input[0]
-                assert len(n.output) == 1
-                self._g.replace_all_inputs(self._g.get_nodes(), n.output[0], n_input)
-
-                to_remove.append(n)
+            # every output is in NCHW now, the consumers of each one are followed by a NCHW transpose
+            for name in node.output:
+                shape = self._g.get_shape(name)
+                if shape is not None and len(shape) == 4:
+                    self._g.set_shape(name, [shape[0], shape[3], shape[1], shape[2]])
+                for n in self._find_output_consumers(name):
+                    self._replace_all_inputs(n.output[0], n.input[0])
+                    to_remove.append(n)
 
             self._update_graph_nodes(None, to_remove, True)
             return True
@@ -179,44 +418,173 @@ class TransposeOptimizer(object):
         log.debug("input transpose does not have single consumer, skipping...")
         return False
 
+    # cost model: a transpose costs the bytes of the tensor it moves
+
+    def _tensor_bytes(self, name):
+        """Size of a tensor in bytes, None if its shape is unknown.
+
+        Unknown dims count as 1, the unknown batch size is the same for all tensors of a model.
+        """
+        shape = self._g.get_shape(name)
+        if shape is None:
+            return None
+        dtype = utils.ONNX_TO_NUMPY_DTYPE.get(self._g.get_dtype(name), np.float32)
+        return int(np.prod([max(d, 1) for d in shape], dtype=np.int64)) * np.dtype(dtype).itemsize
+
+    def _transposes_cost(self, names):
+        """Bytes moved by one transpose of each tensor, None if a size is unknown. Initializers are free."""
+        total = 0
+        for name in names:
+            if self._g.is_initializer(name):
+                continue
+            size = self._tensor_bytes(name)
+            if size is None:
+                return None
+            total += size
+        return total
+
+    def _is_profitable(self, node):
+        """True if moving the transposes around node to its other inputs and outputs doesn't cost bytes.
+
+        The nhwc input transposes and nchw output transposes go away, every other input and every
+        other consumer of an output gets a transpose. Without shapes the transposes are counted.
+        Ties are taken, the moved transposes may cancel with others further away.
+        """
+        removed = []
+        added = []
+        for name, n in zip(node.input, node.inputs):
+            if n is not None and is_nhwc_transpose(n):
+                if n.input[0] not in removed:
+                    removed.append(n.input[0])
+            elif name not in added:
+                added.append(name)
+        for name in node.output:
+            for n in self._find_output_consumers(name):
+                if is_nchw_transpose(n):
+                    removed.append(name)
+                elif n.type not in self._handler_map or self._is_graph_output(n):
+                    # a transpose in front of a handled op moves on, it's only paid where it gets stuck
+                    added.append(name)
+        removed_bytes = self._transposes_cost(removed)
+        added_bytes = self._transposes_cost(added)
+        if removed_bytes is None or added_bytes is None:
+            added = [name for name in added if not self._g.is_initializer(name)]
+            return len(added) <= len(removed)
+        return added_bytes <= removed_bytes
+
+    def _is_split_profitable(self, out_nodes):
+        """True if a copy of the transpose in front of each of out_nodes doesn't cost bytes.
+
+        The copies transpose the same tensor as the transpose they replace, so counting them compares
+        the bytes. Like in _is_profitable a copy in front of a handled op moves on and is only paid
+        where it gets stuck, at most one copy may get stuck.
+        """
+        stuck = [n for n in out_nodes if n.type not in self._handler_map or self._is_graph_output(n)]
+        return len(stuck) <= 1
+
+    def _track_transpose(self, input_name, sign):
+        """Book the bytes of a transpose of input_name that is added (sign 1) or removed (sign -1)."""
+        if self._g.is_initializer(input_name):
+            return
+        size = self._tensor_bytes(input_name)
+        if size is not None:
+            self._predicted_bytes += sign * size
+
+    def _transposed_bytes(self):
+        """Bytes moved by all transposes in the graph and the number of transposes of unknown size."""
+        total = 0
+        unknown = 0
+        for n in self._nodes:
+            if n.type != "Transpose" or n in self._removed or self._g.is_initializer(n.input[0]):
+                continue
+            size = self._tensor_bytes(n.input[0])
+            if size is None:
+                unknown += 1
+            else:
+                total += size
+        return total, unknown
+
+    def _move_shape_behind(self, name, trans):
+        """name is going to be the input of trans, trans takes its shape and name gets the transposed one."""
+        shape = self._g.get_shape(name)
+        perm = trans.get_attr("perm").ints
+        if shape is not None and len(shape) == len(perm):
+            self._g.set_shape(trans.output[0], shape)
+            inv = invert_perm(perm)
+            self._g.set_shape(name, [shape[i] for i in inv])
+        dtype = self._g.get_dtype(name)
+        if dtype is not None:
+            self._g.set_dtype(trans.output[0], dtype)
+
+    def _set_transpose_shape(self, trans):
+        """Shape and dtype of a new transpose from its input."""
+        shape = self._g.get_shape(trans.input[0])
+        perm = trans.get_attr("perm").ints
+        if shape is not None and len(shape) == len(perm):
+            self._g.set_shape(trans.output[0], [shape[p] for p in perm])
+        dtype = self._g.get_dtype(trans.input[0])
+        if dtype is not None:
+            self._g.set_dtype(trans.output[0], dtype)
+
     # the assumption is: only node.input[0] and trans.input[0] will be token care here.
     # if node has other input, they should be const
     def _switch_transpose_and_node(self, node, trans):
-        ops = self._g.get_nodes()
-        self._g.replace_all_inputs(ops, node.output[0], trans.output[0])
-        node.input[0] = trans.input[0]
-        trans.input[0] = utils.port_name(node.name)
-        self._g.set_nodes(ops)
+        self._move_shape_behind(node.output[0], trans)
+        self._replace_all_inputs(node.output[0], trans.output[0])
+        self._set_input(node, 0, trans.input[0])
+        self._set_input(trans, 0, node.output[0])
+
+    def _switch_transpose_and_multi_output_node(self, node, trans):
+        """Move trans behind node, each output gets its own copy of it."""
+        self._set_input(node, 0, trans.input[0])
+        added = []
+        for name in node.output:
+            if not self._find_output_consumers(name):
+                continue
+            nhwc = self._make_onnx_node("Transpose", [name], trans.op.attribute)
+            self._move_shape_behind(name, nhwc)
+            self._replace_all_inputs(name, nhwc.output[0])
+            added.append(nhwc)
+        self._update_graph_nodes(added, [trans], True)
 
     # if return value is True, then it means Transpose is handled as designed
     # otherwise, it means that we skip handling since it is not in our support set
     def _handle_nhwc_tranpose(self, trans):
-        out_nodes = self._g.find_output_consumers(trans.output[0])
+        if self._is_graph_output(trans):
+            return False
+        out_nodes = self._find_output_consumers(trans.output[0])
         if len(out_nodes) == 1:
             p = out_nodes[0]
-            if p.type in self._handler_map:
+            if p.type in self._handler_map and not self._is_graph_output(p):
                 op_handler = self._handler_map[p.type]
                 return op_handler(trans, p)
             return False
+        if not self._is_split_profitable(out_nodes):
+            log.debug("splitting " + trans.name + " into its branches adds transposes, skipping...")
+            return False
         # move transpose into branches to let Transposes can be "handled" in each branch
         to_append = []
         for n in out_nodes:
             branch_trans = self._make_onnx_node("Transpose", [trans.input[0]], trans.op.attribute, 1)
-            self._g.replace_input(n, trans.output[0], branch_trans.output[0])
+            self._set_transpose_shape(branch_trans)
+            self._replace_input(n, trans.output[0], branch_trans.output[0])
 
             to_append.append(branch_trans)
         self._update_graph_nodes(to_append, [trans], True)
-        return False
+        return bool(to_append)
 
     def _remove_useless_tranpose(self, trans):
-        self._g.replace_all_inputs(self._g.get_nodes(), trans.output[0], trans.input[0])
+        if self._is_graph_output(trans):
+            return False
+        self._replace_all_inputs(trans.output[0], trans.input[0])
         self._update_graph_nodes(None, [trans], True)
+        return True
 
     def _transpose_has_single_consumer_node(self, trans_nodes):
         result = True
         for n in trans_nodes:
-            cnt = len(set(self._g.find_output_consumers(n.output[0])))
-            result = result and cnt == 1
+            cnt = len(set(self._find_output_consumers(n.output[0])))
+            result = result and cnt == 1 and not self._is_graph_output(n)
             if not result:
                 return False
         return True
@@ -233,19 +601,24 @@ class TransposeOptimizer(object):
 
         return Node(n, self._g)
 
-    def _get_non_nchw_transpose_output_nodes(self, node):
-        # we just support node having 1 output, we need consider cases where node has more than 1 outputs
-        assert len(node.output) == 1
+    def _get_non_nchw_transpose_output_nodes(self, output_name):
         non_nchw_tranpose_nodes = []
-        consumers = self._g.find_output_consumers(node.output[0])
+        consumers = self._find_output_consumers(output_name)
         for o in consumers:
             if not is_nchw_transpose(o) and o not in non_nchw_tranpose_nodes:
                 non_nchw_tranpose_nodes.append(o)
         return non_nchw_tranpose_nodes
 
     def _create_transpose_pairs_after_node(self, node):
-        assert len(node.output) == 1  # just support node who has 1 output
-        non_nchw_trans_consumers = self._get_non_nchw_transpose_output_nodes(node)
+        added_node = []
+        for output_name in node.output:
+            added_node.extend(self._create_transpose_pairs_after_output(output_name))
+        if added_node:
+            self._update_graph_nodes(added_node, None, True)
+        return added_node
+
+    def _create_transpose_pairs_after_output(self, output_name):
+        non_nchw_trans_consumers = self._get_non_nchw_transpose_output_nodes(output_name)
         added_node = []
         # add Transpose(0, 3, 1, 2) and Transpose(0, 2, 3, 1) before each non_nchw_trans_consumers
         for consumer in non_nchw_trans_consumers:
@@ -253,7 +626,7 @@ class TransposeOptimizer(object):
             nchw_out_name = utils.port_name(nchw_op_name)
 
             kwargs = {"perm": [0, 3, 1, 2]}
-            nchw = helper.make_node("Transpose", [node.output[0]], [nchw_out_name], name=nchw_op_name, **kwargs)
+            nchw = helper.make_node("Transpose", [output_name], [nchw_out_name], name=nchw_op_name, **kwargs)
 
             nhwc_op_name = utils.make_name("Transpose")
             nhwc_out_name = utils.port_name(nhwc_op_name)
@@ -262,17 +635,16 @@ class TransposeOptimizer(object):
             nhwc = helper.make_node("Transpose", [nchw_out_name], [nhwc_out_name], name=nhwc_op_name, **kwargs)
             nchw_node = Node(nchw, self._g)
             nhwc_node = Node(nhwc, self._g)
-            self._g.replace_input(consumer, node.output[0], nhwc_out_name)
+            self._set_transpose_shape(nchw_node)
+            self._set_transpose_shape(nhwc_node)
+            self._replace_input(consumer, output_name, nhwc_out_name)
             added_node.extend([nchw_node, nhwc_node])
-
-        if added_node:
-            self._update_graph_nodes(added_node, None, True)
         return added_node
 
     def _create_transpose_pairs_before_node(self, node):
         non_nhwc_trans_inputs = []
         for input_id, n in zip(node.input, node.inputs):
-            if not is_nhwc_transpose(n):
+            if n is None or not is_nhwc_transpose(n):
                 # check in case node has two inputs coming from a same node output.
                 if [input_id, n] not in non_nhwc_trans_inputs:
                     non_nhwc_trans_inputs.append([input_id, n])
@@ -294,103 +666,136 @@ class TransposeOptimizer(object):
 
             nchw_node = Node(nchw, self._g)
             nhwc_node = Node(nhwc, self._g)
-            self._g.replace_input(node, input_id, nhwc_out_name)
+            self._set_transpose_shape(nchw_node)
+            self._set_transpose_shape(nhwc_node)
+            self._replace_input(node, input_id, nhwc_out_name)
             added_node.extend([nchw_node, nhwc_node])
 
         if added_node:
             self._update_graph_nodes(added_node, None, True)
         return added_node
 
-    def _add_handler(self, trans, node):
-        if self._g.is_initializer(node.input[1]):
-            t_p = trans.inputs[0]
-            if t_p.type in ("Conv", "ConvTranspose") and len(t_p.input) == 2:
-                # if Conv or ConvTranspose's bias input is not set, then we set, otherwise, we don't set
-                # todo: maybe we can add already set bias with the input??? try later
-                conv_inputs = [t_p.input[0], t_p.input[1], node.input[1]]
-                conv_node = self._make_onnx_node(t_p.type, conv_inputs, t_p.op.attribute)
-
-                ops = self._g.get_nodes()
-                trans.input[0] = utils.port_name(conv_node.name)
-                self._g.replace_all_inputs(ops, node.output[0], trans.output[0])
-                self._update_graph_nodes([conv_node], [t_p, node], True)
-                return True
+    def _unary_handler(self, trans, node):
+        if len(node.output) != 1:
             return False
-        return self._handle_node_having_branches(node)
-
-    def _relu_handler(self, trans, node):
-        self._g.replace_all_inputs(self._g.get_nodes(), node.output[0], trans.output[0])
-        node.input[0] = trans.input[0]
-        trans.input[0] = node.output[0]
+        # extra inputs like the bounds of Clip-11 have to be scalar constants
+        for name in node.input[1:]:
+            if name and not self._is_scalar_const(name):
+                return False
+        self._switch_transpose_and_node(node, trans)
         return True
 
-    def _transpose_handler(self, trans, node):
-        if is_nchw_transpose(node):
-            ops = self._g.get_nodes()
-            self._g.replace_all_inputs(ops, node.output[0], trans.input[0])
-            self._update_graph_nodes(None, [trans, node], True)
+    def _broadcast_handler(self, trans, node):
+        if len(node.input) != 2 or len(node.output) != 1 or node.get_attr("axis") is not None:
+            return False
+        index = 1 if node.input[0] == trans.output[0] else 0
+        other = node.input[index]
+        if other == trans.output[0]:
+            # x op x, both inputs move in front of the transpose
+            self._move_shape_behind(node.output[0], trans)
+            self._replace_all_inputs(node.output[0], trans.output[0])
+            self._set_input(node, 0, trans.input[0])
+            self._set_input(node, 1, trans.input[0])
+            self._set_input(trans, 0, node.output[0])
             return True
-        return False
+        if not self._g.is_initializer(other):
+            # both inputs come from the data path, all of them need a transpose
+            if node.get_attr("broadcast") or not all(self._is_4d(name) for name in node.input):
+                return False
+            return self._handle_node_having_branches(node)
+        if not self._is_scalar_const(other):
+            if self._g.opset < 7 or node.get_attr("broadcast"):
+                # legacy broadcast only aligns the trailing dims
+                return False
+            val = numpy_helper.to_array(self._g.get_initializer(other))
+            perm = list(trans.get_attr("perm").ints)
+            if val.ndim > len(perm):
+                return False
+            val = val.reshape([1] * (len(perm) - val.ndim) + list(val.shape))
+            val = np.transpose(val, invert_perm(perm))
+            if len(self._find_output_consumers(other)) == 1:
+                self._g.update_initializer(other, val)
+            else:
+                new_name = utils.make_name(node.name)
+                self._g.make_const(new_name, val)
+                self._set_input(node, index, new_name)
+        # the data input isn't necessarily the first one
+        self._move_shape_behind(node.output[0], trans)
+        self._replace_all_inputs(node.output[0], trans.output[0])
+        self._set_input(node, 1 - index, trans.input[0])
+        self._set_input(trans, 0, node.output[0])
+        return True
 
-    def _maxmin_handler(self, trans, node):
-        input_name = node.input[1]
-        if self._g.is_initializer(input_name):
-            numpy_val = numpy_helper.to_array(self._g.get_initializer(input_name))
-            transposed_val = np.transpose(numpy_val, (0, 3, 1, 2))
-            self._g.update_initializer(input_name, transposed_val)
-            self._switch_transpose_and_node(node, trans)
+    def _is_4d(self, name):
+        producer = self._g.get_node_by_name(name)
+        if producer is not None and is_nhwc_transpose(producer):
             return True
-        return False
+        shape = self._g.get_shape(name)
+        return shape is not None and len(shape) == 4
 
-    def _mul_handler(self, trans, node):
-        # make sure conv don't have bias set
-        if self._g.is_initializer(node.input[1]):
-            t_p = trans.inputs[0]
-            if t_p.type == "Conv" and self._g.is_initializer(t_p.input[1]) and len(t_p.input) == 2:
-                conv = t_p
-                numpy_val = numpy_helper.to_array(self._g.get_initializer(conv.input[1]))
-                transposed_val = np.transpose(numpy_val, (2, 3, 1, 0))
-                mul_val = numpy_helper.to_array(self._g.get_initializer(node.input[1]))
-                result = np.multiply(transposed_val, mul_val)
-                self._g.update_initializer(conv.input[1], np.transpose(result, (3, 2, 0, 1)))
-
-                ops = self._g.get_nodes()
-                self._g.replace_all_inputs(ops, node.output[0], trans.output[0])
-                self._update_graph_nodes(None, [node], True)
-                return True
-
-            mul_dim = self._g.get_initializer(node.input[1]).dims[0]
-            if mul_dim == 1:  # if there is only 1 number, so we just move transpose after the mul
-                ops = self._g.get_nodes()
-                self._g.replace_all_inputs(ops, node.output[0], trans.output[0])
-
-                node.input[0] = trans.input[0]
-                trans.input[0] = utils.port_name(node.name)
-                self._g.set_nodes(ops)
-                return True
-            # if the multiplier is not a single number, we need pad and reshape the data
-            log.debug("pad & reshape Conv's weight to mul-able with NCHW tensor")
-        log.debug("Mul's second input is not a const, skipping")
-        return False
+    def _is_scalar_const(self, name):
+        return self._g.is_initializer(name) and np.prod(self._g.get_initializer(name).dims) == 1
+
+    def _transpose_handler(self, trans, node):
+        return self._merge_transposes(node)
+
+    def _fold_const_transpose(self, trans):
+        """Transpose of an initializer, store the transposed value instead."""
+        if not self._g.is_initializer(trans.input[0]) or self._is_graph_output(trans):
+            return False
+        perm = trans.get_attr("perm")
+        val = numpy_helper.to_array(self._g.get_initializer(trans.input[0]))
+        val = np.transpose(val, perm.ints if perm else None)
+        # the initializer takes the name of the output, the consumers stay as they are
+        self._g.add_initializer(numpy_helper.from_array(val, trans.output[0]))
+        self._update_graph_nodes(None, [trans], True)
+        if not self._find_output_consumers(trans.input[0]) and trans.input[0] not in self._output_names:
+            self._g.remove_initializer(trans.input[0])
+        self._touched.extend(self._find_output_consumers(trans.output[0]))
+        return True
+
+    def _merge_transposes(self, trans):
+        """Transpose of a Transpose, transpose the input of the first one directly."""
+        first = self._g.get_node_by_name(trans.input[0])
+        if first is None or first.type != "Transpose" or first in self._removed or first.output[0] != trans.input[0]:
+            return False
+        first_perm = first.get_attr("perm")
+        perm = trans.get_attr("perm")
+        if not first_perm or not perm:
+            return False
+        perm = compose_perms(first_perm.ints, perm.ints)
+        self._set_input(trans, 0, first.input[0])
+        if not self._find_output_consumers(first.output[0]) and not self._is_graph_output(first):
+            self._update_graph_nodes(None, [first], True)
+        if perm == list(range(len(perm))) and not self._is_graph_output(trans):
+            self._replace_all_inputs(trans.output[0], trans.input[0])
+            self._update_graph_nodes(None, [trans], True)
+        else:
+            trans.set_attr("perm", perm)
+        return True
 
     def _identity_handler(self, trans, node):
-        ops = self._g.get_nodes()
-        self._g.replace_all_inputs(ops, node.output[0], trans.output[0])
+        self._replace_all_inputs(node.output[0], trans.output[0])
         self._update_graph_nodes(None, [node], True)
         return True
 
     def _concat_handler(self, trans, node):
+        perm = trans.get_attr("perm").ints
+        axis = node.get_attr("axis").i % len(perm)
         if self._handle_node_having_branches(node):
-            node.set_attr("axis", 1)
+            node.set_attr("axis", perm[axis])
             return True
         return False
 
-    def _split_handler(self, trans, node):
-        # Todo: need handle cases where Slit node has more than 1 outputs.
-        if self._handle_node_having_branches(node):
-            node.set_attr("axis", 1)
-            return True
-        return False
+    def _multi_output_axis_handler(self, trans, node):
+        """Split, TopK: the data is the first input, the outputs are in its layout along axis."""
+        perm = trans.get_attr("perm").ints
+        default = -1 if node.type == "TopK" else 0
+        axis = node.get_attr("axis")
+        axis = (axis.i if axis else default) % len(perm)
+        node.set_attr("axis", perm[axis])
+        self._switch_transpose_and_multi_output_node(node, trans)
+        return True
 
     def _pad_handler(self, trans, node):
         # [N-start, H-start, W-start, C-start, N-end, H-end,  W-end, C-end]
@@ -401,31 +806,122 @@ class TransposeOptimizer(object):
         self._switch_transpose_and_node(node, trans)
         return True
 
-    def _reducemean_handler(self, trans, node):
-        axes = node.get_attr("axes").ints
-        keepdims = node.get_attr("keepdims")
-        # make sure keepdims is 1, then we can do the swap, otherwise, please don't, because
-        # once keepdims is not set, original dims are lost, so transpose back won't work well.
-        # by default, if keepdims is not specified, it is 1
-        if axes == [1, 2] and ((keepdims and keepdims.i == 1) or (not keepdims)):
-            node.set_attr("axes", [2, 3])
-            self._switch_transpose_and_node(node, trans)
-            return True
-        return False
+    def _switch_transpose_with_perm(self, node, trans, perm):
+        """Switch trans and node, trans gets perm for the output of node. An identity perm drops trans."""
+        if perm == list(range(len(perm))):
+            self._set_input(node, 0, trans.input[0])
+            self._update_graph_nodes(None, [trans], True)
+            return
+        trans.set_attr("perm", perm)
+        self._switch_transpose_and_node(node, trans)
 
+    def _axes(self, node, rank):
+        axes = node.get_attr("axes")
+        if axes is None:
+            return None
+        return [a % rank for a in axes.ints]
 
-    def _slice_handler(self, trans, node):
-        axes = node.get_attr("axes").ints
+    def _reduce_handler(self, trans, node):
+        if len(node.input) != 1:
+            return False
+        perm = list(trans.get_attr("perm").ints)
+        axes = self._axes(node, len(perm))
         keepdims = node.get_attr("keepdims")
-        if axes == [0, 1, 2, 3]:
-            node.set_attr("axes", [0, 2, 3, 1])
+        if keepdims is None or keepdims.i == 1:
+            # the layout stays the same
+            if axes is not None:
+                node.set_attr("axes", sorted(perm[a] for a in axes))
             self._switch_transpose_and_node(node, trans)
             return True
-        return False
+        if axes is None:
+            # reduces to a scalar
+            self._switch_transpose_with_perm(node, trans, [])
+            return True
+        node.set_attr("axes", sorted(perm[a] for a in axes))
+        self._switch_transpose_with_perm(node, trans, squeeze_perm(perm, axes))
+        return True
+
+    def _squeeze_handler(self, trans, node):
+        if len(node.input) != 1:
+            return False
+        perm = list(trans.get_attr("perm").ints)
+        axes = self._axes(node, len(perm))
+        if axes is None:
+            # all dims of size 1 go away, which ones they are is only known from the shape
+            shape = self._g.get_shape(trans.output[0])
+            if shape is None or -1 in shape:
+                return False
+            axes = [i for i, d in enumerate(shape) if d == 1]
+        node.set_attr("axes", sorted(perm[a] for a in axes))
+        self._switch_transpose_with_perm(node, trans, squeeze_perm(perm, axes))
+        return True
+
+    def _unsqueeze_handler(self, trans, node):
+        if len(node.input) != 1:
+            return False
+        perm = list(trans.get_attr("perm").ints)
+        axes = node.get_attr("axes")
+        if axes is None:
+            return False
+        rank = len(perm) + len(axes.ints)
+        axes = [a % rank for a in axes.ints]
+        # the new dims stay where they are, the others get the order of the transpose input
+        node.set_attr("axes", axes)
+        self._switch_transpose_with_perm(node, trans, unsqueeze_perm(perm, axes))
+        return True
+
+    def _gather_handler(self, trans, node):
+        if node.input[0] != trans.output[0] or node.input[1] == trans.output[0]:
+            return False
+        if self._g.is_initializer(node.input[1]):
+            indices_rank = len(self._g.get_initializer(node.input[1]).dims)
+        else:
+            shape = self._g.get_shape(node.input[1])
+            if shape is None:
+                return False
+            indices_rank = len(shape)
+        perm = list(trans.get_attr("perm").ints)
+        axis = node.get_attr("axis")
+        axis = (axis.i if axis else 0) % len(perm)
+        new_axis = perm[axis]
+
+        def _position(dim):
+            # position of a dim of the transpose input in the output of the new gather
+            return dim if dim < new_axis else dim + indices_rank - 1
+
+        new_perm = [_position(perm[i]) for i in range(axis)]
+        new_perm += [new_axis + i for i in range(indices_rank)]
+        new_perm += [_position(perm[i]) for i in range(axis + 1, len(perm))]
+        node.set_attr("axis", new_axis)
+        self._switch_transpose_with_perm(node, trans, new_perm)
+        return True
 
-    # todo: consider share a same logic for element-wise op.
-    def _tanh_handler(self, trans, node):
-        self._g.replace_all_inputs(self._g.get_nodes(), node.output[0], trans.output[0])
-        node.input[0] = trans.input[0]
-        trans.input[0] = node.output[0]
+    def _slice_handler(self, trans, node):
+        perm = list(trans.get_attr("perm").ints)
+        if len(node.input) > 1:
+            # opset 10, starts, ends and axes are inputs
+            old_axes = node.input[3] if len(node.input) > 3 else ""
+            if old_axes:
+                if not self._g.is_initializer(old_axes):
+                    return False
+                axes = numpy_helper.to_array(self._g.get_initializer(old_axes)).tolist()
+            elif self._g.is_initializer(node.input[1]):
+                axes = list(range(len(numpy_helper.to_array(self._g.get_initializer(node.input[1])))))
+            else:
+                return False
+            new_name = utils.make_name(node.name)
+            self._g.make_const(new_name, np.array([perm[a % len(perm)] for a in axes], dtype=np.int64))
+            while len(node.input) < 4:
+                node.input.append("")
+            self._set_input(node, 3, new_name)
+            if old_axes and not self._find_output_consumers(old_axes) and old_axes not in self._output_names:
+                self._g.remove_initializer(old_axes)
+        else:
+            starts = node.get_attr("starts")
+            if starts is None:
+                return False
+            axes = node.get_attr("axes")
+            axes = axes.ints if axes else range(len(starts.ints))
+            node.set_attr("axes", [perm[a % len(perm)] for a in axes])
+        self._switch_transpose_and_node(node, trans)
         return True
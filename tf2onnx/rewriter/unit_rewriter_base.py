@@ -71,7 +71,7 @@ class UnitRewriterBase:
         # are defining the calculation with different orders. Then we can share the same 
         # pattern.
         cell_pattern = get_pattern(unit_type)
-        matcher = GraphMatcher(cell_pattern, allow_reorder=True)
+        matcher = GraphMatcher(cell_pattern, allow_reorder=True, name=unit_type.name)
         match_results = list(matcher.match_ops(self.g.get_nodes()))
 
         if match_results:
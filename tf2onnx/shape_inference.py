@@ -0,0 +1,618 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+tf2onnx.shape_inference - forward shape and dtype inference over onnx ops
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import logging
+
+import numpy as np
+from onnx import helper, numpy_helper, onnx_pb
+
+from tf2onnx import utils
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.shape_inference")
+
+# pylint: disable=unused-argument,missing-docstring
+
+_DTYPE_BY_NAME = {v: k for k, v in utils.ONNX_DTYPE_NAMES.items()}
+
+
+def _is_known(dim):
+    return dim is not None and dim >= 0
+
+
+def _prod(dims):
+    if not all(_is_known(d) for d in dims):
+        return -1
+    return int(np.prod(dims, dtype=np.int64))
+
+
+def _get_attr_value(node, name, default=None):
+    attr = node.get_attr(name)
+    if attr is None:
+        return default
+    return helper.get_attribute_value(attr)
+
+
+def _get_const_value(g, name):
+    """Return the value of a constant input as numpy array, None if it is not constant."""
+    if g.is_initializer(name):
+        return numpy_helper.to_array(g.get_initializer(name))
+    node = g.get_node_by_name(name)
+    if node is not None and node.is_const():
+        return node.get_tensor()
+    return None
+
+
+def get_input_shape(g, name):
+    """Return a copy of the shape of an input, None if unknown.
+    An empty shape is ambiguous (tensorflow uses it for scalars and unknown ranks), we only trust it for constants.
+    """
+    if not name:
+        return None
+    shape = g.get_shape(name)
+    if shape is None:
+        return None
+    if not shape:
+        if g.is_initializer(name):
+            return []
+        node = g.get_node_by_name(name)
+        if node is not None and node.is_const():
+            return []
+        return None
+    return [d if _is_known(d) else -1 for d in shape]
+
+
+def _normalize_axis(axis, rank):
+    return axis + rank if axis < 0 else axis
+
+
+def _broadcast_shapes(shapes):
+    """Numpy style multidirectional broadcast. Return None if the shapes can't be broadcast."""
+    rank = max(len(s) for s in shapes)
+    result = []
+    for i in range(rank):
+        dims = [s[len(s) - rank + i] for s in shapes if len(s) - rank + i >= 0]
+        known = set(d for d in dims if _is_known(d) and d != 1)
+        if len(known) > 1:
+            return None
+        if known:
+            result.append(known.pop())
+        elif any(not _is_known(d) for d in dims):
+            result.append(-1)
+        else:
+            result.append(1)
+    return result
+
+
+def _conv_output_dims(in_dims, kernel, strides, dilations, pads, auto_pad):
+    spatial = len(in_dims)
+    out = []
+    for i in range(spatial):
+        d = in_dims[i]
+        if not _is_known(d):
+            out.append(-1)
+            continue
+        effective_kernel = (kernel[i] - 1) * dilations[i] + 1
+        if auto_pad in ("SAME_UPPER", "SAME_LOWER"):
+            out.append(-(-d // strides[i]))
+        elif auto_pad == "VALID":
+            out.append(-(-(d - effective_kernel + 1) // strides[i]))
+        else:
+            out.append((d + pads[i] + pads[i + spatial] - effective_kernel) // strides[i] + 1)
+    return out
+
+
+#
+# handlers: return a list of (shape, dtype) tuples, one per output. None means unknown.
+#
+
+def _same_as_input(g, node):
+    return [(get_input_shape(g, node.input[0]), g.get_dtype(node.input[0]))]
+
+
+def _cast(g, node):
+    to = _get_attr_value(node, "to")
+    if isinstance(to, bytes):
+        to = _DTYPE_BY_NAME.get(to.decode("utf-8"))
+    return [(get_input_shape(g, node.input[0]), to)]
+
+
+def _broadcast(g, node):
+    shapes = [get_input_shape(g, name) for name in node.input]
+    dtype = None
+    for name in node.input:
+        dtype = g.get_dtype(name)
+        if dtype:
+            break
+    if node.type in ["Equal", "Greater", "Less", "And", "Or", "Xor"]:
+        dtype = onnx_pb.TensorProto.BOOL
+    if any(s is None for s in shapes):
+        return [(None, dtype)]
+    if g.opset < 7:
+        # legacy broadcast: the second input is broadcast into the first one
+        return [(shapes[0], dtype)]
+    return [(_broadcast_shapes(shapes), dtype)]
+
+
+def _transpose(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    if shape is None:
+        return [(None, dtype)]
+    perm = _get_attr_value(node, "perm")
+    if perm is None:
+        perm = list(reversed(range(len(shape))))
+    if len(perm) != len(shape):
+        return [(None, dtype)]
+    return [([shape[p] for p in perm], dtype)]
+
+
+def _reshape(g, node):
+    dtype = g.get_dtype(node.input[0])
+    if len(node.input) > 1:
+        target = _get_const_value(g, node.input[1])
+    else:
+        target = _get_attr_value(node, "shape")
+    if target is None:
+        return [(None, dtype)]
+    target = [int(d) for d in np.array(target).flatten()]
+    in_shape = get_input_shape(g, node.input[0])
+    out = []
+    for i, d in enumerate(target):
+        if d == 0:
+            out.append(in_shape[i] if in_shape is not None and i < len(in_shape) else -1)
+        else:
+            out.append(d)
+    if -1 in target and in_shape is not None:
+        total = _prod(in_shape)
+        rest = _prod([d for i, d in enumerate(out) if target[i] != -1])
+        if total >= 0 and rest > 0:
+            out[target.index(-1)] = total // rest
+    return [(out, dtype)]
+
+
+def _flatten(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    if shape is None:
+        return [(None, dtype)]
+    axis = _normalize_axis(_get_attr_value(node, "axis", 1), len(shape))
+    return [([_prod(shape[:axis]) if axis else 1, _prod(shape[axis:])], dtype)]
+
+
+def _squeeze(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    if shape is None:
+        return [(None, dtype)]
+    axes = _get_attr_value(node, "axes")
+    if axes is None:
+        if not all(_is_known(d) for d in shape):
+            return [(None, dtype)]
+        return [([d for d in shape if d != 1], dtype)]
+    axes = [_normalize_axis(a, len(shape)) for a in axes]
+    return [([d for i, d in enumerate(shape) if i not in axes], dtype)]
+
+
+def _unsqueeze(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    axes = _get_attr_value(node, "axes")
+    if shape is None or axes is None:
+        return [(None, dtype)]
+    out = list(shape)
+    rank = len(shape) + len(axes)
+    for a in sorted(_normalize_axis(a, rank) for a in axes):
+        out.insert(a, 1)
+    return [(out, dtype)]
+
+
+def _concat(g, node):
+    shapes = [get_input_shape(g, name) for name in node.input]
+    dtype = g.get_dtype(node.input[0])
+    if any(s is None for s in shapes) or len(set(len(s) for s in shapes)) != 1:
+        return [(None, dtype)]
+    rank = len(shapes[0])
+    axis = _normalize_axis(_get_attr_value(node, "axis", 0), rank)
+    out = []
+    for i in range(rank):
+        dims = [s[i] for s in shapes]
+        if i == axis:
+            out.append(sum(dims) if all(_is_known(d) for d in dims) else -1)
+        else:
+            known = [d for d in dims if _is_known(d)]
+            out.append(known[0] if known else -1)
+    return [(out, dtype)]
+
+
+def _split(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    count = len(node.output)
+    if shape is None:
+        return [(None, dtype)] * count
+    axis = _normalize_axis(_get_attr_value(node, "axis", 0), len(shape))
+    split = _get_attr_value(node, "split")
+    if split is None:
+        size = shape[axis] // count if _is_known(shape[axis]) else -1
+        split = [size] * count
+    results = []
+    for size in split:
+        out = list(shape)
+        out[axis] = size
+        results.append((out, dtype))
+    return results
+
+
+def _slice(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    starts = _get_attr_value(node, "starts")
+    ends = _get_attr_value(node, "ends")
+    if shape is None or starts is None or ends is None:
+        return [(None, dtype)]
+    axes = _get_attr_value(node, "axes", list(range(len(starts))))
+    out = list(shape)
+    for axis, start, end in zip(axes, starts, ends):
+        axis = _normalize_axis(axis, len(shape))
+        d = shape[axis]
+        if not _is_known(d):
+            out[axis] = -1
+            continue
+        start = min(max(start + d if start < 0 else start, 0), d)
+        end = min(max(end + d if end < 0 else end, 0), d)
+        out[axis] = max(end - start, 0)
+    return [(out, dtype)]
+
+
+def _gather(g, node):
+    shape = get_input_shape(g, node.input[0])
+    indices = get_input_shape(g, node.input[1])
+    dtype = g.get_dtype(node.input[0])
+    if shape is None or indices is None:
+        return [(None, dtype)]
+    axis = _normalize_axis(_get_attr_value(node, "axis", 0), len(shape))
+    return [(shape[:axis] + indices + shape[axis + 1:], dtype)]
+
+
+def _conv(g, node):
+    shape = get_input_shape(g, node.input[0])
+    kernel = get_input_shape(g, node.input[1])
+    dtype = g.get_dtype(node.input[0])
+    if shape is None or kernel is None or len(shape) < 3 or len(kernel) != len(shape):
+        return [(None, dtype)]
+    spatial = len(shape) - 2
+    kernel_shape = _get_attr_value(node, "kernel_shape", kernel[2:])
+    strides = _get_attr_value(node, "strides", [1] * spatial)
+    dilations = _get_attr_value(node, "dilations", [1] * spatial)
+    pads = _get_attr_value(node, "pads", [0] * spatial * 2)
+    auto_pad = _get_attr_value(node, "auto_pad", b"NOTSET").decode("utf-8")
+    if not all(_is_known(k) for k in kernel_shape):
+        return [(None, dtype)]
+    dims = _conv_output_dims(shape[2:], kernel_shape, strides, dilations, pads, auto_pad)
+    return [([shape[0], kernel[0]] + dims, dtype)]
+
+
+def _conv_transpose(g, node):
+    shape = get_input_shape(g, node.input[0])
+    kernel = get_input_shape(g, node.input[1])
+    dtype = g.get_dtype(node.input[0])
+    if shape is None or kernel is None or len(shape) < 3 or len(kernel) != len(shape):
+        return [(None, dtype)]
+    spatial = len(shape) - 2
+    group = _get_attr_value(node, "group", 1)
+    channels = kernel[1] * group if _is_known(kernel[1]) else -1
+    output_shape = _get_attr_value(node, "output_shape")
+    if output_shape is not None:
+        return [([shape[0], channels] + list(output_shape[-spatial:]), dtype)]
+    kernel_shape = _get_attr_value(node, "kernel_shape", kernel[2:])
+    strides = _get_attr_value(node, "strides", [1] * spatial)
+    dilations = _get_attr_value(node, "dilations", [1] * spatial)
+    pads = _get_attr_value(node, "pads", [0] * spatial * 2)
+    output_padding = _get_attr_value(node, "output_padding", [0] * spatial)
+    dims = []
+    for i in range(spatial):
+        d = shape[i + 2]
+        if not _is_known(d) or not _is_known(kernel_shape[i]):
+            dims.append(-1)
+            continue
+        dims.append(strides[i] * (d - 1) + output_padding[i] + (kernel_shape[i] - 1) * dilations[i] + 1
+                    - pads[i] - pads[i + spatial])
+    return [([shape[0], channels] + dims, dtype)]
+
+
+def _pool(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    kernel_shape = _get_attr_value(node, "kernel_shape")
+    if shape is None or kernel_shape is None or len(shape) != len(kernel_shape) + 2:
+        out_shape = None
+    else:
+        spatial = len(kernel_shape)
+        strides = _get_attr_value(node, "strides", [1] * spatial)
+        pads = _get_attr_value(node, "pads", [0] * spatial * 2)
+        auto_pad = _get_attr_value(node, "auto_pad", b"NOTSET").decode("utf-8")
+        out_shape = shape[:2] + _conv_output_dims(shape[2:], kernel_shape, strides, [1] * spatial, pads, auto_pad)
+    # the optional Indices output of MaxPool
+    indices = [(out_shape, onnx_pb.TensorProto.INT64)] if len(node.output) > 1 else []
+    return [(out_shape, dtype)] + indices
+
+
+def _global_pool(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    if shape is None:
+        return [(None, dtype)]
+    return [(shape[:2] + [1] * (len(shape) - 2), dtype)]
+
+
+def _reduce(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    if shape is None:
+        return [(None, dtype)]
+    axes = _get_attr_value(node, "axes", list(range(len(shape))))
+    axes = [_normalize_axis(a, len(shape)) for a in axes]
+    keepdims = _get_attr_value(node, "keepdims", 1)
+    if keepdims:
+        return [([1 if i in axes else d for i, d in enumerate(shape)], dtype)]
+    return [([d for i, d in enumerate(shape) if i not in axes], dtype)]
+
+
+def _arg_minmax(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = onnx_pb.TensorProto.INT64
+    if shape is None:
+        return [(None, dtype)]
+    axis = _normalize_axis(_get_attr_value(node, "axis", 0), len(shape))
+    keepdims = _get_attr_value(node, "keepdims", 1)
+    if keepdims:
+        return [([1 if i == axis else d for i, d in enumerate(shape)], dtype)]
+    return [([d for i, d in enumerate(shape) if i != axis], dtype)]
+
+
+def _matmul(g, node):
+    a = get_input_shape(g, node.input[0])
+    b = get_input_shape(g, node.input[1])
+    dtype = g.get_dtype(node.input[0])
+    if a is None or b is None or not a or not b:
+        return [(None, dtype)]
+    a_vec, b_vec = len(a) == 1, len(b) == 1
+    if a_vec:
+        a = [1] + a
+    if b_vec:
+        b = b + [1]
+    batch = _broadcast_shapes([a[:-2], b[:-2]]) if len(a) > 2 or len(b) > 2 else []
+    if batch is None:
+        return [(None, dtype)]
+    out = batch + [a[-2], b[-1]]
+    if b_vec:
+        out = out[:-1]
+    if a_vec:
+        del out[-2 if not b_vec else -1]
+    return [(out, dtype)]
+
+
+def _gemm(g, node):
+    a = get_input_shape(g, node.input[0])
+    b = get_input_shape(g, node.input[1])
+    dtype = g.get_dtype(node.input[0])
+    if a is None or b is None or len(a) != 2 or len(b) != 2:
+        return [(None, dtype)]
+    m = a[1] if _get_attr_value(node, "transA", 0) else a[0]
+    n = b[0] if _get_attr_value(node, "transB", 0) else b[1]
+    return [([m, n], dtype)]
+
+
+def _pad(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    pads = _get_attr_value(node, "pads")
+    if shape is None or pads is None or len(pads) != 2 * len(shape):
+        return [(None, dtype)]
+    rank = len(shape)
+    return [([d + pads[i] + pads[i + rank] if _is_known(d) else -1 for i, d in enumerate(shape)], dtype)]
+
+
+def _shape(g, node):
+    shape = get_input_shape(g, node.input[0])
+    return [([len(shape)] if shape is not None else None, onnx_pb.TensorProto.INT64)]
+
+
+def _size(g, node):
+    return [([], onnx_pb.TensorProto.INT64)]
+
+
+def _tile(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    repeats = _get_const_value(g, node.input[1]) if len(node.input) > 1 else None
+    if shape is None or repeats is None or len(repeats) != len(shape):
+        return [(None, dtype)]
+    return [([d * int(r) if _is_known(d) else -1 for d, r in zip(shape, repeats)], dtype)]
+
+
+def _upsample(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    scales = _get_attr_value(node, "scales")
+    if shape is None or scales is None or len(scales) != len(shape):
+        return [(None, dtype)]
+    return [([int(np.floor(d * s)) if _is_known(d) else -1 for d, s in zip(shape, scales)], dtype)]
+
+
+def _topk(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    k = _get_attr_value(node, "k")
+    if shape is None or k is None:
+        return [(None, dtype), (None, onnx_pb.TensorProto.INT64)]
+    axis = _normalize_axis(_get_attr_value(node, "axis", -1), len(shape))
+    out = list(shape)
+    out[axis] = k
+    return [(out, dtype), (list(out), onnx_pb.TensorProto.INT64)]
+
+
+def _depth_to_space(g, node):
+    shape = get_input_shape(g, node.input[0])
+    dtype = g.get_dtype(node.input[0])
+    blocksize = _get_attr_value(node, "blocksize")
+    if shape is None or blocksize is None or len(shape) != 4:
+        return [(None, dtype)]
+    n, c, h, w = shape
+    if node.type == "DepthToSpace":
+        c = c // (blocksize * blocksize) if _is_known(c) else -1
+        h = h * blocksize if _is_known(h) else -1
+        w = w * blocksize if _is_known(w) else -1
+    else:
+        c = c * blocksize * blocksize if _is_known(c) else -1
+        h = h // blocksize if _is_known(h) else -1
+        w = w // blocksize if _is_known(w) else -1
+    return [([n, c, h, w], dtype)]
+
+
+def _random(g, node):
+    shape = _get_attr_value(node, "shape")
+    return [(list(shape) if shape is not None else None, _get_attr_value(node, "dtype", onnx_pb.TensorProto.FLOAT))]
+
+
+def _random_like(g, node):
+    dtype = _get_attr_value(node, "dtype", g.get_dtype(node.input[0]))
+    return [(get_input_shape(g, node.input[0]), dtype)]
+
+
+_UNARY_OPS = [
+    "Abs", "Acos", "Asin", "Atan", "BatchNormalization", "Ceil", "Clip", "Cos", "Dropout", "Elu", "Exp", "Floor",
+    "HardSigmoid", "Identity", "InstanceNormalization", "LeakyRelu", "Log", "LogSoftmax", "LRN",
+    "Neg", "Not", "Reciprocal", "Relu", "Selu", "Sigmoid", "Sin", "Softmax", "Softplus", "Softsign", "Sqrt",
+    "Tan", "Tanh", "ThresholdedRelu",
+]
+
+_BROADCAST_OPS = [
+    "Add", "And", "Div", "Equal", "Greater", "Less", "Max", "Mean", "Min", "Mul", "Or", "Pow", "PRelu", "Sub",
+    "Sum", "Xor",
+]
+
+_REDUCE_OPS = [
+    "ReduceL1", "ReduceL2", "ReduceLogSum", "ReduceLogSumExp", "ReduceMax", "ReduceMean", "ReduceMin",
+    "ReduceProd", "ReduceSum", "ReduceSumSquare",
+]
+
+_SHAPE_HANDLERS = {
+    "ArgMax": _arg_minmax,
+    "ArgMin": _arg_minmax,
+    "AveragePool": _pool,
+    "Cast": _cast,
+    "Concat": _concat,
+    "Conv": _conv,
+    "ConvTranspose": _conv_transpose,
+    "DepthToSpace": _depth_to_space,
+    "Flatten": _flatten,
+    "Gather": _gather,
+    "Gemm": _gemm,
+    "GlobalAveragePool": _global_pool,
+    "GlobalMaxPool": _global_pool,
+    "MatMul": _matmul,
+    "MaxPool": _pool,
+    "Pad": _pad,
+    "RandomNormal": _random,
+    "RandomNormalLike": _random_like,
+    "RandomUniform": _random,
+    "RandomUniformLike": _random_like,
+    "Reshape": _reshape,
+    "Shape": _shape,
+    "Size": _size,
+    "Slice": _slice,
+    "SpaceToDepth": _depth_to_space,
+    "Split": _split,
+    "Squeeze": _squeeze,
+    "Tile": _tile,
+    "TopK": _topk,
+    "Transpose": _transpose,
+    "Unsqueeze": _unsqueeze,
+    "Upsample": _upsample,
+}
+_SHAPE_HANDLERS.update({op: _same_as_input for op in _UNARY_OPS})
+_SHAPE_HANDLERS.update({op: _broadcast for op in _BROADCAST_OPS})
+_SHAPE_HANDLERS.update({op: _reduce for op in _REDUCE_OPS})
+
+
+def _update_output(g, name, shape, dtype, override):
+    """Merge an inferred shape/dtype into the graph. Return True if anything changed."""
+    changed = False
+    if dtype and g.get_dtype(name) is None:
+        g.set_dtype(name, dtype)
+        changed = True
+    if shape is None:
+        return changed
+    shape = [int(d) if _is_known(d) else -1 for d in shape]
+    old = g.get_shape(name)
+    if old is None or (not old and shape):
+        g.set_shape(name, shape)
+        return True
+    if len(old) != len(shape):
+        if override:
+            g.set_shape(name, shape)
+            return True
+        log.debug("inferred rank of %s differs: %s vs. %s", name, shape, old)
+        return changed
+    conflict = any(_is_known(o) and _is_known(s) and o != s for o, s in zip(old, shape))
+    if conflict and not override:
+        log.debug("inferred shape of %s differs: %s vs. %s", name, shape, old)
+        return changed
+    if conflict:
+        merged = [s if _is_known(s) else o for o, s in zip(old, shape)]
+    else:
+        merged = [o if _is_known(o) else s for o, s in zip(old, shape)]
+    if merged != list(old):
+        g.set_shape(name, merged)
+        changed = True
+    return changed
+
+
+def infer_node_shape(g, node, override=False):
+    """Infer output shapes and dtypes of a single node.
+    Args:
+        g: the graph
+        node: onnx node
+        override: if True, inferred dimensions replace conflicting recorded ones, otherwise
+            recorded shapes are only refined (unknown dimensions get filled in)
+    Returns:
+        True if a shape or dtype of the graph changed
+    """
+    handler = _SHAPE_HANDLERS.get(node.type)
+    if handler is None or node.domain:
+        return False
+    try:
+        results = handler(g, node)
+    except Exception as ex:  # pylint: disable=broad-except
+        log.debug("shape inference failed for %s: %s", node.name, ex)
+        return False
+    changed = False
+    for name, (shape, dtype) in zip(node.output, results):
+        if name:
+            changed |= _update_output(g, name, shape, dtype, override)
+    return changed
+
+
+def infer_shapes(g, ops=None, override=False):
+    """Infer output shapes and dtypes for ops (default: all nodes of the graph).
+    Ops are visited in the given order which should be topological so results propagate
+    in a single sweep.
+    Returns:
+        number of nodes whose outputs changed
+    """
+    if ops is None:
+        ops = g.get_nodes()
+    changed = 0
+    for node in ops:
+        if infer_node_shape(g, node, override):
+            changed += 1
+    return changed
@@ -16,14 +16,18 @@ import traceback
 import numpy as np
 from onnx import helper, onnx_pb, numpy_helper
 
+import tensorflow as tf
+from tensorflow.core.framework import graph_pb2
 from tensorflow.python.framework import graph_util
+from tensorflow.python.framework import op_def_registry
 from tensorflow.tools.graph_transforms import TransformGraph
 
 import tf2onnx
 from tf2onnx import utils
 from tf2onnx.graph import Node, Graph
-from tf2onnx.graph_matcher import OpTypePattern, GraphMatcher
+from tf2onnx.graph_matcher import MatcherStats, OpTypePattern, RewriteRule, apply_rules, const_value, set_stats
 from tf2onnx.rewriter.rnn import rewrite_single_direction_lstm, rewrite_bi_direction_lstm
+from tf2onnx.shape_inference import infer_shapes
 from tf2onnx.utils import port_name
 
 logging.basicConfig(level=logging.INFO)
@@ -43,17 +47,58 @@ DEFAULT_TARGET = []
 # pylint: disable=unused-variable
 
 
+# ignore the following attributes
+IGNORED_ATTR = ["unknown_rank", "_class", "Tidx", "Tshape", "use_cudnn_on_gpu", "Index",
+                "Tpaddings", "TI", "Tparams", "Tindices", "Tlen", "Tdim", "dynamic_size", "element_shape",
+                "Tmultiples", "output_dtype", "Tblock_shape", "Tcrops", "index_type", "Taxis", "U",
+                "maxval", "Tout"]
+
+
+def _tf_node_to_onnx(node, attr_names, input_names, output_names, dtypes, attr_cnt):
+    """Onnx node for a tf.Operation or _NodeDefOp with minimally converted attributes."""
+    attr = {}
+    for a in attr_names:
+        attr_cnt[a] += 1
+        if a == "dtype":
+            attr[a] = utils.map_tf_dtype(node.get_attr("dtype"))
+        elif a == "T":
+            dtype = node.get_attr("T")
+            if dtype:
+                if not isinstance(dtype, list):
+                    dtypes[node.name] = utils.map_tf_dtype(dtype)
+        elif a in ["output_type", "output_dtype", "out_type"]:
+            attr[a] = utils.map_tf_dtype(node.get_attr(a))
+        elif a == "shape":
+            attr[a] = utils.get_shape(node)
+        elif a == "Tperm":
+            pass
+        elif a == "_output_shapes":
+            attr[a] = utils.get_shape(node)
+        elif a == "value":
+            onnx_tensor = utils.tf_to_onnx_tensor(node.get_attr(a), name=port_name(node.name))
+            attr[a] = onnx_tensor
+        elif a == "DstT":
+            attr["to"] = utils.map_tf_dtype(node.get_attr("DstT"))
+        elif a == "SrcT":
+            continue
+        elif a in IGNORED_ATTR:
+            continue
+        else:
+            attr[a] = node.get_attr(a)
+
+    try:
+        return helper.make_node(node.type, input_names, output_names, name=node.name, **attr)
+    except Exception as ex:
+        log.error("pass1 convert failed for %s, ex=%s", node, ex)
+        raise
+
+
 def tflist_to_onnx(node_list, shape_override):
     """
     Convert the tf-node list into an onnx graph with minimal rewrites so
     we can use the onnx graph as intermediate graph.
     """
 
-    # ignore the following attributes
-    ignored_attr = ["unknown_rank", "_class", "Tidx", "Tshape", "use_cudnn_on_gpu", "Index",
-                    "Tpaddings", "TI", "Tparams", "Tindices", "Tlen", "Tdim", "dynamic_size", "element_shape",
-                    "Tmultiples", "output_dtype", "Tblock_shape", "Tcrops", "index_type", "Taxis", "U",
-                    "maxval", "Tout"]
     # some stats
     op_cnt = collections.Counter()
     attr_cnt = collections.Counter()
@@ -78,55 +123,165 @@ def tflist_to_onnx(node_list, shape_override):
 
     # minimal conversion of attributes
     for node in ops:
-        attr = {}
-        takeit = True
         op_cnt[node.type] += 1
-        for a in node.node_def.attr:
-            attr_cnt[a] += 1
-            if a == "dtype":
-                attr[a] = utils.map_tf_dtype(node.get_attr("dtype"))
-            elif a == "T":
-                dtype = node.get_attr("T")
-                if dtype:
-                    if not isinstance(dtype, list):
-                        dtypes[node.name] = utils.map_tf_dtype(dtype)
-            elif a in ["output_type", "output_dtype", "out_type"]:
-                attr[a] = utils.map_tf_dtype(node.get_attr(a))
-            elif a == "shape":
-                attr[a] = utils.get_shape(node)
-            elif a == "Tperm":
-                pass
-            elif a == "_output_shapes":
-                attr[a] = utils.get_shape(node)
-            elif a == "value":
-                onnx_tensor = utils.tf_to_onnx_tensor(node.get_attr(a), name=port_name(node.name))
-                attr[a] = onnx_tensor
-            elif a == "DstT":
-                attr["to"] = utils.map_tf_dtype(node.get_attr("DstT"))
-            elif a == "SrcT":
-                continue
-            elif a in ignored_attr:
-                continue
+        input_names = [i.name for i in node.inputs]
+        output_names = [i.name for i in node.outputs]
+        onnx_nodes.append(_tf_node_to_onnx(node, node.node_def.attr, input_names, output_names, dtypes, attr_cnt))
+
+    return onnx_nodes, op_cnt, attr_cnt, output_shapes, dtypes
+
+
+def _get_op_def(op_type):
+    if hasattr(op_def_registry, "get"):
+        return op_def_registry.get(op_type)
+    return op_def_registry.get_registered_ops().get(op_type)
+
+
+class _NodeDefOp(object):
+    """The parts of tf.Operation pass 1 uses, read from a NodeDef and the OpDef of its type.
+
+    Attributes the NodeDef leaves out get the OpDef defaults, like tf.import_graph_def adds them.
+    """
+
+    def __init__(self, node_def):
+        self.node_def = node_def
+        self.name = node_def.name
+        self.type = node_def.op
+        self._op_def = _get_op_def(node_def.op)
+        if self._op_def is None:
+            raise ValueError("tensorflow op " + node_def.op + " of " + node_def.name + " is not registered")
+        self._defaults = {a.name: a.default_value for a in self._op_def.attr
+                          if a.HasField("default_value") and a.name not in node_def.attr}
+
+    def attr_names(self):
+        """Attributes with defaults, _output_shapes is only read for the shapes like tf.import_graph_def does."""
+        return [a for a in self.node_def.attr if a != "_output_shapes"] + list(self._defaults)
+
+    def get_attr(self, name):
+        """Attribute value converted like tf.Operation.get_attr does."""
+        value = self.node_def.attr[name] if name in self.node_def.attr else self._defaults.get(name)
+        if value is None:
+            raise ValueError("op " + self.name + " has no attribute " + name)
+        kind = value.WhichOneof("value")
+        if kind is None:
+            return []
+        if kind == "list":
+            for field in ["s", "i", "f", "b", "type", "shape", "tensor", "func"]:
+                items = getattr(value.list, field)
+                if items:
+                    if field == "type":
+                        return [tf.as_dtype(t) for t in items]
+                    return list(items)
+            return []
+        if kind == "type":
+            return tf.as_dtype(value.type)
+        return getattr(value, kind)
+
+    def input_names(self):
+        """Data inputs as tensor names, control inputs are left out like in tf.Operation.inputs."""
+        return [i if ":" in i else port_name(i) for i in self.node_def.input if not i.startswith("^")]
+
+    def output_dtypes(self):
+        """tf dtypes of the outputs, from the output args of the OpDef."""
+        ret = []
+        for arg in self._op_def.output_arg:
+            count = self.get_attr(arg.number_attr) if arg.number_attr else 1
+            if arg.type_list_attr:
+                ret.extend(self.get_attr(arg.type_list_attr))
+            elif arg.type_attr:
+                ret.extend([self.get_attr(arg.type_attr)] * count)
             else:
-                attr[a] = node.get_attr(a)
+                ret.extend([tf.as_dtype(arg.type)] * count)
+        return ret
+
+    def output_shapes(self):
+        """Shapes from the _output_shapes attribute, None if they aren't known.
+
+        Without _output_shapes the shape of Placeholders comes from their shape attribute and
+        the shape of Consts from their value.
+        """
+        if "_output_shapes" in self.node_def.attr:
+            return [_shape_as_list(shape) for shape in self.node_def.attr["_output_shapes"].list.shape]
+        if self.type in ["Placeholder", "PlaceholderWithDefault"]:
+            return [_shape_as_list(self.get_attr("shape"))]
+        if self.type == "Const":
+            return [[d.size for d in self.get_attr("value").tensor_shape.dim]]
+        return None
+
+
+def _shape_as_list(shape):
+    """TensorShapeProto as list like TensorShape.as_list, [] for an unknown rank."""
+    if shape.unknown_rank:
+        return []
+    return [d.size if d.size >= 0 else None for d in shape.dim]
+
 
-        if takeit:
+def _tf_output_shapes(graph_def):
+    """Output shapes tensorflow shape inference finds, needs a tf.Graph."""
+    shapes = {}
+    with tf.Graph().as_default() as tf_graph:
+        tf.import_graph_def(graph_def, name='')
+    for op in tf_graph.get_operations():
+        for out in op.outputs:
             try:
-                input_names = [i.name for i in node.inputs]
-                output_names = [i.name for i in node.outputs]
-                onnx_node = helper.make_node(node.type, input_names, output_names, name=node.name, **attr)
-                onnx_nodes.append(onnx_node)
-            except Exception as ex:
-                log.error("pass1 convert failed for %s, ex=%s", node, ex)
-                raise
+                shapes[out.name] = out.get_shape().as_list()
+            except ValueError:
+                shapes[out.name] = []
+    return shapes
+
+
+def graphdef_to_onnx(graph_def, shape_override, tf_shape_inference=True):
+    """
+    Pass 1 reading the NodeDefs of a GraphDef, without importing it into a tf.Graph.
+
+    The shapes come from shape_override and the _output_shapes attributes. Shapes neither
+    has are taken from tensorflow shape inference if tf_shape_inference is set, which imports
+    the graph after all, otherwise they stay unknown for infer_shapes to fill in.
+    """
+    op_cnt = collections.Counter()
+    attr_cnt = collections.Counter()
+    onnx_nodes = []
+    output_shapes = {}
+    dtypes = {}
+
+    ops = [_NodeDefOp(node_def) for node_def in graph_def.node]
+    outputs = {}
+    missing = []
+    for node in ops:
+        shapes = node.output_shapes()
+        outputs[node.name] = []
+        for i, dtype in enumerate(node.output_dtypes()):
+            name = port_name(node.name, i)
+            outputs[node.name].append(name)
+            dtypes[name] = utils.map_tf_dtype(dtype)
+            shape = shape_override.get(name)
+            if shape is None and shapes is not None and i < len(shapes):
+                shape = shapes[i]
+            if shape is None:
+                missing.append(name)
+                shape = []
+            output_shapes[name] = shape
+    if missing and tf_shape_inference:
+        log.debug("%d outputs have no _output_shapes, using tensorflow shape inference", len(missing))
+        tf_shapes = _tf_output_shapes(graph_def)
+        for name in missing:
+            output_shapes[name] = tf_shapes.get(name, [])
+
+    for node in ops:
+        op_cnt[node.type] += 1
+        onnx_nodes.append(_tf_node_to_onnx(node, node.attr_names(), node.input_names(), outputs[node.name],
+                                           dtypes, attr_cnt))
 
     return onnx_nodes, op_cnt, attr_cnt, output_shapes, dtypes
 
 
-def tensorflow_to_onnx(graph, shape_override):
+def tensorflow_to_onnx(graph, shape_override, tf_shape_inference=True):
     """
     Load tensorflow graph and do a conversion.
+    graph can be a tf.Graph or a GraphDef, which is read without a tf.Graph, see graphdef_to_onnx.
     """
+    if isinstance(graph, graph_pb2.GraphDef):
+        return graphdef_to_onnx(graph, shape_override, tf_shape_inference)
     return tflist_to_onnx(graph.get_operations(), shape_override)
 
 
@@ -429,7 +584,11 @@ def conv_convert_inputs(ctx, node, with_kernel=False, new_kernel_shape=None,
             transpose = ctx.insert_new_node_on_output("Transpose", output_name, name=op_name)
             transpose.set_attr("perm", NCHW_TO_NHWC)
             transpose.inserted_nchw = True
-            ctx.set_shape(transpose.output[0], ctx.get_shape(node.output[idx]))
+            shape = ctx.get_shape(node.output[idx])
+            ctx.set_shape(transpose.output[0], shape)
+            if shape and len(shape) == 4:
+                # the op itself now produces NCHW
+                ctx.set_shape(node.output[idx], spatial_map(shape, NHWC_TO_NCHW))
             nodes.append(transpose)
             node.data_format = "NCHW"
     return nodes
@@ -1398,149 +1557,170 @@ _OPSETS = [
 ]
 
 
-def rewrite_random_uniform(g, ops):
-    pattern = \
-        OpTypePattern('Add', name='output', inputs=[
-            OpTypePattern('Mul', inputs=[
-                OpTypePattern('RandomUniform', name='input1', inputs=["*"]),
-                OpTypePattern('Sub', name='input2', inputs=["*", "*"]),
-            ]), None
-        ])
+RANDOM_UNIFORM_PATTERN = \
+    OpTypePattern('Add', name='output', inputs=[
+        OpTypePattern('Mul', single_consumer=True, inputs=[
+            OpTypePattern('RandomUniform', name='input1', inputs=["*"], single_consumer=True),
+            OpTypePattern('Sub', name='input2', single_consumer=True, inputs=[
+                OpTypePattern("*", constraints=[const_value()]),
+                OpTypePattern("*", constraints=[const_value()]),
+            ]),
+        ]), None
+    ])
 
-    matcher = GraphMatcher(pattern)
-    match_results = list(matcher.match_ops(ops))
-    for match in match_results:
-        input2 = match.get_op('input2')
-        output = match.get_op('output')
-        # max is on input 0
-        tmax = input2.inputs[0].get_tensor_value()[0]
-        tmin = input2.inputs[1].get_tensor_value()[0]
-        dtype = output.dtype
-        op_name = utils.make_name("RandomUniform")
-        out_name = port_name(op_name)
-        ru_op = match.get_op('input1')
-        if ru_op.inputs[0].type == "Shape":
-            shape_op = ru_op.inputs[0]
-            new_node = Node(helper.make_node("RandomUniformLike",
-                                             [shape_op.input[0]], [out_name], name=op_name,
-                                             low=tmin, high=tmax, dtype=dtype), g)
-        else:
-            shape = g.get_shape(output.output[0])
-            new_node = Node(helper.make_node("RandomUniform",
-                                             [], [out_name], name=op_name,
-                                             low=tmin, high=tmax, dtype=dtype, shape=shape), g)
-        ops = g.replace_subgraph(ops, match, [], [output], [], [new_node])
 
-    return ops
+def _build_random_uniform(g, match):
+    input2 = match.get_op('input2')
+    output = match.get_op('output')
+    # max is on input 0
+    tmax = input2.inputs[0].get_tensor_value()[0]
+    tmin = input2.inputs[1].get_tensor_value()[0]
+    dtype = output.dtype
+    op_name = utils.make_name("RandomUniform")
+    out_name = port_name(op_name)
+    ru_op = match.get_op('input1')
+    if ru_op.inputs[0].type == "Shape":
+        shape_op = ru_op.inputs[0]
+        new_node = Node(helper.make_node("RandomUniformLike",
+                                         [shape_op.input[0]], [out_name], name=op_name,
+                                         low=tmin, high=tmax, dtype=dtype), g)
+    else:
+        shape = g.get_shape(output.output[0])
+        new_node = Node(helper.make_node("RandomUniform",
+                                         [], [out_name], name=op_name,
+                                         low=tmin, high=tmax, dtype=dtype, shape=shape), g)
+    return [new_node], {output.output[0]: out_name}
+
+
+TRANSPOSE_PATTERN = \
+    OpTypePattern('Transpose', name='output', inputs=[
+        OpTypePattern(None),
+        OpTypePattern('Sub', inputs=[
+            OpTypePattern('Sub', inputs=["*", "*"]),
+            OpTypePattern('Range', inputs=["*", "*", "*"]),
+        ]),
+    ])
+
 
+def _build_transpose(g, match):
+    # the Transpose is kept, it gets the perm as attribute instead of the computed input
+    output = match.get_op('output')
+    shape = g.get_shape(output.input[0])
+    dims = [i for i in range(len(shape) - 1, -1, -1)]
+    output.set_attr("perm", dims)
+    g.remove_input(output, output.input[1])
+    return [], {}
 
-def rewrite_transpose(g, ops):
-    pattern = \
-        OpTypePattern('Transpose', name='output', inputs=[
-            OpTypePattern(None),
-            OpTypePattern('Sub', inputs=[
-                OpTypePattern('Sub', inputs=["*", "*"]),
-                OpTypePattern('Range', inputs=["*", "*", "*"]),
-            ]),
-        ])
 
-    matcher = GraphMatcher(pattern)
-    match_results = list(matcher.match_ops(ops))
-    for match in match_results:
-        output = match.get_op('output')
-        shape = g.get_shape(output.input[0])
-        dims = [i for i in range(len(shape) - 1, -1, -1)]
-        output.set_attr("perm", dims)
-        g.remove_input(output, output.input[1])
-        ops = g.replace_subgraph(ops, match, [], [], [], [])
-        ops.append(output)
-    return ops
+RANDOM_NORMAL_PATTERN = \
+    OpTypePattern('Add', name='output', inputs=[
+        OpTypePattern('Mul', name='input2', single_consumer=True, inputs=[
+            OpTypePattern('RandomStandardNormal', name='input1', inputs=["*"], single_consumer=True), "*"
+        ]), OpTypePattern("*", constraints=[const_value()])
+    ])
 
 
-def rewrite_random_normal(g, ops):
-    pattern = \
-        OpTypePattern('Add', name='output', inputs=[
-            OpTypePattern('Mul', name='input2', inputs=[
-                OpTypePattern('RandomStandardNormal', name='input1', inputs=["*"]), "*"
-            ]), "*"
-        ])
+def _build_random_normal(g, match):
+    output = match.get_op('output')
+    mean = output.inputs[1].get_tensor_value()[0]
+    dtype = output.dtype
+    op_name = utils.make_name("RandomNormal")
+    out_name = port_name(op_name)
 
-    matcher = GraphMatcher(pattern)
-    match_results = list(matcher.match_ops(ops))
-    for match in match_results:
-        output = match.get_op('output')
-        mean = output.inputs[1].get_tensor_value()[0]
-        dtype = output.dtype
-        op_name = utils.make_name("RandomNormal")
-        out_name = port_name(op_name)
-
-        rn_op = match.get_op('input1')
-        if rn_op.inputs[0].type == "Shape":
-            shape_op = rn_op.inputs[0]
-            new_node = Node(helper.make_node("RandomNormalLike", [shape_op.input[0]], [out_name],
-                                             name=op_name, mean=mean, scale=1.0,
-                                             dtype=dtype), g)
-            ops = g.replace_subgraph(ops, match, [], [output], [], [new_node])
-        else:
-            shape = g.get_shape(output.output[0])
-            new_node = Node(helper.make_node("RandomNormal", [], [out_name],
-                                             name=op_name, shape=shape, mean=mean, scale=1.0,
-                                             dtype=dtype), g)
-            ops = g.replace_subgraph(ops, match, [], [output], [], [new_node])
+    rn_op = match.get_op('input1')
+    if rn_op.inputs[0].type == "Shape":
+        shape_op = rn_op.inputs[0]
+        new_node = Node(helper.make_node("RandomNormalLike", [shape_op.input[0]], [out_name],
+                                         name=op_name, mean=mean, scale=1.0,
+                                         dtype=dtype), g)
+    else:
+        shape = g.get_shape(output.output[0])
+        new_node = Node(helper.make_node("RandomNormal", [], [out_name],
+                                         name=op_name, shape=shape, mean=mean, scale=1.0,
+                                         dtype=dtype), g)
+    return [new_node], {output.output[0]: out_name}
+
+
+DROPOUT_PATTERN = \
+    OpTypePattern('Mul', name='outputs', inputs=[
+        OpTypePattern('RealDiv', name="input2", single_consumer=True),
+        OpTypePattern('Floor', single_consumer=True, inputs=[
+            OpTypePattern('Add', single_consumer=True, inputs=[
+                OpTypePattern(None, name="input3"),
+                OpTypePattern('RandomUniform'),
+            ])
+        ]),
+    ])
 
-    return ops
 
+def _build_dropout(g, match):
+    inputs2 = match.get_op('input2')
+    outputs = match.get_op('outputs')
+    op_name = utils.make_name("Dropout")
+    out_name = port_name(op_name)
+    new_node = Node(helper.make_node("Dropout", [inputs2.input[0]], [out_name], name=op_name, ratio=1.0), g)
+    return [new_node], {outputs.output[0]: out_name}
 
-def rewrite_dropout(g, ops):
-    pattern = \
-        OpTypePattern('Mul', name='outputs', inputs=[
-            OpTypePattern('RealDiv', name="input2"),
-            OpTypePattern('Floor', inputs=[
-                OpTypePattern('Add', inputs=[
-                    OpTypePattern(None, name="input3"),
-                    OpTypePattern('RandomUniform'),
-                ])
+
+FLATTEN_PATTERN = \
+    OpTypePattern('Reshape', name='outputs', inputs=[
+        OpTypePattern("*", name="input2"),
+        OpTypePattern('Pack', single_consumer=True, inputs=[
+            OpTypePattern('StridedSlice', single_consumer=True, inputs=[
+                "*", "*", "*", "*",
             ]),
-        ])
-    matcher = GraphMatcher(pattern)
-    match_results = list(matcher.match_ops(ops))
-    for match in match_results:
-        inputs2 = match.get_op('input2')
-        outputs = match.get_op('outputs')
-        op_name = utils.make_name("Dropout")
-        out_name = port_name(op_name)
-        new_node = Node(helper.make_node("Dropout", [inputs2.input[0]], [out_name], name=op_name, ratio=1.0), g)
-        ops = g.replace_subgraph(ops, match, [inputs2], [outputs], [new_node], [new_node])
+            "*",
+        ]),
+    ])
+
+
+def _build_flatten(g, match):
+    inputs2 = match.get_op('input2')
+    outputs = match.get_op('outputs')
+    op_name = utils.make_name("Flatten")
+    out_name = port_name(op_name)
+    new_node = Node(helper.make_node("Flatten", [inputs2.output[0]], [out_name], name=op_name), g)
+    return [new_node], {outputs.output[0]: out_name}
+
 
-    return ops
+# pre-processing rewrite rules, in priority order
+REWRITE_RULES = [
+    RewriteRule("transpose", TRANSPOSE_PATTERN, _build_transpose, keep=["output"]),
+    RewriteRule("flatten", FLATTEN_PATTERN, _build_flatten, keep=["input2"]),
+    RewriteRule("random_uniform", RANDOM_UNIFORM_PATTERN, _build_random_uniform),
+    RewriteRule("random_normal", RANDOM_NORMAL_PATTERN, _build_random_normal),
+    RewriteRule("dropout", DROPOUT_PATTERN, _build_dropout),
+]
+
+
+def rewrite_patterns(g, ops, names=None):
+    """Apply the REWRITE_RULES in names, all of them by default, in one pass over ops.
+
+    Rewrites are matched incrementally, a rewrite enabled by another one is applied
+    in the same pass.
+    """
+    rules = [rule for rule in REWRITE_RULES if names is None or rule.name in names]
+    return apply_rules(g, ops, rules, incremental=True)
+
+
+def rewrite_random_uniform(g, ops):
+    return rewrite_patterns(g, ops, ["random_uniform"])
+
+
+def rewrite_transpose(g, ops):
+    return rewrite_patterns(g, ops, ["transpose"])
+
+
+def rewrite_random_normal(g, ops):
+    return rewrite_patterns(g, ops, ["random_normal"])
+
+
+def rewrite_dropout(g, ops):
+    return rewrite_patterns(g, ops, ["dropout"])
 
 
 def rewrite_flatten(g, ops):
-    pattern = \
-        OpTypePattern('Reshape', name='outputs', inputs=[
-            OpTypePattern("*", name="input2"),
-            OpTypePattern('Pack', inputs=[
-                OpTypePattern('StridedSlice', inputs=[
-                    "*", "*", "*", "*",
-                ]),
-                "*",
-            ]),
-        ])
-    matcher = GraphMatcher(pattern)
-    match_results = list(matcher.match_ops(ops))
-    for match in match_results:
-        inputs2 = match.get_op('input2')
-        outputs = match.get_op('outputs')
-        op_name = utils.make_name("Flatten")
-        out_name = port_name(op_name)
-        new_node = Node(helper.make_node("Flatten", [inputs2.output[0]], [out_name], name=op_name), g)
-        g.replace_all_inputs(ops, outputs.output[0], out_name)
-        to_be_removed = [node for node in match.get_nodes() if node != inputs2]
-        for i in range(len(ops) - 1, -1, -1):
-            if ops[i] in to_be_removed:
-                del ops[i]
-        ops.append(new_node)
-    return ops
+    return rewrite_patterns(g, ops, ["flatten"])
 
 
 def rewrite_incomplete_type_support(g, ops):
@@ -1658,10 +1838,11 @@ def tensorflow_onnx_mapping(g, continue_on_error, custom_op_handlers):
             else:
                 raise ex
         if onnx_node:
-            if isinstance(onnx_node, list):
-                onnx_nodes.extend(onnx_node)
-            else:
-                onnx_nodes.append(onnx_node)
+            if not isinstance(onnx_node, list):
+                onnx_node = [onnx_node]
+            # refine shapes right away so handlers of the consumers can use them
+            infer_shapes(g, onnx_node)
+            onnx_nodes.extend(onnx_node)
 
     g.set_nodes(onnx_nodes)
 
@@ -1687,18 +1868,37 @@ def tf_optimize(inputs, outputs, graph_def, fold_constant=None):
     return graph_def
 
 
+def bind_batch_size(onnx_nodes, output_shapes, batch_size):
+    """Bind the unknown batch dimension of all placeholders to batch_size.
+    The shapes of the other ops get refined from there by shape inference during the op mapping.
+    """
+    for node in onnx_nodes:
+        if node.op_type != "Placeholder":
+            continue
+        for name in node.output:
+            shape = output_shapes.get(name)
+            if shape and (shape[0] is None or shape[0] < 0):
+                output_shapes[name] = [batch_size] + list(shape[1:])
+
+
 def process_tf_graph(tf_graph, continue_on_error=False, verbose=False, target=None,
                      opset=None, custom_op_handlers=None, custom_rewriter=None,
-                     extra_opset=None, shape_override=None):
+                     extra_opset=None, shape_override=None, batch_size=None, matcher_stats=None,
+                     tf_shape_inference=True):
     """Convert tensorflow graph to onnx graph.
         Args:
-            tf_graph: tensorflow graph
+            tf_graph: tensorflow graph or GraphDef, a GraphDef is converted without a tf.Graph
             continue_on_error: if an op can't be processed (aka there is no mapping), continue
             verbose: print summary stats
             target: list of workarounds applied to help certain platforms
             opset: the opset to be used (int, default is latest)
             custom_op_handlers: dictionary of custom ops handlers
             custom_rewriter: list of custom graph rewriters
+            batch_size: if set, unknown batch dimensions of all graph inputs are bound to it
+            matcher_stats: MatcherStats the pattern matchers of the rewriters record into,
+                verbose prints them
+            tf_shape_inference: for a GraphDef, use tensorflow shape inference for outputs
+                without _output_shapes
         Return:
             onnx graph
     """
@@ -1716,22 +1916,32 @@ def process_tf_graph(tf_graph, continue_on_error=False, verbose=False, target=No
         shape_override = {}
     if target is None:
         target = DEFAULT_TARGET
+    if matcher_stats is None and verbose:
+        matcher_stats = MatcherStats()
 
-    onnx_nodes, op_cnt, attr_cnt, output_shapes, dtypes = tensorflow_to_onnx(tf_graph, shape_override)
+    onnx_nodes, op_cnt, attr_cnt, output_shapes, dtypes = tensorflow_to_onnx(tf_graph, shape_override,
+                                                                             tf_shape_inference)
+    if batch_size is not None:
+        bind_batch_size(onnx_nodes, output_shapes, batch_size)
 
     g = Graph(onnx_nodes, output_shapes, dtypes, target, opset, extra_opset)
     ops = g.get_nodes()
 
     # pre-processing graph rewrites
-    rewriters = [rewrite_transpose, rewrite_flatten, rewrite_random_uniform,
-                 rewrite_random_normal, rewrite_dropout,
-                 rewrite_single_direction_lstm, rewrite_bi_direction_lstm]
+    # the pattern rewriters share a single traversal of the graph
+    rewriters = [rewrite_patterns, rewrite_single_direction_lstm, rewrite_bi_direction_lstm]
 
     if custom_rewriter is not None:
         rewriters.extend(custom_rewriter)
-    for rewrite in rewriters:
-        ops = rewrite(g, ops)
-        g.set_nodes(ops)
+    if matcher_stats is not None:
+        previous_stats = set_stats(matcher_stats)
+    try:
+        for rewrite in rewriters:
+            ops = rewrite(g, ops)
+            g.set_nodes(ops)
+    finally:
+        if matcher_stats is not None:
+            set_stats(previous_stats)
     topological_sort(g.get_nodes())
 
     if custom_op_handlers is None:
@@ -1752,10 +1962,14 @@ def process_tf_graph(tf_graph, continue_on_error=False, verbose=False, target=No
     # onnx requires topological sorting
     topological_sort(g.get_nodes())
 
+    # fill in shapes and dtypes tensorflow didn't know or the handlers didn't record
+    infer_shapes(g)
+
     g.update_proto()
     if verbose:
         print("tensorflow ops: {}".format(op_cnt))
         print("tensorflow attr: {}".format(attr_cnt))
         print("onnx mapped: {}".format(mapped_op))
         print("onnx unmapped: {}".format(unmapped_op))
+        print(matcher_stats.summary())
     return g
@@ -0,0 +1,145 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+Time GraphMatcher.match_ops on a large synthetic tensorflow graph.
+
+The graph repeats a dense layer block (MatMul, BiasAdd, Relu, Identity, Reshape of a Pack of a
+StridedSlice) and every --dropout-every blocks a dropout, so the flatten and dropout patterns
+find matches while most nodes are no candidate root for any pattern.
+
+For each of the patterns process_tf_graph matches this compares
+  scan     trying the pattern on every node, what match_ops did before the op type index
+  indexed  match_ops on the graph node list, including building the op type index
+  cached   match_ops again on the same graph version, the index is reused
+The rewriters line times the pattern rewriters of tfonnx.py matched one after another with
+scans against a single MultiPatternMatcher traversal, the last line the time rewrite_patterns
+takes to match and apply all of them on a fresh graph.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+from onnx import helper
+
+from tf2onnx.graph import Graph
+from tf2onnx.graph_matcher import GraphMatcher, MultiPatternMatcher
+from tf2onnx.rewriter.rnn_utils import lstmcell_pattern
+from tf2onnx.tfonnx import REWRITE_RULES, rewrite_patterns
+
+PATTERNS = {rule.name: rule.pattern for rule in REWRITE_RULES}
+PATTERNS["lstm"] = lstmcell_pattern
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=200000, help="approximate number of nodes")
+    parser.add_argument("--dropout-every", type=int, default=10, help="blocks between dropouts")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per pattern, the fastest counts")
+    return parser.parse_args()
+
+
+class GraphBuilder(object):
+    def __init__(self):
+        self.nodes = [helper.make_node("Placeholder", [], ["input:0"], name="input")]
+
+    def add(self, op_type, inputs):
+        name = "n{}".format(len(self.nodes))
+        self.nodes.append(helper.make_node(op_type, inputs, [name + ":0"], name=name))
+        return name + ":0"
+
+
+def make_graph(nodes, dropout_every):
+    b = GraphBuilder()
+    x = "input:0"
+    block = 0
+    while len(b.nodes) < nodes:
+        x = b.add("MatMul", [x, b.add("Const", [])])
+        x = b.add("Relu", [b.add("BiasAdd", [x, b.add("Const", [])])])
+        x = b.add("Identity", [x])
+        shape = b.add("Shape", [x])
+        begin, end, strides = b.add("Const", []), b.add("Const", []), b.add("Const", [])
+        batch = b.add("StridedSlice", [shape, begin, end, strides])
+        x = b.add("Reshape", [x, b.add("Pack", [batch, b.add("Const", [])])])
+        block += 1
+        if block % dropout_every == 0:
+            keep = b.add("Const", [])
+            noise = b.add("RandomUniform", [b.add("Shape", [x])])
+            mask = b.add("Floor", [b.add("Add", [keep, noise])])
+            x = b.add("Mul", [b.add("RealDiv", [x, keep]), mask])
+    return Graph(b.nodes, output_shapes={}, dtypes={})
+
+
+def scan(matcher, ops):
+    return [m for m in (matcher.match_op(op) for op in ops) if m]
+
+
+def best_time(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def speedup(before, after):
+    if after < 1e-4:
+        return "{:>8}".format("-")
+    return "{:>7.1f}x".format(before / after)
+
+
+def main():
+    args = get_args()
+    start = time.time()
+    g = make_graph(args.nodes, args.dropout_every)
+    print("graph with {} nodes built in {:.1f}s".format(len(g.get_nodes()), time.time() - start))
+    print("{:<15} {:>8} {:>10} {:>12} {:>11} {:>8}".format(
+        "pattern", "matches", "scan(ms)", "indexed(ms)", "cached(ms)", "speedup"))
+    total_scan = total_cached = 0.
+    for name, pattern in sorted(PATTERNS.items()):
+        matcher = GraphMatcher(pattern, allow_reorder=name == "lstm")
+        ops = g.get_nodes()
+        t_scan, expected = best_time(lambda: scan(matcher, ops), args.repeat)
+
+        def indexed():
+            g.bump_version()
+            return list(matcher.match_ops(ops))
+
+        t_indexed, found = best_time(indexed, args.repeat)
+        t_cached, _ = best_time(lambda: list(matcher.match_ops(ops)), args.repeat)
+        if len(found) != len(expected):
+            raise ValueError("pattern " + name + ": index found " + str(len(found)) + " matches, scan " +
+                             str(len(expected)))
+        total_scan += t_scan
+        total_cached += t_cached
+        print("{:<15} {:>8} {:>10.1f} {:>12.1f} {:>11.1f} {}".format(
+            name, len(found), t_scan * 1000, t_indexed * 1000, t_cached * 1000, speedup(t_scan, t_cached)))
+    print("{:<15} {:>8} {:>10.1f} {:>12} {:>11.1f} {}".format(
+        "total", "", total_scan * 1000, "", total_cached * 1000, speedup(total_scan, total_cached)))
+
+    ops = g.get_nodes()
+    matchers = [GraphMatcher(rule.pattern) for rule in REWRITE_RULES]
+    t_scan, _ = best_time(lambda: [scan(matcher, ops) for matcher in matchers], args.repeat)
+    multi = MultiPatternMatcher()
+    for rule in REWRITE_RULES:
+        multi.add(rule.name, rule.pattern)
+    t_multi, found = best_time(lambda: multi.match_ops(ops), args.repeat)
+    print("{:<15} {:>8} {:>10.1f} {:>12} {:>11.1f} {}".format(
+        "rewriters", len(found), t_scan * 1000, "", t_multi * 1000, speedup(t_scan, t_multi)))
+
+    g = make_graph(args.nodes, args.dropout_every)
+    before = len(g.get_nodes())
+    start = time.time()
+    g.set_nodes(rewrite_patterns(g, g.get_nodes()))
+    print("rewrite_patterns: {:.1f}ms, {} -> {} nodes".format((time.time() - start) * 1000, before,
+                                                              len(g.get_nodes())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+Time the TransposeOptimizer on synthetic NHWC graphs of growing depth.
+
+The graphs are built directly as tf2onnx Graphs the way conv_convert_inputs leaves NHWC
+convolutions, every Conv, ConvTranspose and MaxPool is wrapped in
+Transpose(NHWC->NCHW) -> op -> Transpose(NCHW->NHWC), so the optimizer has to cancel the
+transposes between them:
+
+  mobilenet  depthwise and pointwise convs with Clip, global average pool head
+  resnet     Conv -> Relu -> Conv blocks with Add skip connections
+  inception  blocks of parallel conv / pool branches joined by a Concat
+  unet       MaxPool encoder and ConvTranspose decoder with Concat skip connections
+
+For each model and depth the optimizer wall time, the peak memory allocated while it runs
+and the remaining transposes are reported. --save-baseline writes the results to a json
+file, --baseline compares against one and fails if transposes are left that weren't before
+or if the time grows beyond --tolerance. By default the results are compared against
+optimizer_benchmark_baseline.json next to this script, pass --baseline "" to skip that.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from onnx import helper, numpy_helper, TensorProto
+
+from tf2onnx import utils
+from tf2onnx.graph import Graph
+from tf2onnx.optimizer.transpose_optimizer import TransposeOptimizer
+
+CHANNELS = 8
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "optimizer_benchmark_baseline.json")
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", default=",".join(sorted(MODELS)), help="comma separated list of models")
+    parser.add_argument("--blocks", default="25,50,100,200", help="comma separated list of graph depths")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per depth, the fastest counts")
+    parser.add_argument("--baseline", default=BASELINE, help="json file with results to compare against")
+    parser.add_argument("--save-baseline", help="write the results to this json file")
+    parser.add_argument("--tolerance", type=float, default=2.,
+                        help="fail if the time grows by more than this factor over the baseline")
+    args = parser.parse_args()
+    args.models = args.models.split(",")
+    for model in args.models:
+        if model not in MODELS:
+            parser.error("unknown model " + model + ", known models: " + ", ".join(sorted(MODELS)))
+    args.blocks = [int(b) for b in args.blocks.split(",")]
+    return args
+
+
+class GraphBuilder(object):
+    """Collects onnx nodes and weights and turns them into a tf2onnx Graph."""
+
+    def __init__(self):
+        self.nodes = [helper.make_node("Placeholder", [], ["input:0"], name="input")]
+        self.weights = []
+
+    def add(self, op_type, inputs, **kwargs):
+        name = "n{}".format(len(self.nodes))
+        self.nodes.append(helper.make_node(op_type, inputs, [name + ":0"], name=name, **kwargs))
+        return name + ":0"
+
+    def const(self, val):
+        name = "W{}".format(len(self.weights))
+        self.weights.append(numpy_helper.from_array(val, name))
+        return name
+
+    def nchw(self, op_type, x, inputs=None, **kwargs):
+        """NHWC op the way conv_convert_inputs converts it."""
+        x = self.add("Transpose", [x], perm=[0, 3, 1, 2])
+        x = self.add(op_type, [x] + (inputs or []), **kwargs)
+        return self.add("Transpose", [x], perm=[0, 2, 3, 1])
+
+    def conv(self, x, channels_in=CHANNELS, channels_out=CHANNELS, kernel=1, group=1):
+        w = self.const(np.ones([channels_out, channels_in // group, kernel, kernel], dtype=np.float32))
+        pad = kernel // 2
+        return self.nchw("Conv", x, [w], kernel_shape=[kernel, kernel], pads=[pad] * 4, group=group)
+
+    def build(self, output):
+        output = self.add("Identity", [output])
+        g = Graph(self.nodes, output_shapes={"input:0": [1, 32, 32, CHANNELS]},
+                  dtypes={"input:0": TensorProto.FLOAT}, opset=7)
+        for w in self.weights:
+            g.add_initializer(w)
+        return g, [output]
+
+
+def make_mobilenet(blocks):
+    b = GraphBuilder()
+    x = "input:0"
+    for _ in range(blocks):
+        x = b.add("Clip", [b.conv(x, kernel=3, group=CHANNELS)], min=0., max=6.)
+        x = b.add("Clip", [b.conv(x)], min=0., max=6.)
+    x = b.add("ReduceMean", [x], axes=[1, 2], keepdims=0)
+    x = b.add("MatMul", [x, b.const(np.ones([CHANNELS, 10], dtype=np.float32))])
+    return b.build(b.add("Softmax", [x]))
+
+
+def make_resnet(blocks):
+    b = GraphBuilder()
+    x = "input:0"
+    for _ in range(blocks):
+        y = b.add("Relu", [b.conv(x)])
+        y = b.conv(y)
+        x = b.add("Relu", [b.add("Add", [x, y])])
+    return b.build(x)
+
+
+def make_inception(blocks):
+    b = GraphBuilder()
+    x = "input:0"
+    half = CHANNELS // 2
+    for _ in range(blocks):
+        b1 = b.add("Relu", [b.conv(x, channels_out=half)])
+        b2 = b.add("Relu", [b.conv(b.add("Relu", [b.conv(x, channels_out=half)]), half, half, kernel=3)])
+        b3 = b.nchw("MaxPool", x, kernel_shape=[3, 3], pads=[1, 1, 1, 1], strides=[1, 1])
+        b3 = b.add("Relu", [b.conv(b3, channels_out=half)])
+        b4 = b.add("Relu", [b.conv(x, channels_out=half)])
+        x = b.add("Concat", [b1, b2, b3, b4], axis=3)
+        x = b.add("Relu", [b.conv(x, channels_in=2 * CHANNELS)])
+    return b.build(x)
+
+
+def make_unet(blocks):
+    b = GraphBuilder()
+    x = "input:0"
+    skips = []
+    for _ in range(blocks):
+        x = b.add("Relu", [b.conv(x, kernel=3)])
+        skips.append(x)
+        x = b.nchw("MaxPool", x, kernel_shape=[2, 2], strides=[2, 2])
+    x = b.add("Relu", [b.conv(x, kernel=3)])
+    for skip in reversed(skips):
+        w = b.const(np.ones([CHANNELS, CHANNELS, 2, 2], dtype=np.float32))
+        x = b.nchw("ConvTranspose", x, [w], kernel_shape=[2, 2], strides=[2, 2])
+        x = b.add("Concat", [skip, x], axis=3)
+        x = b.add("Relu", [b.conv(x, channels_in=2 * CHANNELS, kernel=3)])
+    return b.build(x)
+
+
+MODELS = {
+    "inception": make_inception,
+    "mobilenet": make_mobilenet,
+    "resnet": make_resnet,
+    "unet": make_unet,
+}
+
+
+def count_transposes(g):
+    return len([n for n in g.get_nodes() if n.type == "Transpose"])
+
+
+def run(model, blocks, repeat):
+    """Optimize the graph repeat times for the fastest time and once more with memory tracing."""
+    best = None
+    for _ in range(repeat):
+        utils.INTERNAL_NAME = 1
+        g, outputs = MODELS[model](blocks)
+        optimizer = TransposeOptimizer(g, output_names=outputs)
+        start = time.time()
+        optimizer.optimize()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # tracing slows down the optimizer, it gets a run of its own
+    utils.INTERNAL_NAME = 1
+    g, outputs = MODELS[model](blocks)
+    result = {"model": model, "blocks": blocks, "nodes": len(g.get_nodes()), "before": count_transposes(g),
+              "time": best}
+    optimizer = TransposeOptimizer(g, output_names=outputs)
+    tracemalloc.start()
+    optimizer.optimize()
+    result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result["transposes"] = count_transposes(g)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of results against the baseline."""
+    previous = {(r["model"], r["blocks"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        key = (result["model"], result["blocks"])
+        if key not in previous:
+            continue
+        old = previous[key]
+        if result["transposes"] > old["transposes"]:
+            regressions.append("{} {}: {} transposes left, baseline {}".format(
+                key[0], key[1], result["transposes"], old["transposes"]))
+        if result["time"] > old["time"] * tolerance:
+            regressions.append("{} {}: {:.1f}ms, baseline {:.1f}ms".format(
+                key[0], key[1], result["time"] * 1000, old["time"] * 1000))
+    return regressions
+
+
+def main():
+    args = get_args()
+    results = []
+    print("{:<10} {:>7} {:>7} {:>10} {:>12} {:>11} {:>11}".format(
+        "model", "blocks", "nodes", "time(ms)", "us per node", "peak(KiB)", "transposes"))
+    for model in args.models:
+        for blocks in args.blocks:
+            result = run(model, blocks, args.repeat)
+            results.append(result)
+            print("{:<10} {:>7} {:>7} {:>10.1f} {:>12.1f} {:>11.1f} {:>5} -> {:<4}".format(
+                model, blocks, result["nodes"], result["time"] * 1000, result["time"] * 1e6 / result["nodes"],
+                result["peak_memory"] / 1024, result["before"], result["transposes"]))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("regression: " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()